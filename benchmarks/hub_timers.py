@@ -60,7 +60,8 @@ l = []
 def work (n):
     l.append(n)
 
-timeouts = [random.uniform(0, 10) for x in xrange(timer_count)]
+timeouts = [random.uniform(0, 1) for x in xrange(timer_count)]
+
 
 hub = get_hub()
 
@@ -74,10 +75,26 @@ for timeout in timeouts:
 
     scheduled.append(t)
 
-hub.prepare_timers()
-hub.fire_timers(time.time() + 11)
-hub.prepare_timers()
+## cancel a third of them: they are discarded lazily by the hub
+for t in scheduled[::3]:
+    t.cancel()
+
+end = time.time()
+schedule_duration = end - start
+
+## let all the deadlines pass without running the hub, so only the firing is timed
+time.sleep(max(timeouts) + 0.1)
+
+expected = timer_count - len(scheduled[::3])
+
+start = time.time()
+
+while len(l) < expected:
+    evy.sleep(0)
 
 end = time.time()
+fire_duration = end - start
 
-print "Duration: %f" % (end - start,)
+print "Schedule & cancel: %f" % (schedule_duration,)
+print "Fire: %f" % (fire_duration,)
+print "Duration: %f" % (schedule_duration + fire_duration,)
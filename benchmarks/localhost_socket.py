@@ -54,6 +54,10 @@ SIZE = 1
 CONCURRENCY = 50
 TRIES = 5
 
+## read sizes used when measuring the throughput (the writers always send big chunks)
+READ_SIZES = [1, 16, 256, 4096, 65536]
+WRITE_SIZE = None
+
 
 
 
@@ -68,8 +72,9 @@ def writer (addr, socket_impl):
     sock = socket_impl(socket_orig.AF_INET, socket_orig.SOCK_STREAM)
     sock.connect(addr)
     sent = 0
+    size = WRITE_SIZE or SIZE
     while sent < BYTES:
-        d = 'xy' * (max(min(SIZE / 2, BYTES - sent), 1))
+        d = 'xy' * (max(min(size / 2, BYTES - sent), 1))
         sock.sendall(d)
         sent += len(d)
 
@@ -88,9 +93,9 @@ def launch_green_threads ():
 
     pool = evy.GreenPool(CONCURRENCY * 2 + 1)
     server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_sock.bind(('localhost', 0))
+    server_sock.bind(('127.0.0.1', 0))
     server_sock.listen(50)
-    addr = ('localhost', server_sock.getsockname()[1])
+    addr = ('127.0.0.1', server_sock.getsockname()[1])
     pool.spawn_n(green_accepter, server_sock, pool)
     for i in xrange(CONCURRENCY):
         pool.spawn_n(writer, addr, socket.socket)
@@ -111,9 +116,9 @@ def launch_heavy_threads ():
 
     threads = []
     server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_sock.bind(('localhost', 0))
+    server_sock.bind(('127.0.0.1', 0))
     server_sock.listen(50)
-    addr = ('localhost', server_sock.getsockname()[1])
+    addr = ('127.0.0.1', server_sock.getsockname()[1])
     accepter_thread = threading.Thread(None, heavy_accepter, "accepter thread",
         (server_sock, threads))
     accepter_thread.start()
@@ -140,6 +145,9 @@ if __name__ == "__main__":
                       default = CONCURRENCY)
     parser.add_option('-t', '--tries', type = 'int', dest = 'tries',
                       default = TRIES)
+    parser.add_option('--read-sizes', action = 'store_true', dest = 'read_sizes',
+                      default = False,
+                      help = 'measure the throughput for several read sizes')
 
     opts, args = parser.parse_args()
 
@@ -147,6 +155,20 @@ if __name__ == "__main__":
     SIZE = opts.size
     CONCURRENCY = opts.concurrency
 
+    if opts.read_sizes:
+        WRITE_SIZE = max(READ_SIZES)
+        print
+        print "measuring throughput for %d bytes x %d connections..." % (BYTES, CONCURRENCY)
+        print
+
+        for SIZE in READ_SIZES:
+            results = benchmarks.measure_best(opts.tries, 1, lambda: None, lambda: None,
+                                              launch_green_threads)
+            elapsed = results[launch_green_threads]
+            print "read size %6d: %8.3f secs, %10.2f KB/s" % (SIZE, elapsed,
+                                                            (BYTES * CONCURRENCY) / elapsed / 1024.0)
+        raise SystemExit
+
     funcs = [launch_green_threads]
     if opts.threading:
         funcs.append(launch_heavy_threads)
@@ -52,8 +52,12 @@ class BenchResults(object):
     spawn = None
     spawn_n = None
     spawn_n_kw = None
+    recycled_spawn = None
+    recycled_spawn_n = None
     pool_spawn = None
     pool_spawn_n = None
+    recycled_pool_spawn = None
+    recycled_pool_spawn_n = None
 
 
 def percent(x, y):
@@ -63,7 +67,7 @@ pool = None
 iters = 10000
 
 def bench_spawn_evy():
-    from evy.green.threads import spawn, spawn_n, sleep
+    from evy.green.threads import spawn, spawn_n, sleep, recycle_workers
     from evy.green.pools import GreenPool
 
     print
@@ -100,6 +104,18 @@ def bench_spawn_evy():
 
     print "evy spawn/spawn_n difference %% %0.1f" % percent(best[run_spawn], best[run_spawn_n])
 
+    recycle_workers()
+    try:
+        best = benchmarks.measure_best(5, iters, 'pass', cleanup, run_spawn_n, run_spawn)
+    finally:
+        recycle_workers(0)
+
+    results.recycled_spawn = best[run_spawn]
+    print "evy.spawn (recycled workers)", results.recycled_spawn
+
+    results.recycled_spawn_n = best[run_spawn_n]
+    print "evy.spawn_n (recycled workers)", results.recycled_spawn_n
+
 
     def setup ():
         global pool
@@ -123,6 +139,19 @@ def bench_spawn_evy():
     print "evy.GreenPool.spawn_n", results.pool_spawn_n
 
     print "evy spawn/spawn_n difference: %% %0.1f" % percent(best[run_pool_spawn], best[run_pool_spawn_n])
+
+    def setup_recycled ():
+        global pool
+        pool = GreenPool(iters, recycle = True)
+
+    best = benchmarks.measure_best(3, iters, setup_recycled, cleanup_pool, run_pool_spawn,
+                                   run_pool_spawn_n)
+
+    results.recycled_pool_spawn = best[run_pool_spawn]
+    print "evy.GreenPool.spawn (recycled workers)", results.recycled_pool_spawn
+
+    results.recycled_pool_spawn_n = best[run_pool_spawn_n]
+    print "evy.GreenPool.spawn_n (recycled workers)", results.recycled_pool_spawn_n
     return results
 
 def bench_spawn_eventlet():
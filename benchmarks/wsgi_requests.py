@@ -0,0 +1,173 @@
+"""
+Benchmark the requests/second of the WSGI server, for small keep-alive requests.
+
+The request heads are parsed with :class:`evy.web.httpparser.HttpRequestParser`, and this is
+compared with the parsing done before it existed (with `--compare-legacy`): a `readline()`
+per header line, a :class:`mimetools.Message` and a second pass splitting the headers.
+
+Profiling and graphs
+====================
+
+You can profile this program and obtain a call graph with `gprof2dot` and `graphviz`:
+
+```
+python -m cProfile -o output.pstats    path/to/this/script arg1 arg2
+gprof2dot.py -f pstats output.pstats | dot -Tpng -o output.png
+```
+
+It generates a graph where a node represents a function and has the following layout:
+
+```
+    +------------------------------+
+    |        function name         |
+    | total time % ( self time % ) |
+    |         total calls          |
+    +------------------------------+
+```
+
+where:
+
+  * total time % is the percentage of the running time spent in this function and all its children;
+  * self time % is the percentage of the running time spent in this function alone;
+  * total calls is the total number of times this function was called (including recursive calls).
+
+An edge represents the calls between two functions and has the following layout:
+
+```
+               total time %
+                  calls
+    parent --------------------> children
+```
+
+where:
+
+  * total time % is the percentage of the running time transfered from the children to this parent (if available);
+  * calls is the number of calls the parent function called the children.
+
+"""
+
+import mimetools
+import StringIO
+import time
+
+import benchmarks
+
+CONCURRENCY = 10
+REQUESTS = 500
+TRIES = 3
+PIPELINE = 1
+
+REQUEST = ('GET /some/path?query=1 HTTP/1.1\r\n'
+           'Host: localhost\r\n'
+           'User-Agent: Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/20.0\r\n'
+           'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n'
+           'Accept-Language: en-US,en;q=0.5\r\n'
+           'Accept-Encoding: gzip, deflate\r\n'
+           'Cookie: session=0123456789abcdef; user=someone\r\n'
+           'Connection: keep-alive\r\n'
+           '\r\n')
+
+
+def app (env, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', '2')])
+    return ['ok']
+
+
+def legacy_protocol ():
+    from evy.web import wsgi
+
+    class LegacyHttpProtocol(wsgi.HttpProtocol):
+        """
+        The request parsing done before the HttpRequestParser
+        """
+
+        def read_request_head (self, parser):
+            line = self.rfile.readline(parser.max_request_line)
+            if not line:
+                return False
+            parser.requestline = line.rstrip('\r\n')
+            message = mimetools.Message(self.rfile, 0)
+            parser.headers = [tuple(x.strip() for x in h.split(':', 1)) for h in message.headers]
+            parser.done = True
+            return True
+
+    return LegacyHttpProtocol
+
+
+def client (addr):
+    from evy.io import convenience
+
+    sock = convenience.connect(addr)
+    ## send PIPELINE requests at a time, and wait for all the responses
+    for i in xrange(REQUESTS // PIPELINE):
+        sock.sendall(REQUEST * PIPELINE)
+        data = ''
+        while data.count('\r\n\r\nok') < PIPELINE:
+            data += sock.recv(65536)
+    sock.close()
+
+
+def run_server (protocol):
+    from evy.io import convenience
+    from evy.web import wsgi
+    import evy
+
+    server_sock = convenience.listen(('127.0.0.1', 0))
+    addr = ('127.0.0.1', server_sock.getsockname()[1])
+    server = evy.spawn(wsgi.server, server_sock, app, protocol = protocol,
+                       log = StringIO.StringIO(), log_output = False)
+    pool = evy.GreenPool(CONCURRENCY)
+    for i in xrange(CONCURRENCY):
+        pool.spawn_n(client, addr)
+    pool.waitall()
+    server.kill()
+
+
+def launch_current ():
+    from evy.web import wsgi
+
+    run_server(wsgi.HttpProtocol)
+
+
+def launch_legacy ():
+    run_server(legacy_protocol())
+
+
+if __name__ == "__main__":
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option('--compare-legacy', action = 'store_true', dest = 'legacy',
+                      default = False)
+    parser.add_option('-c', '--concurrency', type = 'int', dest = 'concurrency',
+                      default = CONCURRENCY)
+    parser.add_option('-r', '--requests', type = 'int', dest = 'requests',
+                      default = REQUESTS)
+    parser.add_option('-t', '--tries', type = 'int', dest = 'tries',
+                      default = TRIES)
+    parser.add_option('-p', '--pipeline', type = 'int', dest = 'pipeline',
+                      default = PIPELINE)
+
+    opts, args = parser.parse_args()
+
+    CONCURRENCY = opts.concurrency
+    REQUESTS = opts.requests
+    PIPELINE = opts.pipeline
+
+    funcs = [launch_current]
+    if opts.legacy:
+        funcs.append(launch_legacy)
+
+    print
+    print "measuring %d requests x %d connections (%d pipelined), %d tries..." % (
+        REQUESTS, CONCURRENCY, PIPELINE, opts.tries)
+    print
+
+    results = benchmarks.measure_best(opts.tries, 1, lambda: None, lambda: None, *funcs)
+
+    total = REQUESTS * CONCURRENCY
+    print "parser: %8.3f secs, %10.2f requests/s" % (results[launch_current],
+                                                      total / results[launch_current])
+    if opts.legacy:
+        print "legacy: %8.3f secs, %10.2f requests/s" % (results[launch_legacy],
+                                                          total / results[launch_legacy])
@@ -28,13 +28,13 @@
 
 import weakref
 
-from evy.green import threads as greenthread
+from evy.support import greenlets as greenlet
 
 __all__ = ['get_ident', 'local']
 
 def get_ident ():
     """ Returns ``id()`` of current greenlet.  Useful for debugging."""
-    return id(greenthread.getcurrent())
+    return id(greenlet.getcurrent())
 
 
 class _localbase(object):
@@ -59,10 +59,13 @@ def _patch (thrl):
 
     # until we can store the localdict on greenlets themselves,
     # we store it in _local__greens on the local object
-    cur = greenthread.getcurrent()
+    cur = greenlet.getcurrent()
     if cur not in greens:
         # must be the first time we've seen this greenlet, call __init__
         greens[cur] = {}
+        if hasattr(cur, 'generation'):
+            # a recycled greenlet: its locals are released when the function is done
+            cur.__dict__.setdefault('corolocals', []).append(greens)
         cls = type(thrl)
         if cls.__init__ is not object.__init__:
             args, kw = object.__getattribute__(thrl, '_local__args')
@@ -71,6 +74,14 @@ def _patch (thrl):
 
 
 
+def release (g):
+    """
+    Release the locals of a greenlet that is going to be recycled for running another function
+    """
+    for greens in g.__dict__.pop('corolocals', ()):
+        greens.pop(g, None)
+
+
 class local(_localbase):
     def __getattribute__ (self, attr):
         _patch(self)
@@ -39,6 +39,8 @@ Non-blocking DNS support for Evy
 
 
 import sys
+import time
+import collections
 
 import pyuv
 import pycares
@@ -48,11 +50,35 @@ from evy.event import Event
 from evy.timeout import Timeout
 
 import socket
-from _socket import getservbyname, gaierror, error
+from _socket import getservbyname, gaierror, error, inet_pton
 
 
 DNS_QUERY_TIMEOUT = 10.0
 
+## cache defaults: the maximum number of names, and the time (in seconds) we keep positive
+## answers (when the resolver does not give us the records TTL) and negative answers
+DNS_CACHE_MAX_ENTRIES = 1000
+DNS_CACHE_TTL = 300.0
+DNS_CACHE_NEGATIVE_TTL = 30.0
+
+## resolver errors that mean "this name has no records", and that can be cached
+ARES_NEGATIVE_ERRORS = ('ARES_ENOTFOUND', 'ARES_ENODATA')
+
+HOSTS_FILE = '/etc/hosts'
+
+## the DNS query for each address family
+QUERY_TYPES = {
+    socket.AF_INET:     pycares.QUERY_TYPE_A,
+    socket.AF_INET6:    pycares.QUERY_TYPE_AAAA,
+}
+
+## the socket types (and protocols) returned by getaddrinfo() when no type is specified
+DEFAULT_SOCKTYPES = [
+    (socket.SOCK_STREAM, socket.IPPROTO_TCP),
+    (socket.SOCK_DGRAM, socket.IPPROTO_UDP),
+    (socket.SOCK_RAW, 0),
+]
+
 
 ARES_ERR_MAP = {
     'ARES_EAGAIN' :    socket.EAI_AGAIN,
@@ -66,13 +92,83 @@ def is_ipv4_addr (host):
     Return true if host is a valid IPv4 address in dotted quad notation.
     """
     try:
-        d1, d2, d3, d4 = map(int, host.split('.'))
-    except (ValueError, AttributeError):
+        inet_pton(socket.AF_INET, host)
+    except (error, TypeError, UnicodeEncodeError):
+        return False
+    return True
+
+
+def is_ipv6_addr (host):
+    """
+    Return true if host is a valid IPv6 address.
+    """
+    try:
+        inet_pton(socket.AF_INET6, host)
+    except (error, TypeError, UnicodeEncodeError):
         return False
+    return True
+
+
+class HostsFile(object):
+    """
+    An in-memory index of the hosts file, loaded the first time it is used.
+    """
+
+    def __init__ (self, path = HOSTS_FILE):
+        self.path = path
+        self.index = None                   # name -> {family: [addresses]}
+
+    def load (self):
+        """
+        (Re)load the hosts file
+        """
+        index = {}
+        try:
+            f = open(self.path)
+            try:
+                for line in f:
+                    fields = line.split('#', 1)[0].split()
+                    if len(fields) < 2:
+                        continue
+                    address = fields[0]
+                    if is_ipv4_addr(address):
+                        family = socket.AF_INET
+                    elif is_ipv6_addr(address):
+                        family = socket.AF_INET6
+                    else:
+                        continue
+                    for name in fields[1:]:
+                        addresses = index.setdefault(name.lower(), {}).setdefault(family, [])
+                        if address not in addresses:
+                            addresses.append(address)
+            finally:
+                f.close()
+        except (IOError, OSError):
+            pass
+        self.index = index
+
+    def lookup (self, name, family = socket.AF_INET):
+        """
+        Get the addresses for *name* in the hosts file
+
+        :param name: the host name
+        :param family: the address family
+        :return: a list of addresses (maybe empty)
+        """
+        if self.index is None:
+            self.load()
+        try:
+            return list(self.index[name.lower()][family])
+        except (KeyError, AttributeError):
+            return []
 
-    if 0 <= d1 <= 255 and 0 <= d2 <= 255 and 0 <= d3 <= 255 and 0 <= d4 <= 255:
-        return True
-    return False
+    def __contains__ (self, name):
+        if self.index is None:
+            self.load()
+        try:
+            return name.lower() in self.index
+        except AttributeError:
+            return False
 
 
 #
@@ -191,24 +287,150 @@ class CaresResolver(object):
         self._channel.getnameinfo(addr, flags, cb)
 
 
+class DnsCache(object):
+    """
+    A cache for DNS answers.
+
+    Answers are kept for their TTL (or a default TTL when it is not known) and the least
+    recently used entries are evicted when the cache is full. Negative answers (names with no
+    records) are also cached, for a shorter time. Concurrent lookups for the same key wait for
+    the same query.
+    """
+
+    def __init__ (self, max_entries = DNS_CACHE_MAX_ENTRIES, ttl = DNS_CACHE_TTL,
+                  negative_ttl = DNS_CACHE_NEGATIVE_TTL):
+        """
+        :param max_entries: the maximum number of entries in the cache
+        :param ttl: the time (in seconds) positive answers are kept when the TTL is unknown
+        :param negative_ttl: the time (in seconds) negative answers are kept
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self.entries = collections.OrderedDict()    # key -> (expiration, value, exception)
+        self.pending = {}                           # key -> Event, for the queries in flight
+
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+
+    def __len__ (self):
+        return len(self.entries)
+
+    def __contains__ (self, key):
+        entry = self.entries.get(key)
+        return entry is not None and entry[0] > time.time()
+
+    def __repr__ (self):
+        return '<DnsCache at %s entries=%d/%d hits=%d misses=%d collapsed=%d>' % (
+            hex(id(self)), len(self.entries), self.max_entries, self.hits, self.misses,
+            self.collapsed)
+
+    def flush (self, key = None):
+        """
+        Remove all the entries (or just the one for *key*) from the cache
+        """
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+
+    def _store (self, key, value, exception, ttl):
+        if self.max_entries <= 0 or ttl <= 0:
+            return
+
+        entries = self.entries
+        entries.pop(key, None)
+        while len(entries) >= self.max_entries:
+            entries.popitem(last = False)
+        entries[key] = (time.time() + ttl, value, exception)
+
+    def lookup (self, key, query):
+        """
+        Get the answer for *key* from the cache or, if it is not there, from *query*
+
+        :param key: the key for the answer (eg, the name and the query type)
+        :param query: a function that returns a tuple with the answer and its TTL (or None
+                      if it is unknown). It can raise a :class:`socket.gaierror` with
+                      `EAI_NONAME` or `EAI_NODATA` for negative answers.
+        :return: the answer
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            expiration, value, exception = entry
+            if expiration > time.time():
+                self.hits += 1
+                del self.entries[key]
+                self.entries[key] = entry
+                if exception is not None:
+                    raise exception
+                return value
+            else:
+                del self.entries[key]
+
+        waiting = self.pending.get(key)
+        if waiting is not None:
+            self.collapsed += 1
+            return waiting.wait()
+
+        self.misses += 1
+        waiting = self.pending[key] = Event()
+        try:
+            try:
+                value, ttl = query()
+            except socket.gaierror, e:
+                if e.args[0] in (socket.EAI_NONAME, socket.EAI_NODATA):
+                    self._store(key, None, e, self.negative_ttl)
+                waiting.send_exception(e)
+                raise
+            except:
+                ## even a Timeout or a GreenletExit: the others would wait forever
+                waiting.send_exception(*sys.exc_info())
+                raise
+            else:
+                self._store(key, value, None, self.ttl if ttl is None else ttl)
+                waiting.send(value)
+                return value
+        finally:
+            del self.pending[key]
+
+
 #
 # cache
 #
 _resolver_hub = get_hub()
 resolver = CaresResolver(_resolver_hub.uv_loop)
 
+cache = DnsCache()
+hosts = HostsFile()
 
 
-def resolve (name):
+def reinit_resolver ():
     """
-    Resolve the *name*, returning a list of IP addresses
+    Replace the resolver by a new one, running in the current hub. This is done by
+    :func:`evy.hubs.reinit_hub` (ie, in a child process after a fork()), as the resolver
+    is bound to the libuv loop of the hub where it was created.
+    """
+    global _resolver_hub, resolver
+    _resolver_hub = get_hub()
+    resolver = CaresResolver(_resolver_hub.uv_loop)
 
-    :param name: the name we want to resolve
-    :return: a list of IP addresses
+    ## nobody will answer the queries in flight in the old hub
+    cache.pending.clear()
+
+
+
+def _query (name, query_type):
     """
-    if is_ipv4_addr(name):
-        return [name]
+    Run a query for *name*
 
+    :param name: the name we want to resolve
+    :param query_type: the query type (ie, `pycares.QUERY_TYPE_A`)
+    :return: a tuple with the list of records and their TTL (or None, if it is unknown)
+    :raise socket.gaierror: with `EAI_NODATA` only for NXDOMAIN or empty answers, as these
+                            are cached. Other errors are not mapped to a negative answer.
+    """
     rrset = []
     resolved = Event()
 
@@ -225,18 +447,98 @@ def resolve (name):
 
     try:
         with Timeout(DNS_QUERY_TIMEOUT):
-            resolver.query(name, pycares.QUERY_TYPE_A, _resolv_callback)
+            resolver.query(name, query_type, _resolv_callback)
             rrset = resolved.wait()
 
     except Timeout, e:
         raise socket.gaierror(socket.EAI_AGAIN, 'Lookup timed out')
-    except Exception, e:
+    except socket.gaierror, e:
+        if e.args[0] not in ARES_NEGATIVE_ERRORS:
+            raise socket.gaierror(socket.EAI_AGAIN, 'Temporary failure resolving "%s" (%s)' % (
+                name, e.args[1]))
         raise socket.gaierror(socket.EAI_NODATA, 'No address associated with hostname "%s"' % name)
 
     if len(rrset) == 0:
         raise socket.gaierror(socket.EAI_NODATA, 'No address associated with hostname "%s"' % name)
 
-    return rrset
+    ## newer versions of pycares return records with a TTL
+    ttls = [rr.ttl for rr in rrset if hasattr(rr, 'ttl')]
+    if ttls:
+        return [rr.host for rr in rrset], min(ttls)
+    return rrset, None
+
+
+def resolve (name, family = socket.AF_INET):
+    """
+    Resolve the *name*, returning a list of IP addresses
+
+    Literal addresses and names in the hosts file are resolved without any query, unless
+    the hosts file has no address of this family for the name.
+
+    :param name: the name we want to resolve
+    :param family: the address family (`AF_INET` or `AF_INET6`)
+    :return: a list of IP addresses
+    """
+    if family == socket.AF_INET:
+        if is_ipv4_addr(name):
+            return [name]
+    elif family == socket.AF_INET6:
+        if is_ipv6_addr(name):
+            return [name]
+    else:
+        raise socket.gaierror(socket.EAI_FAMILY, 'Address family for hostname not supported')
+
+    ## names in the hosts file are only looked up in the DNS for the families they have no
+    ## addresses for
+    addresses = hosts.lookup(name, family)
+    if addresses:
+        return addresses
+
+    query_type = QUERY_TYPES[family]
+    return list(cache.lookup((name, query_type), lambda: _query(name, query_type)))
+
+
+def resolve_all (name, families = (socket.AF_INET, socket.AF_INET6)):
+    """
+    Resolve the *name* for several address families, running all the queries in parallel
+
+    :param name: the name we want to resolve
+    :param families: the address families
+    :return: a list of (family, address) tuples, in the order of *families*
+    """
+    from evy.green.threads import spawn, kill
+
+    ## no queries are needed when the hosts file has addresses for all the families
+    if name in hosts:
+        answers = [(family, hosts.lookup(name, family)) for family in families]
+        if all(addresses for family, addresses in answers):
+            return [(family, addr) for family, addresses in answers for addr in addresses]
+
+    def _resolve (family):
+        try:
+            return resolve(name, family), None
+        except socket.gaierror, e:
+            return [], e
+
+    ## start all the queries but the first one in other greenthreads
+    others = [(family, spawn(_resolve, family)) for family in families[1:]]
+
+    results = []
+    errors = []
+    try:
+        for family, answer in [(families[0], _resolve(families[0]))] + others:
+            addresses, e = answer if isinstance(answer, tuple) else answer.wait()
+            results.extend((family, addr) for addr in addresses)
+            if e is not None:
+                errors.append(e)
+    finally:
+        ## we could be killed (or timed out) while waiting for the other queries
+        for family, gt in others:
+            kill(gt)
+
+    if not results:
+        raise errors[0]
+    return results
 
 #
 # methods
@@ -276,20 +578,61 @@ def getaliases (host):
 def getaddrinfo (host, port, family = 0, socktype = 0, proto = 0, flags = 0):
     """
     Replacement for Python's socket.getaddrinfo.
+
+    IPv4 and IPv6 addresses are resolved in parallel when *family* is `AF_UNSPEC`, and IPv4
+    addresses are returned first.
     """
-    if not host:
-        host = 'localhost'
+    if family == socket.AF_UNSPEC:
+        families = (socket.AF_INET, socket.AF_INET6)
+    elif family in (socket.AF_INET, socket.AF_INET6):
+        families = (family,)
+    else:
+        raise socket.gaierror(socket.EAI_FAMILY, 'ai_family not supported')
 
-    socktype = socktype or socket.SOCK_STREAM
+    port, socktypes = resolver._lookup_port(port, socktype)
+    if socktypes:
+        protos = dict(DEFAULT_SOCKTYPES)
+        socktypes = [(st, proto or protos.get(st, 0)) for st in socktypes]
+    else:
+        socktypes = [(st, proto or p) for st, p in DEFAULT_SOCKTYPES]
 
-    if is_ipv4_addr(host):
-        return [(socket.AF_INET, socktype, proto, '', (host, port))]
+    if not host:
+        if flags & socket.AI_PASSIVE:
+            addresses = [(f, '0.0.0.0' if f == socket.AF_INET else '::') for f in families]
+        else:
+            addresses = [(f, '127.0.0.1' if f == socket.AF_INET else '::1') for f in families]
+    elif is_ipv4_addr(host):
+        if socket.AF_INET in families:
+            addresses = [(socket.AF_INET, host)]
+        elif flags & socket.AI_V4MAPPED:
+            addresses = [(socket.AF_INET6, '::ffff:' + host)]
+        else:
+            raise socket.gaierror(socket.EAI_ADDRFAMILY, 'Address family for hostname not supported')
+    elif is_ipv6_addr(host):
+        if socket.AF_INET6 not in families:
+            raise socket.gaierror(socket.EAI_ADDRFAMILY, 'Address family for hostname not supported')
+        addresses = [(socket.AF_INET6, host)]
+    elif flags & socket.AI_NUMERICHOST:
+        raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+    else:
+        try:
+            addresses = resolve_all(host, families)
+        except socket.gaierror:
+            if family == socket.AF_INET6 and flags & socket.AI_V4MAPPED:
+                addresses = [(socket.AF_INET6, '::ffff:' + addr) for addr in resolve(host)]
+            else:
+                raise
 
-    rrset = resolve(host)
+    canonname = host if flags & socket.AI_CANONNAME else ''
     value = []
-
-    for rr in rrset:
-        value.append((socket.AF_INET, socktype, proto, '', (rr, port)))
+    for af, addr in addresses:
+        if af == socket.AF_INET6:
+            sockaddr = (addr, port, 0, 0)
+        else:
+            sockaddr = (addr, port)
+        for st, p in socktypes:
+            value.append((af, st, p, canonname, sockaddr))
+            canonname = ''
     return value
 
 
@@ -299,38 +642,7 @@ def gethostbyname (hostname):
 
     Currently only supports IPv4.
     """
-    if is_ipv4_addr(hostname):
-        return hostname
-
-    ips = []
-    resolved = Event()
-
-    def _resolv_callback(result, errorno):
-        try:
-            if errorno:
-                e = pycares.errno.errorcode[errorno]
-                msg = pycares.errno.strerror(errorno)
-                ee = ARES_ERR_MAP[e]
-                resolved.send_exception(socket.gaierror(ee, msg))
-            else:
-                resolved.send(result)
-        except Exception, e:
-            resolved.send_exception(e)
-
-    try:
-        with Timeout(DNS_QUERY_TIMEOUT):
-            resolver.query(hostname, pycares.QUERY_TYPE_CNAME, _resolv_callback)
-            ips = resolved.wait()
-
-    except Timeout, e:
-        raise socket.gaierror(socket.EAI_AGAIN, 'Lookup timed out')
-    except Exception, e:
-        raise socket.gaierror(socket.EAI_NODATA, 'No address associated with hostname')
-
-    if len(ips) == 0:
-        raise socket.gaierror(socket.EAI_NODATA, 'No address associated with hostname')
-
-    return ips[0]
+    return resolve(hostname)[0]
 
 
 def gethostbyname_ex (hostname):
@@ -389,19 +701,23 @@ def getnameinfo (addr, flags):
 
 
 
-def resolve_address(address):
+def resolve_address(address, family = socket.AF_INET):
     """
     Resolve an address (as a tuple) to a valid IP and port
-    :param address: a tuple with a hostname or IP and port
+    :param address: a tuple with a hostname or IP and port (plus the flow info and scope id,
+                    for IPv6)
+    :param family: the address family
     :return: a valid IP and port tuple
     """
-    hostname, port = address
+    hostname, port = address[:2]
     if len(hostname) == 0:
-        ip = '0.0.0.0'
+        ip = '::' if family == socket.AF_INET6 else '0.0.0.0'
     else:
-        ip = resolve(hostname)[0]
+        ip = resolve(hostname, family)[0]
 
     assert isinstance(ip, str)
     assert isinstance(port, int)
 
+    if family == socket.AF_INET6:
+        return (ip, port) + tuple(address[2:])
     return ip, port
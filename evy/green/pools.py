@@ -27,13 +27,15 @@
 # THE SOFTWARE.
 #
 
+import collections
 import itertools
 import traceback
 
 from evy import event
+from evy import hubs
 from evy.green import threads as greenthread
+from evy.green.threads import GreenTask, Workers
 from evy import queue
-from evy import semaphore
 from evy.support import greenlets as greenlet
 
 __all__ = ['GreenPool', 'GreenPile']
@@ -41,18 +43,40 @@ __all__ = ['GreenPool', 'GreenPile']
 DEBUG = True
 
 
+def _wake_spawner (entry):
+    spawner = entry[1]
+    if spawner is not None:
+        entry[1] = None
+        spawner.switch()
 
 
-class GreenPool(object):
+class GreenPool(Workers):
     """
     The GreenPool class is a pool of green threads.
+
+    The slots of the pool are just counted, and the slot of a function that finishes is given to
+    the next spawn waiting. Every function runs in its own greenthread, unless the pool is
+    created with *recycle*: the functions are run then by a set of
+    :class:`~evy.green.threads.Workers` (greenlets that are recycled for running another function
+    when they are done), which is much faster for short functions, and :meth:`spawn` returns a
+    :class:`~evy.green.threads.GreenTask` (with the same interface as a
+    :class:`~evy.green.threads.GreenThread`, but it is not a greenlet).
     """
 
-    def __init__ (self, size = 1000):
+    def __init__ (self, size = 1000, recycle = False):
+        """
+        :param size: the maximum number of functions running at the same time
+        :param recycle: if True, run the functions in recycled workers
+        """
+        Workers.__init__(self)
         self.size = size
-        self.coroutines_running = set()
-        self.sem = semaphore.Semaphore(size)
-        self.no_coros_running = event.Event()
+        self.recycle = recycle
+        self.busy = 0                           # slots in use
+        self.pending = collections.deque()      # [task, spawner] waiting for a slot
+        self.no_coros_running = None
+
+        ## the greenlets running functions (greenthreads, or workers when recycling them)
+        self.coroutines_running = self.workers
 
     def resize (self, new_size):
         """ Change the max number of greenthreads doing work at any given time.
@@ -63,14 +87,17 @@ class GreenPool(object):
         their tasks to drop the overall quantity below *new_size*.  Until
         then, the return value of free() will be negative.
         """
-        size_delta = new_size - self.size
-        self.sem.counter += size_delta
         self.size = new_size
+        while self.pending and self.busy < self.size:
+            self.busy += 1
+            entry = self.pending.popleft()
+            hubs.get_hub().run_callback(_wake_spawner, entry)
+            self._start(entry[0])
 
     def running (self):
         """ Returns the number of greenthreads that are currently executing
         functions in the GreenPool."""
-        return len(self.coroutines_running)
+        return self.busy
 
     def free (self):
         """
@@ -78,14 +105,14 @@ class GreenPool(object):
 
         If zero or less, the next call to :meth:`spawn` or :meth:`spawn_n` will
         block the calling greenthread until a slot becomes available."""
-        return self.sem.counter
+        return self.size - self.busy
 
     def spawn (self, function, *args, **kwargs):
         """
         Run the *function* with its arguments in its own green thread.
-        Returns the :class:`GreenThread <evy.greenthread.GreenThread>`
-        object that is running the function, which can be used to retrieve the
-        results.
+        Returns the :class:`GreenThread <evy.green.threads.GreenThread>` (or the
+        :class:`GreenTask <evy.green.threads.GreenTask>`, when recycling workers) that is
+        running the function, which can be used to retrieve the results.
 
         If the pool is currently at capacity, ``spawn`` will block until one of
         the running greenthreads completes its task and frees up a slot.
@@ -93,82 +120,138 @@ class GreenPool(object):
         This function is reentrant; *function* can call ``spawn`` on the same
         pool without risk of deadlocking the whole thing.
         """
-        # if reentering an empty pool, don't try to wait on a coroutine freeing
-        # itself -- instead, just execute in the current coroutine
-        current = greenthread.getcurrent()
-        if self.sem.locked() and current in self.coroutines_running:
-            # a bit hacky to use the GT without switching to it
-            gt = greenthread.GreenThread(current)
-            gt.main(function, args, kwargs)
-            return gt
+        if self.recycle:
+            gt = task = GreenTask(function, args, kwargs)
         else:
-            self.sem.acquire()
-            gt = greenthread.spawn(function, *args, **kwargs)
-            if not self.coroutines_running:
-                self.no_coros_running = event.Event()
-            self.coroutines_running.add(gt)
-            gt.link(self._spawn_done)
+            gt = greenthread.GreenThread(hubs.get_hub().greenlet)
+            task = (gt, function, args, kwargs)
+
+        if self.busy < self.size:
+            self.busy += 1
+            self._start(task)
+        elif not self._wait_slot(task):
+            # if reentering an empty pool, don't try to wait on a coroutine freeing
+            # itself -- instead, just execute in the current coroutine
+            if self.recycle:
+                self._run(task)
+            else:
+                # a bit hacky to use the GT without switching to it
+                gt = greenthread.GreenThread(greenthread.getcurrent())
+                gt.main(function, args, kwargs)
         return gt
 
-    def _spawn_n_impl (self, func, args, kwargs, coro):
+    def spawn_n (self, function, *args, **kwargs):
+        """Create a greenthread to run the *function*, the same as
+        :meth:`spawn`.  The difference is that :meth:`spawn_n` returns
+        None; the results of *function* are not retrievable.
+        """
+        if self.recycle:
+            task = GreenTask(function, args, kwargs)
+        else:
+            task = (None, function, args, kwargs)
+
+        if self.busy < self.size:
+            self.busy += 1
+            self._start(task)
+        elif not self._wait_slot(task):
+            if self.recycle:
+                self._run(task)
+            else:
+                self._spawn_n_impl(function, args, kwargs, False)
+
+    def _start (self, task):
+        ## start a task that has a slot
+        if self.recycle:
+            self._queue(task)
+            return
+
+        gt, function, args, kwargs = task
+        hub = hubs.get_hub()
+        if gt is None:
+            gt = greenlet.greenlet(self._spawn_n_impl, parent = hub.greenlet)
+            args = (function, args, kwargs, True)
+            kwargs = {}
+        else:
+            gt.link(self._spawn_done)
+            args = (function, args, kwargs)
+            kwargs = {}
+        self.workers.add(gt)
+        hub.run_callback(gt.switch, *args)
+
+    def _spawn_n_impl (self, function, args, kwargs, pooled):
         try:
             try:
-                func(*args, **kwargs)
+                function(*args, **kwargs)
             except (KeyboardInterrupt, SystemExit, greenlet.GreenletExit):
                 raise
             except:
                 if DEBUG:
                     traceback.print_exc()
         finally:
-            if coro is None:
-                return
-            else:
-                coro = greenthread.getcurrent()
-                self._spawn_done(coro)
+            if pooled:
+                self._spawn_done(greenthread.getcurrent())
 
-    def spawn_n (self, function, *args, **kwargs):
-        """Create a greenthread to run the *function*, the same as
-        :meth:`spawn`.  The difference is that :meth:`spawn_n` returns
-        None; the results of *function* are not retrievable.
-        """
-        # if reentering an empty pool, don't try to wait on a coroutine freeing
-        # itself -- instead, just execute in the current coroutine
+    def _spawn_done (self, coro):
+        self.workers.discard(coro)
+        self._done()
+
+    def _wait_slot (self, task):
+        ## wait for a slot for the task, or return False if we are reentering a full pool
         current = greenthread.getcurrent()
-        if self.sem.locked() and current in self.coroutines_running:
-            self._spawn_n_impl(function, args, kwargs, None)
-        else:
-            self.sem.acquire()
-            g = greenthread.spawn_n(self._spawn_n_impl,
-                                    function, args, kwargs, True)
-            if not self.coroutines_running:
-                self.no_coros_running = event.Event()
-            self.coroutines_running.add(g)
+        if current in self.workers:
+            return False
+
+        ## the greenlet that frees a slot starts the task, and wakes us up
+        entry = [task, current]
+        self.pending.append(entry)
+        try:
+            hubs.get_hub().switch()
+        except:
+            if entry[1] is not None:
+                entry[1] = None
+                try:
+                    self.pending.remove(entry)
+                except ValueError:
+                    pass
+            raise
+        return True
+
+    def _done (self):
+        pending = self.pending
+        if pending and self.busy <= self.size:
+            ## the slot goes to the next spawn waiting
+            entry = pending.popleft()
+            hubs.get_hub().run_callback(_wake_spawner, entry)
+            self._start(entry[0])
+            return
+
+        self.busy -= 1
+        # if done processing (no more work is waiting for processing),
+        # we can finish off any waitall() calls that might be pending
+        if self.busy <= 0 and self.no_coros_running is not None:
+            no_coros_running = self.no_coros_running
+            self.no_coros_running = None
+            no_coros_running.send(None)
+
+    def _print_exc (self, exc_info):
+        if DEBUG:
+            Workers._print_exc(self, exc_info)
 
     def waitall (self):
         """
         Waits until all greenthreads in the pool are finished working.
         """
-        assert greenthread.getcurrent() not in self.coroutines_running,\
+        assert greenthread.getcurrent() not in self.workers,\
         "Calling waitall() from within one of the GreenPool's greenthreads will never terminate."
-        if self.running():
+        if self.busy > 0:
+            if self.no_coros_running is None:
+                self.no_coros_running = event.Event()
             self.no_coros_running.wait()
 
-    def _spawn_done (self, coro):
-        self.sem.release()
-        if coro is not None:
-            self.coroutines_running.remove(coro)
-            # if done processing (no more work is waiting for processing),
-        # we can finish off any waitall() calls that might be pending
-        if self.sem.balance == self.size:
-            self.no_coros_running.send(None)
-
     def waiting (self):
         """Return the number of greenthreads waiting to spawn.
         """
-        if self.sem.balance < 0:
-            return -self.sem.balance
-        else:
-            return 0
+        return len(self.pending)
 
     def _do_map (self, func, it, gi):
         for args in it:
@@ -27,8 +27,11 @@
 # THE SOFTWARE.
 #
 
+import collections
 import sys
+import traceback
 
+from evy import corolocal
 from evy import event
 from evy import hubs
 from evy import timeout
@@ -39,7 +42,9 @@ from evy.support import greenlets as greenlet
 
 
 __all__ = ['getcurrent', 'sleep', 'spawn', 'spawn_n', 'spawn_after', 'spawn_after_local',
-           'GreenThread']
+           'recycle_workers', 'GreenThread', 'GreenTask', 'Workers']
+
+DEBUG = True
 
 
 getcurrent = greenlet.getcurrent
@@ -92,7 +97,11 @@ def spawn (func, *args, **kwargs):
     Execution control returns immediately to the caller; the created greenthread is merely scheduled
     to be run at the next available opportunity. Use :func:`spawn_after` to  arrange for greenthreads
     to be spawned after a finite delay.
+
+    When workers are recycled (see :func:`recycle_workers`), it returns a :class:`GreenTask`.
     """
+    if _recycled_workers:
+        return _get_workers().spawn(func, *args, **kwargs)
     hub = hubs.get_hub()
     g = GreenThread(hub.greenlet)
     hub.run_callback(g.switch, func, args, kwargs)
@@ -107,7 +116,11 @@ def spawn_n (func, *args, **kwargs):
     
     If an exception is raised in the function, spawn_n prints a stack trace; the print can be
     disabled by calling :func:`evy.debug.hub_exceptions` with False.
+
+    When workers are recycled (see :func:`recycle_workers`), it returns a :class:`GreenTask`.
     """
+    if _recycled_workers:
+        return _get_workers().spawn(func, *args, **kwargs)
 
     def _run_callback (func, args, kwargs):
         hub = hubs.get_hub()
@@ -258,6 +271,8 @@ def cancel (g, *throw_args):
     already started execution.  If the grenthread has already started 
     execution, :func:`cancel` has no effect.
     """
+    if isinstance(g, GreenTask):
+        return g.cancel(*throw_args)
     if not g:
         kill(g, *throw_args)
 
@@ -274,6 +289,8 @@ def kill (g, *throw_args):
     
     Calling :func:`kill` causes the calling greenthread to cooperatively yield.
     """
+    if isinstance(g, GreenTask):
+        return g.kill(*throw_args)
     if g.dead:
         return
     hub = hubs.get_hub()
@@ -312,3 +329,274 @@ def waitall (*args):
         res.append(t.wait())
     return res
 
+
+## maximum number of idle workers kept by a set of workers
+MAX_IDLE_WORKERS = 100
+
+## the number of idle workers kept for spawn() and spawn_n(), or 0 when they are not recycled
+_recycled_workers = 0
+
+
+def recycle_workers (max_idle = MAX_IDLE_WORKERS):
+    """
+    Run the functions started with :func:`spawn` and :func:`spawn_n` in recycled workers:
+    a set of long-lived greenlets that take the functions from a run queue, one after another,
+    instead of creating a new greenlet for each function. Both functions return then a
+    :class:`GreenTask`, with the same interface as a :class:`GreenThread`.
+
+    This makes short functions much cheaper, but the handles returned are not greenlets anymore,
+    and anything that is left in the greenlet (like some local timers) does not outlive
+    the function.
+
+    :param max_idle: the maximum number of idle workers kept in each hub, or 0 for disabling the
+    recycling of workers
+    """
+    global _recycled_workers
+    _recycled_workers = max_idle
+    hub = hubs.get_hub()
+    if getattr(hub, 'workers', None) is not None:
+        hub.workers.max_idle = max_idle
+
+
+def _get_workers ():
+    hub = hubs.get_hub()
+    workers = getattr(hub, 'workers', None)
+    if workers is None:
+        workers = hub.workers = Workers(_recycled_workers)
+    return workers
+
+
+class GreenTask(object):
+    """
+    A function run by some :class:`Workers`, with the interface of a :class:`GreenThread`: its
+    result can be retrieved with :meth:`wait`, functions can be :meth:`link`-ed to it, and it
+    can be killed.
+
+    Tasks are much cheaper than greenthreads: they are run by recycled workers, and
+    they only allocate something else when they are waited for or linked.
+    """
+
+    __slots__ = ['function', 'args', 'kwargs', 'worker', 'dead', 'value', 'exc_info',
+                 'waiters', 'links']
+
+    def __init__ (self, function, args, kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.worker = None          # the greenlet running the task, once started
+        self.dead = False
+        self.value = None
+        self.exc_info = None
+        self.waiters = None
+        self.links = None
+
+    def __nonzero__ (self):
+        ## like a greenlet: true while running
+        return self.worker is not None and not self.dead
+
+    def wait (self):
+        """
+        Returns the result of the function, or raises the exception it raised
+        """
+        if not self.dead:
+            current = getcurrent()
+            if self.waiters is None:
+                self.waiters = [current]
+            else:
+                self.waiters.append(current)
+            try:
+                hubs.get_hub().switch()
+            finally:
+                if self.waiters is not None and current in self.waiters:
+                    self.waiters.remove(current)
+
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    def link (self, func, *curried_args, **curried_kwargs):
+        """
+        Set up a function to be called with the task and the *curried* arguments when the
+        task finishes (see :meth:`GreenThread.link`)
+        """
+        if self.dead:
+            func(self, *curried_args, **curried_kwargs)
+        elif self.links is None:
+            self.links = [(func, curried_args, curried_kwargs)]
+        else:
+            self.links.append((func, curried_args, curried_kwargs))
+
+    def kill (self, *throw_args):
+        """
+        Kills the task. If it is running, the exception *throw_args* (:class:`GreenletExit`
+        by default) is raised in it; if it has not started yet, it will not be run, and
+        :meth:`wait` will raise *throw_args*.
+        """
+        if self.dead:
+            return
+        if self.worker is None:
+            if not throw_args:
+                throw_args = (greenlet.GreenletExit, greenlet.GreenletExit(), None)
+            elif len(throw_args) == 1:
+                throw_args = (type(throw_args[0]), throw_args[0], None)
+            self._finish(None, throw_args)
+        else:
+            kill(self.worker, *throw_args)
+
+    def cancel (self, *throw_args):
+        """
+        Kills the task, but only if it has not started yet
+        """
+        if self.worker is None:
+            self.kill(*throw_args)
+
+    def _finish (self, value, exc_info):
+        self.dead = True
+        self.value = value
+        self.exc_info = exc_info
+        self.function = self.args = self.kwargs = None
+
+        if self.waiters:
+            hubs.get_hub().run_callback(self._wake_waiters)
+
+        links = self.links
+        if links is not None:
+            self.links = None
+            for func, curried_args, curried_kwargs in links:
+                try:
+                    func(self, *curried_args, **curried_kwargs)
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    _print_exc()
+
+    def _wake_waiters (self):
+        waiters = self.waiters
+        self.waiters = None
+        for waiter in waiters or ():
+            waiter.switch()
+
+
+def _print_exc (exc_info = None):
+    ## errors printing the traceback cannot stop a worker
+    if DEBUG:
+        try:
+            traceback.print_exception(*(exc_info or sys.exc_info()))
+        except:
+            pass
+
+
+class _Worker(greenlet.greenlet):
+    """
+    A greenlet that runs tasks, one after another. Its *generation* is incremented for every
+    task, so the local timers of a task are not fired for the next one, and its locals are
+    released when the task is done.
+    """
+    generation = 0
+
+
+class Workers(object):
+    """
+    A set of recycled greenlets (the workers) that run :class:`GreenTask`\ s.
+
+    The tasks are queued, and they are started together from a single hub callback: a task
+    that does not block returns its worker before the next task is started, so the same worker
+    can run all of them. Up to *max_idle* workers are kept when there is nothing to do.
+    """
+
+    def __init__ (self, max_idle = MAX_IDLE_WORKERS):
+        self.max_idle = max_idle
+        self.workers = set()
+        self.idle = []                          # workers waiting for a task
+        self.queued = collections.deque()       # tasks waiting for a worker
+        self.dispatching = False
+
+    def spawn (self, function, *args, **kwargs):
+        """
+        Run ``function(*args, **kwargs)`` in a worker, and return its :class:`GreenTask`
+        """
+        task = GreenTask(function, args, kwargs)
+        self._queue(task)
+        return task
+
+    def _queue (self, task):
+        ## queue a task, to be started by the next dispatch
+        self.queued.append(task)
+        if not self.dispatching:
+            self.dispatching = True
+            hubs.get_hub().run_callback(self._dispatch)
+
+    def _dispatch (self):
+        ## start the tasks queued (from the hub), in idle workers or in new ones. The tasks
+        ## queued meanwhile are left for the next dispatch
+        self.dispatching = False
+        queued = self.queued
+        idle = self.idle
+        hub = hubs.get_hub()
+        try:
+            for _ in xrange(len(queued)):
+                task = queued.popleft()
+                if idle:
+                    worker = idle.pop()
+                else:
+                    worker = _Worker(self._work, parent = hub.greenlet)
+                    self.workers.add(worker)
+                worker.switch(task)
+        finally:
+            if queued and not self.dispatching:
+                self.dispatching = True
+                hub.run_callback(self._dispatch)
+
+    def _run (self, task):
+        if task.dead:
+            return
+        task.worker = getcurrent()
+        try:
+            result = task.function(*task.args, **task.kwargs)
+        except greenlet.GreenletExit:
+            task._finish(None, sys.exc_info())
+        except (KeyboardInterrupt, SystemExit):
+            task._finish(None, sys.exc_info())
+            raise
+        except:
+            exc_info = sys.exc_info()
+            task._finish(None, exc_info)
+            self._print_exc(exc_info)
+        else:
+            task._finish(result, None)
+
+    def _print_exc (self, exc_info):
+        _print_exc(exc_info)
+
+    def _done (self):
+        ## called when a task is done (successfully or not)
+        pass
+
+    def _work (self, task):
+        ## the main loop of the workers
+        current = getcurrent()
+        hub = hubs.get_hub()
+        try:
+            while True:
+                try:
+                    self._run(task)
+                except:
+                    ## KeyboardInterrupt or SystemExit: the worker dies with them
+                    self._done()
+                    raise
+                finally:
+                    current.generation += 1
+                    corolocal.release(current)
+
+                self._done()
+                if len(self.idle) >= self.max_idle:
+                    return
+                self.idle.append(current)
+                try:
+                    task = hub.switch()
+                except:
+                    if current in self.idle:
+                        self.idle.remove(current)
+                    raise
+        finally:
+            self.workers.discard(current)
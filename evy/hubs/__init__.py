@@ -32,12 +32,15 @@ __import__('pkg_resources').declare_namespace(__name__)
 
 
 
+import sys
+
 from evy.support import greenlets as greenlet
 from evy import patcher
 
 __all__ = ["use_hub",
            "get_hub",
            "get_default_hub",
+           "reinit_hub",
            "trampoline"]
 
 threading = patcher.original('threading')
@@ -89,6 +92,33 @@ def get_hub ():
     return hub
 
 
+def reinit_hub ():
+    """
+    Replace the hub of the current thread by a new hub, with its own libuv loop.
+
+    This must be called in a child process after a fork(), before using any green function: the
+    libuv loop inherited from the parent (and its epoll descriptor) cannot be shared by both
+    processes. Anything created with the old hub (sockets, timers...) must not be used anymore,
+    and the DNS resolver is replaced by a new one.
+
+    :return: the new hub
+    """
+    import pyuv
+
+    try:
+        _threadlocal.Hub
+    except AttributeError:
+        use_hub()
+
+    hub = _threadlocal.hub = _threadlocal.Hub(ptr = pyuv.Loop())
+
+    ## the resolver (if it has been imported) runs in the loop of the old hub
+    dns = sys.modules.get('evy.green.dns')
+    if dns is not None:
+        dns.reinit_resolver()
+    return hub
+
+
 
 from evy.timeout import Timeout
 
@@ -120,14 +150,15 @@ def trampoline (fd, read = None, write = None, timeout = None, timeout_exc = Tim
     if timeout is not None:
         t = hub.schedule_call_global(timeout, current.throw, timeout_exc)
 
-    try:
-        if read:        listener = hub.add(hub.READ,  fileno, current.switch)
-        elif write:     listener = hub.add(hub.WRITE, fileno, current.switch)
+    if read:        evtype = hub.READ
+    elif write:     evtype = hub.WRITE
 
+    try:
+        listener = hub.add(evtype, fileno, current.switch)
         try:
             return hub.switch()
         finally:
-            hub.remove(listener)
+            hub.remove(listener, evtype)
     finally:
         if t is not None:
             t.cancel()
@@ -39,7 +39,6 @@ class Callback(object):
     __slots__ = [
         'callback',
         'called',
-        'implcallback',
     ]
 
     def __init__(self, cb, *args, **kw):
@@ -81,16 +80,13 @@ class Callback(object):
 
     def destroy(self):
         """
-        Stop and destroy the callback
+        Destroy the callback
         """
-        if hasattr(self, 'implcallback'):
-            self.implcallback.stop()
-
-            def _dummy(*args): pass
-            self.implcallback.close(_dummy)
-
-            del self.implcallback
+        self.called = True
+        try:
             del self.callback
+        except AttributeError:
+            pass
 
     def __call__(self, *args):
         if not self.called:
@@ -107,10 +103,11 @@ class Callback(object):
         """
         Prevent this idle from being called. If the callback has already
         been called or canceled, has no effect.
+
+        The callback is not removed from the hub: it will be discarded when its turn comes.
         """
         if not self.called:
             self.called = True
-            get_hub()._callback_canceled(self)
             try:
                 del self.callback
             except AttributeError:
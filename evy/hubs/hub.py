@@ -28,6 +28,8 @@
 #
 
 import math
+import heapq
+import collections
 import traceback
 import signal
 import sys
@@ -75,6 +77,12 @@ time = patcher.original('time')
 READ = pyuv.UV_READABLE
 WRITE = pyuv.UV_WRITABLE
 
+## maximum number of callbacks run in one loop iteration, so we do not starve the I/O
+MAX_CALLBACKS_PER_ITERATION = 1000
+
+## the minimum number of timers in the heap before we consider removing the canceled ones
+MIN_TIMERS_COMPACTION = 1000
+
 
 
 def alarm_handler (signum, frame):
@@ -121,9 +129,16 @@ class Hub(object):
         self.stopping = False
         self.running = False
 
-        self.timers = set()
+        self.timers = []                    # heap of (deadline, sequence, timer)
+        self.timers_seq = 0
+        self.timers_canceled = 0
+        self.timers_referenced = 0
+        self.timers_deadline = None         # the deadline the uv timer is armed for
         self.pollers = {}
-        self.callbacks = set()
+        self.callbacks = collections.deque()
+        self.callbacks_per_iteration = MAX_CALLBACKS_PER_ITERATION
+
+        self.poller_reuses = 0              # number of pollers reused instead of allocated
 
         self.debug_exceptions = True
         self.debug_blocking = False
@@ -153,6 +168,13 @@ class Hub(object):
         if not self.uv_loop:
             raise SystemError("default_loop() failed")
 
+        ## the idle handle that runs all the callbacks
+        self.uv_idle = pyuv.Idle(self.uv_loop)
+
+        ## the timer that fires all our timers
+        self.uv_timer = pyuv.Timer(self.uv_loop)
+        self.uv_timer.unref()
+
     def block_detect_pre (self):
         # shortest alarm we can possibly raise is one second
         self.block_detect_handle = pyuv.Signal(self.uv_loop)
@@ -167,39 +189,49 @@ class Hub(object):
         """
         Signals an intent to or write a particular file descriptor.
 
+        Pollers are cached by file descriptor: if we have already waited on this *fileno*, the
+        same underlying watcher is restarted with the new events mask instead of allocating a
+        new one.
+
         :param evtype: either the constant READ or WRITE.
         :param fileno: the file number of the file of interest.
         :param cb: callback which will be called when the file is ready for reading/writing.
         """
-        if fileno in self.pollers:
+        try:
             p = self.pollers[fileno]
+        except KeyError:
+            p = poller.Poller(fileno, persistent = persistent, _hub = self)
 
-            current_events = 0
-
+            ## register the poller
+            self.pollers[fileno] = p
+        else:
             ## check we do not have another callback on the same descriptor and event
-            if p.notify_readable and evtype is READ:
+            if p.notify_readable and evtype & READ:
                 raise RuntimeError('there is already %s reading from descriptor %d' % (str(p), fileno))
 
-            if p.notify_writable and evtype is WRITE:
+            if p.notify_writable and evtype & WRITE:
                 raise RuntimeError('there is already %s writing to descriptor %d' % (str(p), fileno))
 
-            p.start(self, current_events | evtype, cb, fileno)
-        else:
-            p = poller.Poller(fileno, persistent = persistent)
-            p.start(self, evtype, cb, fileno)
-
-            ## register the poller
-            self.pollers[fileno] = p
+            if not p.active:
+                p.persistent = persistent
+                self.poller_reuses += 1
 
+        p.start(self, evtype, cb, fileno)
         return p
 
-    def remove (self, p):
+    def remove (self, p, evtype = None):
         """
         Remove a listener
-        :param listener: the listener to remove
-        """
-        self._poller_canceled(p)
 
+        The poller is stopped for that event, but it is not destroyed until the descriptor is
+        removed with :meth:`remove_descriptor`, so it can be reused in the next wait.
+
+        :param p: the listener to remove
+        :param evtype: the event (READ or WRITE) we are not interested anymore (default: both)
+        """
+        if evtype is None:
+            evtype = READ | WRITE
+        p.stop(evtype)
 
     def remove_descriptor (self, fileno, skip_callbacks = False):
         """
@@ -319,7 +351,7 @@ class Hub(object):
         t = self.timers
         if not t:
             return None
-        return t[0][0]
+        return t[0][0] / 1000.0
 
     def run (self, *a, **kw):
         """
@@ -365,12 +397,18 @@ class Hub(object):
         self.stopping = False
 
         ## remove all the timers and pollers
-        for timer in self.timers:                   timer.destroy()
+        for _, _, timer in self.timers:             timer.destroy()
         for poller in self.pollers.values():        poller.destroy()
         for callback in self.callbacks:             callback.destroy()
-        self.timers = set()
+        self.timers = []
+        self.timers_canceled = 0
+        self.timers_referenced = 0
+        self.timers_deadline = None
+        self.uv_timer.stop()
+        self.uv_timer.unref()
         self.pollers = {}
-        self.callbacks = set()
+        self.callbacks.clear()
+        self.uv_idle.stop()
 
 
     def loop(self, once = False):
@@ -423,6 +461,9 @@ class Hub(object):
             #    for handler in self.uv_sighandlers: handler.stop()
             #    self.uv_signal_checker.stop()
 
+            self.uv_idle.close()
+            self.uv_timer.close()
+
             if self.uv_loop == pyuv.Loop.default_loop():
                 _default_loop_destroyed = True
 
@@ -457,58 +498,125 @@ class Hub(object):
         """
         Add a timer in the hub
 
-        :param timer:
-        :param unreferenced: if True, we unreference the timer, so the loop does not wait until it is triggered
-        :return:
+        Timers are kept in a heap, ordered by deadline, and a single uv timer is armed for the
+        nearest deadline.
+
+        :param timer: the timer to add
+        :return: the deadline of the timer, in milliseconds of loop time
+        """
+        ## the loop time is only updated by the loop, so it is old if this greenlet has
+        ## been running (or the loop stopped) for a while
+        self.uv_loop.update_time()
+        ## the deadline is rounded up, so timers never fire before their time
+        deadline = self.uv_loop.now() + int(math.ceil(timer.seconds * 1000))
+        timer.scheduled_time = deadline
+        self.timers_seq += 1
+        heapq.heappush(self.timers, (deadline, self.timers_seq, timer))
+
+        if not timer.forgotten:
+            self._timer_referenced()
+
+        if self.timers_deadline is None or deadline < self.timers_deadline:
+            self._arm_timers(deadline)
+
+        return deadline
+
+    def _arm_timers (self, deadline, minimum = 0):
+        """
+        (Re)start the uv timer for firing at *deadline*
+        """
+        self.timers_deadline = deadline
+        delay = max(deadline - self.uv_loop.now(), minimum)
+        self.uv_timer.start(self._timers_triggered, delay / 1000.0, 0)
+
+    def _timer_referenced (self):
+        """
+        A timer that must keep the loop alive has been added
+        """
+        self.timers_referenced += 1
+        if self.timers_referenced == 1:
+            self.uv_timer.ref()
+
+    def _timer_unreferenced (self):
+        """
+        A timer that kept the loop alive has been triggered, canceled or forgotten
         """
-        eventtimer = pyuv.Timer(self.uv_loop)
-        eventtimer.data = timer
-        timer.impltimer = eventtimer
-        eventtimer.start(self._timer_triggered, float(timer.seconds), 0)
-        self.timers.add(timer)
+        self.timers_referenced -= 1
+        if self.timers_referenced == 0:
+            self.uv_timer.unref()
 
+    def _timer_forgotten (self, timer):
+        """
+        A timer does not want to keep the loop alive anymore
+
+        :param timer: the timer that has been forgotten
+        """
+        self._timer_unreferenced()
 
     def _timer_canceled (self, timer):
         """
         A timer has been canceled
 
+        The timer is left in the heap and discarded when it reaches the top. The heap is only
+        rebuilt when more than half of the timers in it have been canceled.
+
         :param timer: the timer that has been canceled
         :return: nothing
         """
-        try:
-            timer.destroy()
-        except (AttributeError, TypeError):
-            pass
+        if not timer.forgotten:
+            self._timer_unreferenced()
 
-        try:
-            self.timers.remove(timer)
-        except KeyError:
-            pass
+        self.timers_canceled += 1
+        len_timers = len(self.timers)
+        if len_timers > MIN_TIMERS_COMPACTION and self.timers_canceled > len_timers / 2:
+            self.timers = [t for t in self.timers if not t[2].called]
+            heapq.heapify(self.timers)
+            self.timers_canceled = 0
 
-    def _timer_triggered (self, handle):
+    def _timers_triggered (self, handle):
         """
-        Performs the timer trigger
+        Fire all the timers that have expired
+
+        Timers added while firing are left for the next loop iteration, even if they have
+        already expired.
 
-        :param timer: the timer that has been triggered
+        :param handle: the uv timer
         :return: nothing
         """
-        timer = handle.data
-        try:
-            timer()
-        except self.SYSTEM_EXCEPTIONS:
-            self.interrupted = True
-        except Exception, e:
-            self.squelch_exception(sys.exc_info())
+        self.timers_deadline = None
+        timers = self.timers
+        now = self.uv_loop.now()
+        last_seq = self.timers_seq
 
-        try:
-            timer.destroy()
-        except (AttributeError, TypeError):
-            pass
+        while timers:
+            deadline, seq, timer = timers[0]
+            if deadline > now or seq > last_seq:
+                break
 
-        try:
-            self.timers.remove(timer)
-        except KeyError:
-            pass
+            heapq.heappop(timers)
+            if timer.called:
+                self.timers_canceled -= 1
+                continue
+
+            if not timer.forgotten:
+                self._timer_unreferenced()
+
+            try:
+                timer()
+            except self.SYSTEM_EXCEPTIONS:
+                self.interrupted = True
+            except Exception, e:
+                self.squelch_exception(sys.exc_info())
+
+            ## the timers list could be replaced while compacting it
+            timers = self.timers
+
+        if timers:
+            ## do not fire the new timers in this loop iteration
+            self._arm_timers(timers[0][0], minimum = 1)
+        else:
+            self.timers_deadline = None
+            handle.stop()
 
     @property
     def timers_count(self):
@@ -525,57 +633,49 @@ class Hub(object):
     def add_callback(self, callback):
         """
         Add a callback in the hub
-        :param timer:
-        :return:
-        """
-        assert isinstance(callback, Callback)
-        eventcallback = pyuv.Idle(self.uv_loop)
-        eventcallback.data = callback
-        callback.implcallback = eventcallback
-        eventcallback.start(self._callback_triggered)
-        self.callbacks.add(callback)
 
+        Callbacks are queued and run in FIFO order by a single idle handle, that is only active
+        while there are pending callbacks.
 
-    def _callback_canceled (self, callback):
-        """
-        A callback has been canceled
-        :param callback: the callback that has been canceled
-        :return: nothing
+        :param callback: the callback to add
+        :return: the callback
         """
         assert isinstance(callback, Callback)
-        try:
-            callback.destroy()
-        except (AttributeError, TypeError):
-            pass
+        self.callbacks.append(callback)
+        if not self.uv_idle.active:
+            self.uv_idle.start(self._callbacks_triggered)
+        return callback
 
-        try:
-            self.callbacks.remove(callback)
-        except KeyError:
-            pass
-
-    def _callback_triggered (self, handle):
+    def _callbacks_triggered (self, handle):
         """
-        Performs the callback trigger
-        :return: nothing
+        Run the pending callbacks
+
+        Only the callbacks that were pending when we started (up to `callbacks_per_iteration`)
+        are run, so callbacks scheduled by callbacks are delayed until the next loop iteration.
+        Canceled callbacks are just discarded.
+
+        The idle handle is stopped when it finds no callbacks pending: stopping it right after
+        running them would make the loop block in this iteration, even if the callbacks have
+        asked the hub to stop.
         """
-        callback = handle.data
-        assert isinstance(callback, Callback)
-        try:
-            callback()
-        except self.SYSTEM_EXCEPTIONS:
-            self.interrupted = True
-        except Exception, e:
-            self.squelch_exception(sys.exc_info())
+        callbacks = self.callbacks
+        if not callbacks:
+            handle.stop()
+            return
 
-        try:
-            callback.destroy()
-        except (AttributeError, TypeError):
-            pass
+        pending = min(len(callbacks), self.callbacks_per_iteration)
+        while pending > 0 and callbacks:
+            pending -= 1
+            callback = callbacks.popleft()
+            if callback.called:
+                continue
 
-        try:
-            self.callbacks.remove(timer)
-        except KeyError:
-            pass
+            try:
+                callback()
+            except self.SYSTEM_EXCEPTIONS:
+                self.interrupted = True
+            except Exception, e:
+                self.squelch_exception(sys.exc_info())
 
     @property
     def callback_count(self):
@@ -611,9 +711,6 @@ class Hub(object):
         except:
             self.squelch_io_exception(p.fileno, sys.exc_info())
 
-        if not p.persistent:
-            self._poller_canceled(p)
-
     def _poller_canceled (self, p):
         """
         A poller has been canceled
@@ -625,8 +722,8 @@ class Hub(object):
         fileno = p.fileno
 
         ## remove all references to the poller...
-        try:                del self.pollers[fileno]
-        except KeyError:    pass
+        if self.pollers.get(fileno) is p:
+            del self.pollers[fileno]
 
         p.destroy()
 
@@ -638,6 +735,13 @@ class Hub(object):
         except AttributeError:
             return 0
 
+    @property
+    def active_poller_count(self):
+        try:
+            return len([x for x in self.pollers.values() if x.active])
+        except AttributeError:
+            return 0
+
 
 
     ##
@@ -789,6 +893,7 @@ class Hub(object):
         return [x for x in self.pollers.values() if x.notify_writable]
 
     def __repr__(self):
-        retval =  "<Hub(%d pollers, %d timers, %d active, %s counters)>" % \
-                  (self.poller_count, self.timers_count, self.num_active, str(self.counters))
+        retval =  "<Hub(%d pollers (%d reused), %d timers, %d active, %s counters)>" % \
+                  (self.poller_count, self.poller_reuses, self.timers_count, self.num_active,
+                   str(self.counters))
         return retval
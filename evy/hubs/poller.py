@@ -109,6 +109,9 @@ class Poller(object):
         """
         Start the poller for an event on that file descriptor
 
+        If the poller is already watching some other event, the new event is added to the mask
+        of the underlying watcher.
+
         :param hub: the hub where this watcher is registered
         :param cb: the callback
         :param args: the arguments for the callback
@@ -117,10 +120,7 @@ class Poller(object):
         assert self.impl is not None
         #assert event in [pyuv.UV_READABLE, pyuv.UV_WRITABLE]
 
-        ## check we do not have another callback on the same descriptor and event
-        tot_events =  event
-        if self.notify_readable:    tot_events |= pyuv.UV_READABLE
-        if self.notify_writable:    tot_events |= pyuv.UV_WRITABLE
+        tot_events = event | self.events
 
         assert tot_events != 0, 'no events'
 
@@ -131,11 +131,34 @@ class Poller(object):
             pass
         else:
             cb = partial(cb, *args)
-            if tot_events & pyuv.UV_READABLE:   self.read_callback  = cb
-            if tot_events & pyuv.UV_WRITABLE:   self.write_callback = cb
+            if event & pyuv.UV_READABLE:   self.read_callback  = cb
+            if event & pyuv.UV_WRITABLE:   self.write_callback = cb
 
         return self.impl
 
+    def stop(self, event = pyuv.UV_READABLE | pyuv.UV_WRITABLE):
+        """
+        Stop watching for *event* on the file descriptor.
+
+        The underlying watcher is not closed: it is just restarted with the remaining events (or
+        stopped if there are no more events), so it can be started again for this descriptor
+        without allocating a new one.
+
+        :param event: the events we are not interested in anymore
+        """
+        if event & pyuv.UV_READABLE:   self.read_callback = None
+        if event & pyuv.UV_WRITABLE:   self.write_callback = None
+
+        try:
+            impl = self.impl
+        except AttributeError:
+            return
+
+        remaining = self.events
+        if remaining:
+            impl.start(remaining, self.hub._poller_triggered)
+        else:
+            impl.stop()
 
     def cancel(self):
         """
@@ -188,13 +211,37 @@ class Poller(object):
         except AttributeError:
             return False
 
+    @property
+    def events(self):
+        """
+        The events this poller is currently watching
+        """
+        events = 0
+        if self.notify_readable:    events |= pyuv.UV_READABLE
+        if self.notify_writable:    events |= pyuv.UV_WRITABLE
+        return events
+
+    @property
+    def active(self):
+        """
+        True if this poller is watching some event
+        """
+        return self.notify_readable or self.notify_writable
+
     ##
     ## callbacks
     ##
 
     def __call__(self, evtype):
-        if self.notify_readable and evtype is pyuv.UV_READABLE:   self.read_callback()
-        if self.notify_writable and evtype is pyuv.UV_WRITABLE:   self.write_callback()
+        read_callback, write_callback = self.read_callback, self.write_callback
+
+        ## non-persistent pollers are one-shot: stop watching the events triggered before
+        ## invoking the callbacks, as they could register new interests in this poller
+        if not self.persistent:
+            self.stop(evtype)
+
+        if read_callback is not None and evtype & pyuv.UV_READABLE:     read_callback()
+        if write_callback is not None and evtype & pyuv.UV_WRITABLE:    write_callback()
 
     # No default ordering in 3.x. heapq uses <
     # FIXME should full set be added?
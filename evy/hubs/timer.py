@@ -27,6 +27,9 @@
 # THE SOFTWARE.
 #
 
+import math
+import time
+import traceback
 from functools import partial
 
 from evy.support import greenlets as greenlet
@@ -57,6 +60,7 @@ class Timer(object):
         """
         self.seconds = seconds
         self.called = False
+        self.forgotten = False
 
         if '_callback' in kw:
             self.callback = kw.pop('_callback')
@@ -92,26 +96,35 @@ class Timer(object):
         return self
 
     def __del__(self):
-        self.destroy()
+        ## a pending timer is kept in the heap of its hub, so we can only get here when that
+        ## hub has been discarded (ie, by reinit_hub()): there is nothing to cancel
+        self.called = True
 
     def destroy(self):
         """
-        Stop and destroy the timer
+        Destroy the timer
 
-        Invoke this method when this timer is no longer used
+        Invoke this method when this timer is no longer used. A timer that is still pending
+        in the hub is canceled.
         """
-        if hasattr(self, 'impltimer'):
-            self.impltimer.stop()
-            def _dummy(*args): pass
-            self.impltimer.close(_dummy)
-            del self.impltimer
-
-    def forget(self):
+        if not self.called and getattr(self, 'scheduled_time', None) is not None:
+            self.cancel()
+        self.called = True
         try:
-            self.impltimer.unref()
+            del self.callback
         except AttributeError:
             pass
 
+    def forget(self):
+        """
+        Let the hub forget about this timer, so we do not keep the loop running forever until
+        the timer triggers.
+        """
+        if not self.forgotten:
+            self.forgotten = True
+            if not self.called:
+                get_hub()._timer_forgotten(self)
+
     def __call__(self, *args):
         if not self.called:
             self.called = True
@@ -143,21 +156,32 @@ class Timer(object):
 
 
 class LocalTimer(Timer):
+    """
+    A timer that is not fired if the greenlet that created it has finished. For greenlets
+    that are recycled for running several functions (like the workers of a
+    :class:`~evy.green.pools.GreenPool`), the function must still be the same one: it is
+    identified by the *generation* of the greenlet.
+    """
 
     def __init__(self, *args, **kwargs):
         self.greenlet = greenlet.getcurrent()
+        self.generation = getattr(self.greenlet, 'generation', 0)
         Timer.__init__(self, *args, **kwargs)
 
+    def _finished(self):
+        g = self.greenlet
+        return g is not None and (g.dead or getattr(g, 'generation', 0) != self.generation)
+
     @property
     def pending(self):
-        if self.greenlet is None or self.greenlet.dead:
+        if self.greenlet is None or self._finished():
             return False
         return not self.called
 
     def __call__(self, *args):
         if not self.called:
             self.called = True
-            if self.greenlet is not None and self.greenlet.dead:
+            if self._finished():
                 return
             self.callback()
 
@@ -167,3 +191,101 @@ class LocalTimer(Timer):
         """
         self.greenlet = None
         Timer.cancel(self)
+
+
+class TimerWheel(object):
+    """
+    Coarse timers for a large number of deadlines that are usually canceled before they expire,
+    like the idle timeouts of the connections of a server.
+
+    Deadlines are rounded up to the *resolution* and kept in slots, so adding and canceling one
+    is just a set operation, and a single hub timer (scheduled only while there are deadlines)
+    fires the callbacks of all the slots that have expired::
+
+        wheel = TimerWheel()
+        entry = wheel.add(10, callback, arg)
+        ...
+        wheel.cancel(entry)
+
+    Callbacks are invoked from the hub, so they should not block.
+    """
+
+    def __init__ (self, resolution = 1.0):
+        """
+        :param resolution: the granularity (in seconds) of the deadlines
+        """
+        self.resolution = resolution
+        self.slots = {}
+        self.timer = None
+        self.timer_tick = None
+
+    def __len__ (self):
+        return sum(len(slot) for slot in self.slots.itervalues())
+
+    def add (self, seconds, cb, *args):
+        """
+        Call *cb(\*args)* in (about) *seconds*
+
+        :return: an entry that can be used for canceling the call with :meth:`cancel`
+        """
+        tick = int(math.ceil((time.time() + seconds) / self.resolution))
+        entry = _WheelEntry(tick, cb, args)
+        slot = self.slots.get(tick)
+        if slot is None:
+            slot = self.slots[tick] = set()
+        slot.add(entry)
+        if self.timer is None or tick < self.timer_tick:
+            self._schedule(tick)
+        return entry
+
+    def cancel (self, entry):
+        """
+        Cancel a call added with :meth:`add`. It has no effect if the call has already been done.
+        """
+        slot = self.slots.get(entry.tick)
+        if slot is not None:
+            slot.discard(entry)
+            if not slot:
+                del self.slots[entry.tick]
+
+    def clear (self):
+        """
+        Cancel all the calls
+        """
+        self.slots.clear()
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _schedule (self, tick):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer_tick = tick
+        self.timer = get_hub().schedule_call_global(max(tick * self.resolution - time.time(), 0),
+                                                    self._expire)
+        ## the deadlines should not keep the hub running
+        self.timer.forget()
+
+    def _expire (self):
+        self.timer = None
+        now_tick = int(time.time() / self.resolution)
+        for tick in sorted(tick for tick in self.slots if tick <= now_tick):
+            for entry in self.slots.pop(tick, ()):
+                try:
+                    entry.callback(*entry.args)
+                except Exception:
+                    traceback.print_exc()
+
+        if self.slots:
+            tick = min(self.slots)
+            if self.timer is None or tick < self.timer_tick:
+                self._schedule(tick)
+
+
+class _WheelEntry(object):
+    __slots__ = ('tick', 'callback', 'args')
+
+    def __init__ (self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
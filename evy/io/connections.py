@@ -0,0 +1,267 @@
+#
+# Evy - a concurrent networking library for Python
+#
+# Unless otherwise noted, the files in Evy are under the following MIT license:
+#
+# Copyright (c) 2012, Alvaro Saurin
+# Copyright (c) 2008-2010, Eventlet Contributors (see AUTHORS)
+# Copyright (c) 2007-2010, Linden Research, Inc.
+# Copyright (c) 2005-2006, Bob Ippolito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""
+A pool of client connections, so sockets can be reused between requests to the same server.
+"""
+
+import collections
+import errno
+import time
+
+from evy.hubs import get_hub
+from evy.patched import socket
+from evy.semaphore import Semaphore
+from evy.support import get_errno
+from evy.timeout import Timeout
+
+from evy.io.convenience import connect_fastest
+
+
+__all__ = ['ConnectionPool', 'default_pool']
+
+
+## maximum number of connections borrowed at the same time for a (host, port, ssl) key
+CONNECTIONS_MAX_PER_HOST = 10
+
+## maximum number of idle connections kept for a (host, port, ssl) key
+CONNECTIONS_MAX_IDLE_PER_HOST = 10
+
+## time (in seconds) an idle connection is kept in the pool
+CONNECTIONS_IDLE_TIMEOUT = 60.0
+
+
+def _is_alive (sock):
+    """
+    Check (without blocking) if an idle socket can be reused.
+
+    An idle socket should have nothing to read: if it is readable, the server has closed it (or
+    sent something we cannot make sense of), so it must be discarded.
+    """
+    buffered = getattr(sock, 'uv_recv_buffer', None)
+    if buffered is not None and buffered.size:
+        return False
+
+    fd = getattr(sock, 'uv_fd', sock)
+    try:
+        fd.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except socket.error, e:
+        return get_errno(e) in (errno.EAGAIN, errno.EWOULDBLOCK)
+    except Exception:
+        return False
+    return False
+
+
+class ConnectionPool(object):
+    """
+    A pool of connected client sockets, keyed by *(host, port, ssl context)*.
+
+    Sockets are borrowed with :meth:`get` and returned with :meth:`put` when the caller is done
+    with them and the connection is still usable (or :meth:`discard` when it is not)::
+
+        pool = ConnectionPool()
+        sock = pool.get('www.example.com', 80)
+        try:
+            ...
+        except:
+            pool.discard(sock)
+            raise
+        else:
+            pool.put(sock)
+
+    Idle sockets are reused most-recently-used first, and they are closed when they have been
+    idle for more than *idle_timeout* seconds. A socket that the server has closed while idle is
+    detected (with a non-blocking peek) and discarded before it is handed out.
+    """
+
+    def __init__ (self, max_per_host = CONNECTIONS_MAX_PER_HOST,
+                  max_idle_per_host = CONNECTIONS_MAX_IDLE_PER_HOST,
+                  idle_timeout = CONNECTIONS_IDLE_TIMEOUT,
+                  connect_timeout = None, connect = None):
+        """
+        :param max_per_host: maximum number of sockets borrowed at the same time for the same
+                             key; :meth:`get` blocks when this limit is reached
+        :param max_idle_per_host: maximum number of idle sockets kept for the same key
+        :param idle_timeout: time (in seconds) an idle socket is kept in the pool
+        :param connect_timeout: timeout (in seconds) for opening new connections
+        :param connect: function used for opening new connections, called with a
+                        *(host, port)* address and the *connect_timeout*. By default, this is
+                        :func:`~evy.io.convenience.connect_fastest`
+        """
+        self.max_per_host = max_per_host
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        if connect is not None:
+            self.connect = connect
+
+        self.idle = {}
+        self.limits = {}
+        self.borrowed = {}
+        self.expire_timer = None
+
+        self.hits = 0
+        self.misses = 0
+        self.dead = 0
+        self.expired = 0
+
+    def connect (self, address, timeout):
+        """
+        Open a new connection to *address*
+        """
+        return connect_fastest(address, timeout = timeout)
+
+    def _key (self, host, port, ssl_context):
+        return host, port, ssl_context
+
+    def get (self, host, port, ssl_context = None, timeout = None):
+        """
+        Borrow a connected socket for *host* and *port*, reusing an idle socket when possible.
+
+        :param ssl_context: a SSL context (an object with a ``wrap_socket()`` method, like
+                            :class:`ssl.SSLContext`) used for wrapping new connections. Sockets
+                            are only reused for the same context.
+        :param timeout: maximum time (in seconds) waiting for the per-host limit
+        :return: a connected socket
+        :raises: :class:`socket.timeout` if the *timeout* expires
+        """
+        key = self._key(host, port, ssl_context)
+        limit = self.limits.get(key)
+        if limit is None:
+            limit = self.limits[key] = Semaphore(self.max_per_host)
+
+        if limit.locked():
+            with Timeout(timeout, socket.timeout('timed out')):
+                limit.acquire()
+        else:
+            limit.acquire()
+
+        try:
+            sock = self._get_idle(key)
+            if sock is None:
+                self.misses += 1
+                sock = self.connect((host, port), self.connect_timeout)
+                if ssl_context is not None:
+                    sock = ssl_context.wrap_socket(sock, server_hostname = host)
+            else:
+                self.hits += 1
+        except:
+            limit.release()
+            raise
+
+        self.borrowed[sock] = key
+        return sock
+
+    def _get_idle (self, key):
+        idle = self.idle.get(key)
+        while idle:
+            sock, _ = idle.pop()
+            if _is_alive(sock):
+                return sock
+            self.dead += 1
+            sock.close()
+        return None
+
+    def put (self, sock):
+        """
+        Return a borrowed socket to the pool, so it can be reused.
+        """
+        key = self.borrowed.pop(sock, None)
+        if key is None:
+            sock.close()
+            return
+
+        idle = self.idle.get(key)
+        if idle is None:
+            idle = self.idle[key] = collections.deque()
+        idle.append((sock, time.time() + self.idle_timeout))
+        while len(idle) > self.max_idle_per_host:
+            oldest, _ = idle.popleft()
+            oldest.close()
+
+        self.limits[key].release()
+        self._schedule_expire()
+
+    def discard (self, sock):
+        """
+        Close a borrowed socket that cannot be reused.
+        """
+        key = self.borrowed.pop(sock, None)
+        sock.close()
+        if key is not None:
+            self.limits[key].release()
+
+    def clear (self):
+        """
+        Close all the idle sockets.
+        """
+        for idle in self.idle.values():
+            while idle:
+                sock, _ = idle.pop()
+                sock.close()
+        self.idle.clear()
+        if self.expire_timer is not None:
+            self.expire_timer.cancel()
+            self.expire_timer = None
+
+    def __len__ (self):
+        """
+        Return the number of idle sockets in the pool.
+        """
+        return sum(len(idle) for idle in self.idle.values())
+
+    def _schedule_expire (self):
+        ## one timer for the whole pool, that does not keep the hub alive
+        if self.expire_timer is None:
+            self.expire_timer = get_hub().schedule_call_global(self.idle_timeout, self._expire)
+            self.expire_timer.forget()
+
+    def _expire (self):
+        self.expire_timer = None
+        now = time.time()
+        for key, idle in self.idle.items():
+            ## the oldest sockets are at the left
+            while idle and idle[0][1] <= now:
+                sock, _ = idle.popleft()
+                self.expired += 1
+                sock.close()
+            if not idle:
+                del self.idle[key]
+                if self.limits[key].balance == self.max_per_host:
+                    del self.limits[key]
+
+        if self.idle:
+            next_expiration = min(idle[0][1] for idle in self.idle.values())
+            self.expire_timer = get_hub().schedule_call_global(max(next_expiration - now, 0),
+                                                               self._expire)
+            self.expire_timer.forget()
+
+
+## the default pool, used by the pooled connections in :mod:`evy.patched.httplib`
+default_pool = ConnectionPool()
@@ -27,13 +27,26 @@
 
 
 import sys
+import time
 
 from evy.green.pools import GreenPool
-from evy.green.threads import kill, getcurrent
+from evy.green.threads import kill, getcurrent, spawn
 from evy.patched import socket
+from evy.queue import LightQueue, Empty
+from evy.timeout import Timeout
 from evy.support import greenlets as greenlet
 
 
+## delay (in seconds) between the connection attempts in connect_fastest()
+CONNECT_ATTEMPT_DELAY = 0.25
+
+## maximum number of connections accepted for every wakeup of an accept loop
+ACCEPT_BATCH_SIZE = 64
+
+## period (in seconds) used for computing the accept rate
+ACCEPT_RATE_PERIOD = 1.0
+
+
 def connect (addr, family = socket.AF_INET, bind = None):
     """
     Convenience function for opening client sockets.
@@ -50,6 +63,110 @@ def connect (addr, family = socket.AF_INET, bind = None):
     return sock
 
 
+def _interleave_families (infos):
+    """
+    Reorder the results of getaddrinfo(), alternating the address families
+    """
+    families = []
+    by_family = {}
+    for info in infos:
+        family = info[0]
+        if family not in by_family:
+            families.append(family)
+            by_family[family] = []
+        by_family[family].append(info)
+
+    result = []
+    while len(result) < len(infos):
+        for family in families:
+            if by_family[family]:
+                result.append(by_family[family].pop(0))
+    return result
+
+
+def connect_fastest (addr, timeout = None, attempt_timeout = None,
+                     delay = CONNECT_ATTEMPT_DELAY, bind = None):
+    """
+    Open a client socket to any of the addresses of a server ("happy eyeballs").
+
+    All the addresses of the server are resolved (IPv4 and IPv6, alternating families) and a
+    connection attempt is started for each one, *delay* seconds after the previous one (or
+    as soon as the previous one fails). The first connected socket is returned and the
+    other attempts are cancelled, so a dead address does not stall us until its timeout.
+
+    :param addr: address of the server to connect to, as a (host, port) tuple.
+    :param timeout: overall timeout for connecting, in seconds (None for no timeout)
+    :param attempt_timeout: timeout for each connection attempt, in seconds (None for no timeout)
+    :param delay: time (in seconds) between the start of each connection attempt
+    :param bind: local address to bind to, optional.
+    :return: The connected green socket object.
+    :raises: :class:`socket.error` with the error of the last attempt if all of them fail,
+             or :class:`socket.timeout` if the overall timeout expires
+    """
+    host, port = addr[:2]
+    infos = _interleave_families(socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                                                    socket.SOCK_STREAM))
+    if not infos:
+        raise socket.error('getaddrinfo returns an empty list')
+
+    results = LightQueue()
+    attempts = []
+    winner = []
+
+    def attempt (family, socktype, proto, sockaddr):
+        sock = socket.socket(family, socktype, proto)
+        try:
+            sock.settimeout(attempt_timeout)
+            if bind is not None:
+                sock.bind(bind)
+            sock.connect(sockaddr)
+        except socket.error, e:
+            sock.close()
+            results.put(e)
+        except:
+            sock.close()
+            raise
+        else:
+            if winner:
+                sock.close()
+            else:
+                results.put(sock)
+
+    error = None
+    failed = 0
+    try:
+        with Timeout(timeout, socket.timeout('timed out')):
+            pending = list(infos)
+            while failed < len(infos):
+                if pending:
+                    family, socktype, proto, _, sockaddr = pending.pop(0)
+                    attempts.append(spawn(attempt, family, socktype, proto, sockaddr))
+
+                ## wait for a result, or start the next attempt after the delay
+                try:
+                    result = results.get(timeout = delay if pending else None)
+                except Empty:
+                    continue
+
+                if isinstance(result, socket.error):
+                    error = result
+                    failed += 1
+                else:
+                    winner.append(result)
+                    result.settimeout(socket.getdefaulttimeout())
+                    return result
+    finally:
+        winner.append(None)
+        for gt in attempts:
+            gt.kill()
+        while results.qsize():
+            result = results.get_nowait()
+            if not isinstance(result, socket.error):
+                result.close()
+
+    raise error
+
+
 def listen (addr, family = socket.AF_INET, backlog = 50):
     """
     Convenience function for opening server sockets.  This
@@ -70,6 +187,72 @@ def listen (addr, family = socket.AF_INET, backlog = 50):
     return sock
 
 
+class AcceptStats(object):
+    """
+    Counters for an accept loop, like the loops in :func:`serve` and
+    :func:`evy.web.wsgi.server`.
+
+    The backlog is the number of connections found waiting every time the listening socket
+    becomes readable: when it grows, clients are waiting in the kernel queue for the server.
+    """
+
+    def __init__ (self):
+        self.accepted = 0           # total number of connections accepted
+        self.batches = 0            # number of times the loop has accepted connections
+        self.backlog = 0            # connections found waiting the last time
+        self.max_backlog = 0        # maximum number of connections found waiting
+
+        self._period_start = time.time()
+        self._period_accepted = 0
+        self._rate = 0.0
+
+    def add (self, count):
+        """
+        Account for a batch of *count* connections accepted together
+        """
+        self.accepted += count
+        self.batches += 1
+        self.backlog = count
+        if count > self.max_backlog:
+            self.max_backlog = count
+        self._period_accepted += count
+        self._update_rate()
+
+    def _update_rate (self):
+        now = time.time()
+        elapsed = now - self._period_start
+        if elapsed >= ACCEPT_RATE_PERIOD:
+            self._rate = self._period_accepted / elapsed
+            self._period_start = now
+            self._period_accepted = 0
+
+    @property
+    def rate (self):
+        """
+        The number of connections accepted per second, in the last period
+        """
+        self._update_rate()
+        return self._rate
+
+    def __repr__ (self):
+        return '<AcceptStats accepted=%d rate=%.1f/s backlog=%d max_backlog=%d>' % (
+            self.accepted, self.rate, self.backlog, self.max_backlog)
+
+
+def accept_batch (sock, limit = ACCEPT_BATCH_SIZE):
+    """
+    Accept all the connections waiting in a listening socket (up to *limit*), waiting for one
+    when there is none.
+
+    :return: a list of (socket, address) pairs
+    """
+    try:
+        accept_many = sock.accept_many
+    except AttributeError:
+        return [sock.accept()]
+    return accept_many(limit)
+
+
 class StopServe(Exception):
     """
     Exception class used for quitting :func:`~evy.serve` gracefully."""
@@ -88,7 +271,7 @@ def _stop_checker (t, server_gt, conn):
         kill(server_gt, *sys.exc_info())
 
 
-def serve (sock, handle, concurrency = 1000):
+def serve (sock, handle, concurrency = 1000, stats = None):
     """
     Runs a server on the supplied socket.  Calls the function *handle* in a
     separate greenthread for every incoming client connection.  *handle* takes
@@ -118,15 +301,23 @@ def serve (sock, handle, concurrency = 1000):
     greenthreads that will be open at any time handling requests.  When
     the server hits the concurrency limit, it stops accepting new
     connections until the existing ones complete.
+
+    All the connections waiting when the socket becomes readable are accepted
+    together. The optional *stats* is an :class:`AcceptStats` where the
+    accepted connections are accounted.
     """
     pool = GreenPool(concurrency)
     server_gt = getcurrent()
 
     while True:
         try:
-            conn, addr = sock.accept()
-            gt = pool.spawn(handle, conn, addr)
-            gt.link(_stop_checker, server_gt, conn)
-            conn, addr, gt = None, None, None
+            ## do not accept more connections than we can handle now
+            batch = accept_batch(sock, min(max(pool.free(), 1), ACCEPT_BATCH_SIZE))
+            if stats is not None:
+                stats.add(len(batch))
+            for conn, addr in batch:
+                gt = pool.spawn(handle, conn, addr)
+                gt.link(_stop_checker, server_gt, conn)
+            conn, addr, gt, batch = None, None, None, None
         except StopServe:
             return
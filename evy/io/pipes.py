@@ -192,6 +192,8 @@ class GreenPipe(_fileobject):
         :return: nothing
         """
         #super(GreenPipe, self).close()
+        if not self._fileobj.closed:
+            self.uv_hub.remove_descriptor(self._fileobj.fileno(), skip_callbacks = True)
         self._fileobj.close()
         for method in ['fileno', 'flush', 'isatty', 'next', 'read', 'readinto',
                        'readline', 'readlines', 'seek', 'tell', 'truncate',
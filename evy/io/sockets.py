@@ -28,8 +28,11 @@
 #
 #
 
+import array
 import errno
+import os
 import time
+import collections
 
 try:
     from cStringIO import StringIO
@@ -45,6 +48,7 @@ import pyuv
 from evy.support import get_errno
 from evy.support.errors import last_socket_error
 
+from evy.support import greenlets as greenlet
 from evy.hubs import trampoline, wait_read, wait_write
 from evy.hubs import get_hub
 from evy.timeout import Timeout
@@ -56,6 +60,23 @@ from evy.io.utils import _GLOBAL_DEFAULT_TIMEOUT
 from evy.io.utils import SOCKET_BLOCKING, SOCKET_CLOSED
 from evy.io.utils import _fileobject
 
+try:
+    from OpenSSL import SSL
+except ImportError:
+    ## pyOpenSSL is not installed: define its exceptions anyway, so they can be caught
+    class SSL(object):
+        class WantWriteError(Exception):
+            pass
+
+        class WantReadError(Exception):
+            pass
+
+        class ZeroReturnError(Exception):
+            pass
+
+        class SysCallError(Exception):
+            pass
+
 
 __all__ = [
     'GreenSocket',
@@ -63,6 +84,16 @@ __all__ = [
 
 BUFFER_SIZE = 4096
 
+## default limits for the receive buffer in streaming mode
+STREAM_HIGH_WATER = 256 * 1024
+STREAM_LOW_WATER = 64 * 1024
+
+## default limit of bytes being written, when writes are not waited for
+WRITE_OUTSTANDING_LIMIT = 256 * 1024
+
+## default maximum number of connections accepted at once by accept_many()
+ACCEPT_BATCH_SIZE = 64
+
 
 # Emulate _fileobject class in 3.x implementation
 # Eventually this internal socket structure could be replaced with makefile calls.
@@ -74,6 +105,177 @@ except AttributeError:
 
 
 
+####################################################################################################
+
+class _RecvBuffer(object):
+    """
+    A receive buffer made of the chunks of data obtained from libuv.
+
+    Chunks are kept as they are received and consumed with an offset in the first one, so
+    reading from the buffer only copies the data returned.
+    """
+
+    __slots__ = ['chunks', 'offset', 'size']
+
+    def __init__ (self):
+        self.chunks = collections.deque()
+        self.offset = 0                             # offset in the first chunk
+        self.size = 0                               # total bytes available
+
+    def __len__ (self):
+        return self.size
+
+    def append (self, data):
+        """
+        Add some data at the end of the buffer
+
+        :param data: the data received
+        """
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+
+    def read (self, nbytes):
+        """
+        Get (and consume) up to *nbytes* from the buffer
+
+        :param nbytes: the maximum number of bytes
+        :return: a string with the data
+        """
+        chunks = self.chunks
+        if not chunks or nbytes <= 0:
+            return ''
+
+        ## fast paths: all the data we want is in the first chunk
+        first = chunks[0]
+        offset = self.offset
+        end = offset + nbytes
+        len_first = len(first)
+        if end < len_first:
+            self.offset = end
+            self.size -= nbytes
+            return first[offset:end]
+        elif end == len_first or len(chunks) == 1:
+            chunks.popleft()
+            self.offset = 0
+            res = first[offset:] if offset else first
+            self.size -= len(res)
+            return res
+
+        pieces = []
+        remaining = min(nbytes, self.size)
+        while remaining > 0:
+            chunk = chunks[0]
+            offset = self.offset
+            available = len(chunk) - offset
+            if available <= remaining:
+                pieces.append(chunk[offset:] if offset else chunk)
+                chunks.popleft()
+                self.offset = 0
+                remaining -= available
+            else:
+                pieces.append(chunk[offset:offset + remaining])
+                self.offset = offset + remaining
+                remaining = 0
+
+        res = ''.join(pieces) if len(pieces) > 1 else pieces[0]
+        self.size -= len(res)
+        return res
+
+    def peek (self):
+        """
+        Get the data in the first chunk of the buffer, without consuming it
+
+        :return: a string with the data (empty if the buffer is empty)
+        """
+        if not self.chunks:
+            return ''
+        first = self.chunks[0]
+        return first[self.offset:] if self.offset else first
+
+    def skip (self, nbytes):
+        """
+        Consume up to *nbytes* from the buffer, without copying them
+
+        :param nbytes: the number of bytes
+        """
+        chunks = self.chunks
+        nbytes = min(nbytes, self.size)
+        self.size -= nbytes
+        while nbytes > 0:
+            available = len(chunks[0]) - self.offset
+            if available <= nbytes:
+                chunks.popleft()
+                self.offset = 0
+                nbytes -= available
+            else:
+                self.offset += nbytes
+                nbytes = 0
+
+    def read_into (self, buf, nbytes):
+        """
+        Copy (and consume) up to *nbytes* from the buffer into *buf*
+
+        :param buf: a writable buffer
+        :param nbytes: the maximum number of bytes
+        :return: the number of bytes copied
+        """
+        try:
+            view = memoryview(buf)
+        except TypeError:
+            ## old-style buffers, like array.array in Python 2
+            itemsize = buf.itemsize
+            nbytes = min(nbytes, len(buf) * itemsize, self.size)
+            data = self.read(nbytes - nbytes % itemsize)
+            buf[:len(data) // itemsize] = array.array(buf.typecode, data)
+            return len(data)
+
+        chunks = self.chunks
+        remaining = min(nbytes, len(view), self.size)
+        pos = 0
+        while remaining > 0:
+            chunk = chunks[0]
+            offset = self.offset
+            count = min(len(chunk) - offset, remaining)
+            view[pos:pos + count] = chunk[offset:offset + count]
+            pos += count
+            remaining -= count
+            if offset + count == len(chunk):
+                chunks.popleft()
+                self.offset = 0
+            else:
+                self.offset = offset + count
+
+        self.size -= pos
+        return pos
+
+    def readline (self, limit = -1):
+        """
+        Get (and consume) a line from the buffer
+
+        :param limit: the maximum length of the line, or a negative value for no limit
+        :return: the line (including the newline), or None if there is no complete line in
+                 the buffer yet
+        """
+        scanned = 0
+        offset = self.offset
+        for chunk in self.chunks:
+            pos = chunk.find('\n', offset)
+            if pos >= 0:
+                length = scanned + pos - offset + 1
+                if 0 <= limit < length:
+                    length = limit
+                return self.read(length)
+
+            scanned += len(chunk) - offset
+            offset = 0
+            if 0 <= limit <= scanned:
+                return self.read(limit)
+
+        return None
+
+
+
 ####################################################################################################
 
 def _closed_dummy (*args):
@@ -103,7 +305,23 @@ class GreenSocket(object):
         self.uv_fd = None
         self.uv_handle = None
         self.uv_hub = None
-        self.uv_recv_string = ''                    # buffer for receiving data...
+        self.uv_recv_buffer = _RecvBuffer()         # buffer for receiving data...
+
+        ## streaming mode
+        self.uv_streaming = False
+        self.uv_reading = False                     # True while start_read() is active
+        self.uv_recv_waiter = None                  # the greenlet waiting for data
+        self.uv_recv_error = None                   # EOF or exception found while streaming
+        self.uv_high_water = STREAM_HIGH_WATER
+        self.uv_low_water = STREAM_LOW_WATER
+
+        ## writes
+        self.uv_write_limit = 0                     # outstanding bytes we do not wait for
+        self.uv_write_pending = 0                   # bytes being written by libuv
+        self.uv_write_sizes = collections.deque()   # size of each write, in order
+        self.uv_write_waiter = None                 # the greenlet waiting for writes
+        self.uv_write_waiter_limit = 0              # the bytes the waiter can leave pending
+        self.uv_write_error = None                  # error found in a write nobody waited for
 
         if isinstance(family, (int, long)):
             self.uv_fd = _original_socket(family, type, proto, _sock)
@@ -186,6 +404,13 @@ class GreenSocket(object):
         Close the TCP socket
         :return: None
         """
+        fileno = None
+        if self.uv_fd:
+            try:
+                fileno = self.uv_fd.fileno()
+            except socket.error:
+                pass
+
         try:
             if self.uv_handle:
                 ## remove some TCP-specific stuff
@@ -195,14 +420,30 @@ class GreenSocket(object):
                 if not self.uv_handle.closed:
                     def closed_callback (*args):
                         pass
-                    self.uv_handle.close(closed_callback)
+
+                    ## libuv closes the descriptor, so the Python socket must forget it right
+                    ## after that: otherwise it would close it again when it is released (maybe
+                    ## much later, if something keeps a reference), and by then the descriptor
+                    ## could belong to another socket
+                    if self.uv_write_pending and isinstance(self.uv_handle, pyuv.TCP):
+                        ## let libuv flush the writes nobody waited for before closing,
+                        ## keeping the descriptor alive until then
+                        fd = self.uv_fd
+                        def shutdown_callback (handle, error):
+                            handle.close(closed_callback)
+                            fd.close()
+                        self.uv_handle.shutdown(shutdown_callback)
+                    else:
+                        self.uv_handle.close(closed_callback)
+                        self.uv_fd.close()
 
             elif self.uv_fd:
                 self.uv_fd.close()
         finally:
             ## we must remove all pollers on this socket
-            hub = self.uv_hub if self.uv_hub else get_hub()
-            hub.remove_descriptor(self.fileno(), skip_callbacks = True)
+            if fileno is not None:
+                hub = self.uv_hub if self.uv_hub else get_hub()
+                hub.remove_descriptor(fileno, skip_callbacks = True)
 
             self.uv_handle = None
             self.uv_fd = None
@@ -233,10 +474,21 @@ class GreenSocket(object):
 
 
     def dup (self, *args, **kw):
-        sock = self.uv_fd.dup(*args, **kw)
+        ## the Python socket dup() shares the descriptor, but libuv closes it with the handle,
+        ## so we need a real copy of the descriptor for the new handle
+        if self.uv_handle:
+            sock = socket.fromfd(self.uv_fd.fileno(), self.family, self.type, self.proto)
+        else:
+            sock = self.uv_fd.dup(*args, **kw)
         set_nonblocking(sock)
         newsock = type(self)(sock)
         newsock.settimeout(self.gettimeout())
+        newsock.uv_write_limit = self.uv_write_limit
+        ## share the data received but not consumed yet, so nothing is lost when reading from
+        ## both sockets (ie, with unbuffered file objects created with makefile())
+        newsock.uv_recv_buffer = self.uv_recv_buffer
+        if self.uv_streaming:
+            newsock.setstreaming(True, self.uv_high_water, self.uv_low_water)
 
         #if self.uv_handle:
         #    new_handle = pyuv.TCP(self.uv_hub.uv_loop)
@@ -254,7 +506,7 @@ class GreenSocket(object):
             return self.uv_fd.bind(address)
         else:
             try:
-                self.uv_handle.bind(resolve_address(address))
+                self.uv_handle.bind(resolve_address(address, self.family))
             except ValueError, e:
                 raise OverflowError(e)
             except pyuv.error.TCPError, e:
@@ -288,6 +540,38 @@ class GreenSocket(object):
                     set_nonblocking(client)
                     return GreenSocket(client, _hub = self.uv_hub), addr
 
+    def accept_many (self, limit = ACCEPT_BATCH_SIZE):
+        """
+        Accept all the pending connections (up to *limit*), waiting only when there is none.
+        When many clients connect at the same time, this saves a wait for every connection.
+
+        :param limit: the maximum number of connections accepted
+        :return: a list of (socket, address) pairs, with one pair at least
+        """
+        if self.act_non_blocking:
+            return [self.uv_fd.accept()]
+
+        fd = self.uv_fd
+        accepted = []
+        while True:
+            while len(accepted) < limit:
+                try:
+                    res = socket_accept(fd)
+                except socket.error:
+                    ## return what we have: the error will be raised again in the next call
+                    if accepted:
+                        break
+                    raise
+                if not res:
+                    break
+                client, addr = res
+                set_nonblocking(client)
+                accepted.append((GreenSocket(client, _hub = self.uv_hub), addr))
+
+            if accepted:
+                return accepted
+            wait_read(fd, self.gettimeout(), socket.timeout("timed out"))
+
 
     def connect (self, address):
         """
@@ -310,7 +594,7 @@ class GreenSocket(object):
                     except Exception, e:
                         did_connect.send_exception(e)
 
-                self.uv_handle.connect(resolve_address(address), connect_callback)
+                self.uv_handle.connect(resolve_address(address, self.family), connect_callback)
                 did_connect.wait(self.gettimeout(), socket.timeout(errno.ETIME, "timed out"))
             except pyuv.error.TCPError, e:
                 raise socket.error(*last_socket_error(e.args[0], msg = 'connect error'))
@@ -389,7 +673,7 @@ class GreenSocket(object):
         :param kw:
         :return: a file objet
         """
-        return _fileobject(self.dup(), *args, **kw)
+        return _GreenFileObject(self.dup(), *args, **kw)
 
     def recvfrom (self, *args):
         if not self.uv_fd:
@@ -419,11 +703,194 @@ class GreenSocket(object):
         if not flags:
             flags = 0
 
+        if not self.act_non_blocking and isinstance(self.uv_handle, pyuv.TCP):
+            if not self.uv_recv_buffer.size:
+                self._uv_read()
+            nbytes = self.uv_recv_buffer.read_into(buf, nbytes)
+            if self.uv_streaming:
+                self._uv_stream_drained()
+            return nbytes
+
         if not self.act_non_blocking:
             wait_read(self.uv_fd, self.gettimeout(), socket.timeout("timed out"))
 
         return self.uv_fd.recv_into(buf, nbytes = nbytes, flags = flags)
 
+    def setstreaming (self, flag = True, high_water = STREAM_HIGH_WATER,
+                      low_water = STREAM_LOW_WATER):
+        """
+        Enable or disable the streaming mode in a TCP socket.
+
+        In streaming mode, the socket keeps reading from the connection even when nobody is
+        waiting in a recv(), accumulating the data in the receive buffer. When the buffer
+        reaches *high_water* bytes, reading is paused until it has been drained below
+        *low_water* bytes.
+
+        :param flag: True for enabling the streaming mode
+        :param high_water: the size of the receive buffer where reading is paused
+        :param low_water: the size of the receive buffer where reading is resumed
+        """
+        if not isinstance(self.uv_handle, pyuv.TCP):
+            raise NotImplementedError('streaming is only supported for TCP sockets')
+        if low_water > high_water:
+            raise ValueError('the low water mark must not be higher than the high water mark')
+
+        self.uv_high_water = high_water
+        self.uv_low_water = low_water
+        self.uv_streaming = bool(flag)
+        if not self.uv_streaming and self.uv_reading:
+            self.uv_handle.stop_read()
+            self.uv_reading = False
+        elif self.uv_streaming:
+            ## start reading right now if we are connected, or on the first recv() otherwise
+            try:
+                self._uv_stream_drained()
+            except pyuv.error.TCPError:
+                pass
+
+    def _uv_stream_callback (self, handle, data, error):
+        """
+        Callback for the data received in streaming mode
+        """
+        if error:
+            if pyuv.errno.errorcode[error] == 'UV_EOF':
+                self.uv_recv_error = GreenSocket.EOF
+            else:
+                self.uv_recv_error = last_socket_error(error, msg = 'read error')
+        elif not data:
+            self.uv_recv_error = GreenSocket.EOF
+        else:
+            self.uv_recv_buffer.append(data)
+
+        if self.uv_recv_error is not None or self.uv_recv_buffer.size >= self.uv_high_water:
+            handle.stop_read()
+            self.uv_reading = False
+
+        waiter = self.uv_recv_waiter
+        if waiter is not None:
+            self.uv_recv_waiter = None
+            waiter.switch()
+
+    def _uv_stream_drained (self):
+        """
+        Resume reading if the receive buffer has been drained below the low water mark
+        """
+        if not self.uv_reading and self.uv_recv_error is None and \
+                self.uv_recv_buffer.size <= self.uv_low_water and self.uv_handle:
+            self.uv_handle.start_read(self._uv_stream_callback)
+            self.uv_reading = True
+
+    def _uv_stream_read (self):
+        """
+        Wait for the next chunk of data in streaming mode
+
+        :return: GreenSocket.EOF if the other side has closed the connection, None otherwise
+        """
+        if self.uv_recv_error is None:
+            ## somebody wants more data: keep reading even if we are over the high water mark
+            if not self.uv_reading:
+                self.uv_handle.start_read(self._uv_stream_callback)
+                self.uv_reading = True
+
+            current = greenlet.getcurrent()
+            assert self.uv_recv_waiter is None, 'there is already a greenlet reading from %r' % self
+
+            timeout = self.gettimeout()
+            t = None
+            if timeout is not None:
+                t = self.uv_hub.schedule_call_global(timeout, current.throw,
+                                                     socket.timeout("timed out"))
+            self.uv_recv_waiter = current
+            try:
+                self.uv_hub.switch()
+            finally:
+                self.uv_recv_waiter = None
+                if t is not None:
+                    t.cancel()
+
+        error = self.uv_recv_error
+        if error is None:
+            return None
+        elif error == GreenSocket.EOF:
+            return GreenSocket.EOF
+        else:
+            self.uv_recv_error = GreenSocket.EOF
+            raise error
+
+    def _uv_read (self):
+        """
+        Wait for the next chunk of data from libuv and append it to the receive buffer
+
+        :return: GreenSocket.EOF if the other side has closed the connection, None otherwise
+        """
+        if self.uv_streaming:
+            return self._uv_stream_read()
+
+        did_read = Event()
+
+        def read_callback (handle, data, error):
+            try:
+                self.uv_handle.stop_read()
+                if error:
+                    if pyuv.errno.errorcode[error] == 'UV_EOF':
+                        did_read.send(GreenSocket.EOF)
+                    else:
+                        did_read.send_exception(
+                            last_socket_error(error, msg = 'read error'))
+                elif data is None or len(data) == 0:
+                    did_read.send(GreenSocket.EOF)
+                else:
+                    ## append the data to the buffer and, maybe, stop reading...
+                    self.uv_recv_buffer.append(data)
+                    did_read.send()
+
+            except Exception, e:
+                did_read.send_exception(e)
+
+        ## TODO: we cannot use start_read for UDP!!
+
+        if isinstance(self.uv_handle, pyuv.TCP):
+            self.uv_handle.start_read(read_callback)
+            return did_read.wait(self.gettimeout(), socket.timeout("timed out"))
+        elif isinstance(self.uv_handle, pyuv.UDP):
+            raise NotImplementedError('not implemented yet for UDP sockets')
+
+    def _recv_line (self, size = -1):
+        """
+        Receive a line from the socket, as used by the file objects returned by makefile()
+
+        :param size: the maximum length of the line, or a negative value for no limit
+        :return: the line, including the trailing newline (if any)
+        """
+        buf = self.uv_recv_buffer
+        while True:
+            line = buf.readline(size)
+            if line is None and self._uv_read() == GreenSocket.EOF:
+                line = buf.read(len(buf))
+            if line is not None:
+                if self.uv_streaming:
+                    self._uv_stream_drained()
+                return line
+
+    def _recv_parsed (self, parser):
+        """
+        Feed a parser with the data received, until it is done
+
+        The parser gets the chunks of the receive buffer as they are, and it must provide a
+        ``done`` attribute and a ``feed(data)`` method returning the number of bytes used. The
+        data it does not use is kept in the buffer.
+
+        :param parser: the parser
+        :return: False if the other side closed the connection before the parser was done
+        """
+        buf = self.uv_recv_buffer
+        while not parser.done:
+            if not buf.size and self._uv_read() == GreenSocket.EOF:
+                return False
+            buf.skip(parser.feed(buf.peek()))
+            if self.uv_streaming:
+                self._uv_stream_drained()
+        return True
 
     def recv (self, buflen, flags = 0):
         """
@@ -438,40 +905,14 @@ class GreenSocket(object):
         if self.act_non_blocking:
             return self.uv_fd.recv(buflen, flags)
         elif self.uv_handle:
-            tot_read = len(self.uv_recv_string)
-            if tot_read < buflen:
-
-                did_read = Event()
-
-                def read_callback (handle, data, error):
-                    try:
-                        self.uv_handle.stop_read()
-                        if error:
-                            if pyuv.errno.errorcode[error] == 'UV_EOF':
-                                did_read.send(GreenSocket.EOF)
-                            else:
-                                did_read.send_exception(
-                                    last_socket_error(error, msg = 'read error'))
-                        elif data is None or len(data) == 0:
-                            did_read.send(GreenSocket.EOF)
-                        else:
-                            ## append the data to the buffer and, maybe, stop reading...
-                            self.uv_recv_string += data
-                            did_read.send()
-
-                    except Exception, e:
-                        did_read.send_exception(e)
-
-                ## TODO: we cannot use start_read for UDP!!
-
-                if isinstance(self.uv_handle, pyuv.TCP):
-                    self.uv_handle.start_read(read_callback)
-                    did_read.wait(self.gettimeout(), socket.timeout("timed out"))
-                elif isinstance(self.uv_handle, pyuv.UDP):
-                    raise NotImplementedError('not implemented yet for UDP sockets')
+            ## only wait for more data when there is nothing buffered
+            if not self.uv_recv_buffer.size:
+                self._uv_read()
 
             ## get the data we want from the read buffer, and keep the rest
-            res, self.uv_recv_string = self.uv_recv_string[:buflen], self.uv_recv_string[buflen:]
+            res = self.uv_recv_buffer.read(buflen)
+            if self.uv_streaming:
+                self._uv_stream_drained()
             return res
         else:
             fd = self.uv_fd
@@ -488,6 +929,91 @@ class GreenSocket(object):
                 wait_read(fd, self.gettimeout(), socket.timeout("timed out"))
 
 
+    def setwritelimit (self, limit = WRITE_OUTSTANDING_LIMIT):
+        """
+        Set the number of bytes that can be pending in a TCP socket without waiting for them.
+
+        With a limit greater than zero, send(), sendall() and sendv() return as soon as the data
+        has been passed to libuv, as long as the total amount of bytes not written yet is below
+        *limit*. Errors found in these writes are raised by the next write in the socket. With
+        a limit of zero (the default), all the writes wait until the data has been written.
+
+        :param limit: the maximum number of outstanding bytes
+        """
+        if limit < 0:
+            raise ValueError('the write limit must not be negative')
+        self.uv_write_limit = limit
+
+    def _uv_write_callback (self, handle, error):
+        """
+        Callback for the writes (in order) in a libuv stream
+        """
+        self.uv_write_pending -= self.uv_write_sizes.popleft()
+        if error and self.uv_write_error is None:
+            self.uv_write_error = last_socket_error(error, msg = 'write error')
+
+        if self.uv_write_waiter is not None and (self.uv_write_pending <= self.uv_write_waiter_limit or
+                                                 self.uv_write_error is not None):
+            self.uv_hub.run_callback(self._uv_write_wakeup)
+
+    def _uv_write_wakeup (self):
+        waiter = self.uv_write_waiter
+        if waiter is not None:
+            self.uv_write_waiter = None
+            waiter.switch()
+
+    def _uv_write (self, buffers, nbytes, wait = True):
+        """
+        Write some buffers in the libuv stream with a single write request, waiting until the
+        outstanding bytes are below our limit
+
+        :param buffers: a list of buffers (strings, buffers or memoryviews)
+        :param nbytes: the total length of the buffers
+        :param wait: if False, just queue the write in libuv, without waiting (so this can be
+                     used from the hub)
+        """
+        if self.uv_write_error is not None:
+            error, self.uv_write_error = self.uv_write_error, None
+            raise error
+
+        if len(buffers) == 1:
+            self.uv_handle.write(buffers[0], self._uv_write_callback)
+        else:
+            self.uv_handle.writelines(buffers, self._uv_write_callback)
+
+        self.uv_write_sizes.append(nbytes)
+        self.uv_write_pending += nbytes
+
+        if wait:
+            self._uv_wait_writes(self.uv_write_limit)
+
+    def _uv_wait_writes (self, limit):
+        """
+        Wait until the bytes being written by libuv are below *limit*
+        """
+        if self.uv_write_pending > limit:
+            current = greenlet.getcurrent()
+            assert self.uv_write_waiter is None, 'there is already a greenlet writing to %r' % self
+
+            timeout = self.gettimeout()
+            t = None
+            if timeout is not None:
+                t = self.uv_hub.schedule_call_global(timeout, current.throw,
+                                                     socket.timeout(errno.ETIME, "timed out"))
+            try:
+                while self.uv_write_pending > limit and self.uv_write_error is None:
+                    self.uv_write_waiter = current
+                    self.uv_write_waiter_limit = limit
+                    self.uv_hub.switch()
+            finally:
+                self.uv_write_waiter = None
+                if t is not None:
+                    t.cancel()
+
+            if self.uv_write_error is not None:
+                error, self.uv_write_error = self.uv_write_error, None
+                raise error
+
     def send (self, data, flags = 0):
         """
         Send data to the socket. The socket must be connected to a remote socket. The optional
@@ -501,20 +1027,9 @@ class GreenSocket(object):
         if self.act_non_blocking:
             return self.uv_fd.send(data, flags)
         elif self.uv_handle:
-            did_write = Event()
             write_len = len(data)
-
-            def write_callback (handle, error):
-                try:
-                    if error:
-                        did_write.send_exception(last_socket_error(error, msg = 'write error'))
-                    else:
-                        did_write.send(write_len)
-                except Exception, e:
-                    did_write.send_exception(e)
-
-            self.uv_handle.write(data, write_callback)
-            return did_write.wait(self.gettimeout(), socket.timeout(errno.ETIME, "timed out"))
+            self._uv_write([data], write_len)
+            return write_len
         else:
             fd = self.uv_fd
             # blocking socket behavior - sends all, blocks if the buffer is full
@@ -545,10 +1060,106 @@ class GreenSocket(object):
         :param flags:
         :return: None is returned on success
         """
+        if self.uv_handle and not self.act_non_blocking:
+            ## libuv writes everything we give it
+            self._uv_write([data], len(data))
+            return
+
         tail = self.send(data, flags)
         len_data = len(data)
         while tail < len_data:
-            tail += self.send(data[tail:], flags)
+            tail += self.send(buffer(data, tail), flags)
+
+    def sendv (self, buffers, flags = 0):
+        """
+        Send a list of buffers to the socket, as if they were concatenated. In TCP sockets, the
+        buffers are passed to libuv in a single (vectored) write, without copying them.
+        :param buffers: a sequence of strings, buffers or memoryviews
+        :param flags: modifier flags
+        :return: None is returned on success
+        """
+        buffers = [b for b in buffers if len(b)]
+        if not buffers:
+            return
+
+        if self.uv_handle and not self.act_non_blocking and isinstance(self.uv_handle, pyuv.TCP):
+            self._uv_write(buffers, sum(map(len, buffers)))
+        else:
+            for data in buffers:
+                self.sendall(data, flags)
+
+    def sendfile (self, file, offset = 0, count = None):
+        """
+        Send the contents of a regular file to the socket, until EOF is reached or *count*
+        bytes have been sent. In TCP sockets, the data is sent with the sendfile() system call,
+        so it is not copied to user space, waiting for the socket to be writable when needed.
+        Other sockets (or files where sendfile() cannot be used) fall back to :meth:`sendall`.
+
+        :param file: a regular file object, opened in binary mode
+        :param offset: the position in the file where we start reading
+        :param count: the number of bytes to send (by default, until EOF)
+        :return: the number of bytes sent. The file position is updated to the position
+                 after the last byte sent.
+        """
+        if count is not None and count <= 0:
+            return 0
+
+        total_sent = 0
+        if self.uv_handle and not self.act_non_blocking and isinstance(self.uv_handle, pyuv.TCP):
+            fileno = file.fileno()
+            if count is None:
+                count = max(os.fstat(fileno).st_size - offset, 0)
+
+            ## everything written before must be in the socket before we use it directly
+            self._uv_wait_writes(0)
+            if self.uv_write_error is not None:
+                error, self.uv_write_error = self.uv_write_error, None
+                raise error
+
+            fd = self.uv_fd.fileno()
+            try:
+                while total_sent < count:
+                    try:
+                        sent = pyuv.fs.sendfile(self.uv_hub.uv_loop, fd, fileno,
+                                                offset + total_sent, count - total_sent)
+                    except pyuv.error.FSError, e:
+                        if e.args[0] == pyuv.errno.UV_EAGAIN:
+                            ## the socket is full: we cannot poll the fd of the TCP handle, so
+                            ## we queue the next block in the libuv stream and wait until it has
+                            ## been written, as libuv waits for the socket to be writable
+                            file.seek(offset + total_sent)
+                            data = file.read(min(BUFFER_SIZE * 16, count - total_sent))
+                            if not data:
+                                break
+                            self._uv_write([data], len(data), wait = False)
+                            self._uv_wait_writes(0)
+                            total_sent += len(data)
+                            continue
+                        elif total_sent == 0 and e.args[0] in (pyuv.errno.UV_EINVAL,
+                                                               pyuv.errno.UV_ENOSYS):
+                            ## sendfile() cannot be used with this file
+                            break
+                        raise last_socket_error(e.args[0], msg = 'sendfile error')
+                    if not sent:
+                        break               ## EOF
+                    total_sent += sent
+            finally:
+                file.seek(offset + total_sent)
+
+            if total_sent or count == 0:
+                return total_sent
+
+        file.seek(offset)
+        while count is None or total_sent < count:
+            blocksize = BUFFER_SIZE * 16
+            if count is not None:
+                blocksize = min(blocksize, count - total_sent)
+            data = file.read(blocksize)
+            if not data:
+                break
+            self.sendall(data)
+            total_sent += len(data)
+        return total_sent
 
     def sendto (self, *args):
         """
@@ -633,6 +1244,27 @@ class GreenSocket(object):
         return self._timeout
 
 
+class _GreenFileObject(_fileobject):
+    """
+    File object returned by GreenSocket.makefile(), that gets lines directly from the
+    socket receive buffer when it has nothing buffered by itself.
+    """
+
+    def readline (self, size = -1):
+        sock = self._sock
+        if self._rbuf.tell() == 0 and isinstance(sock, GreenSocket) and \
+                isinstance(sock.uv_handle, pyuv.TCP) and not sock.act_non_blocking:
+            return sock._recv_line(size)
+        return _fileobject.readline(self, size)
+
+    def writelines (self, seq):
+        ## unbuffered files send the lines in one vectored write
+        if self._wbufsize <= 1 and not self._wbuf and isinstance(self._sock, GreenSocket):
+            self._sock.sendv(map(str, seq))
+        else:
+            _fileobject.writelines(self, seq)
+
+
 def shutdown_safe (sock):
     """
     Shuts down the socket. This is a convenience method for
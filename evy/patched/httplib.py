@@ -44,5 +44,58 @@ patcher.inject('httplib',
                globals(),
                *to_patch)
 
+
+class PooledHTTPConnection(HTTPConnection):
+    """
+    A :class:`HTTPConnection` that borrows its socket from a
+    :class:`~evy.io.connections.ConnectionPool`.
+
+    When the connection is closed, the socket is returned to the pool if the last response
+    has been completely read and the server did not ask for closing the connection, so
+    the next connection to the same server can reuse it.
+    """
+
+    def __init__ (self, *args, **kwargs):
+        from evy.io.connections import default_pool
+
+        self.pool = kwargs.pop('pool', None)
+        if self.pool is None:
+            self.pool = default_pool
+        self._reusable = False
+        HTTPConnection.__init__(self, *args, **kwargs)
+
+    def connect (self):
+        if self._tunnel_host:
+            ## tunneled connections are not shared
+            HTTPConnection.connect(self)
+            return
+
+        timeout = self.timeout
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        self.sock = self.pool.get(self.host, self.port, timeout = timeout)
+        self.sock.settimeout(timeout)
+        self._reusable = False
+
+    def putrequest (self, *args, **kwargs):
+        self._reusable = False
+        HTTPConnection.putrequest(self, *args, **kwargs)
+
+    def getresponse (self, *args, **kwargs):
+        response = HTTPConnection.getresponse(self, *args, **kwargs)
+        self._reusable = not response.will_close
+        return response
+
+    def close (self):
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            response = self._HTTPConnection__response
+            if self._reusable and (response is None or response.isclosed()):
+                self.pool.put(sock)
+            else:
+                self.pool.discard(sock)
+            self._reusable = False
+        HTTPConnection.close(self)
+
 if __name__ == '__main__':
     test()
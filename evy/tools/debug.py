@@ -128,8 +128,9 @@ def format_hub_timers ():
 
     hub = hubs.get_hub()
     result = ['TIMERS:']
-    for l in hub.timers:
-        result.append(repr(l))
+    for _, _, l in hub.timers:
+        if not l.called:
+            result.append(repr(l))
     return os.linesep.join(result)
 
 
@@ -162,8 +163,10 @@ def hub_exceptions (state = True):
 
     hubs.get_hub().set_timer_exceptions(state)
     from evy.green import pools as greenpool
+    from evy.green import threads as greenthread
 
     greenpool.DEBUG = state
+    greenthread.DEBUG = state
 
 
 def tpool_exceptions (state = False):
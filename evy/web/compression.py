@@ -0,0 +1,168 @@
+#
+# Evy - a concurrent networking library for Python
+#
+# Unless otherwise noted, the files in Evy are under the following MIT license:
+#
+# Copyright (c) 2012, Alvaro Saurin
+# Copyright (c) 2008-2010, Eventlet Contributors (see AUTHORS)
+# Copyright (c) 2007-2010, Linden Research, Inc.
+# Copyright (c) 2005-2006, Bob Ippolito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+
+"""
+Compression of HTTP responses with the *gzip* and *deflate* content codings.
+
+The body is compressed as it is produced: every block given to a :class:`StreamCompressor`
+is compressed and flushed, so the client can start decompressing the response before it
+is complete, and the whole body is never kept in memory.
+"""
+
+import zlib
+
+__all__ = ['StreamCompressor', 'accepted_encoding', 'is_compressible',
+           'COMPRESSION_LEVEL', 'COMPRESSION_MIN_SIZE']
+
+
+## default compression level (1 is the fastest, 9 the smallest)
+COMPRESSION_LEVEL = 6
+
+## responses smaller than this (in bytes) are not compressed
+COMPRESSION_MIN_SIZE = 1024
+
+## types of content worth compressing (besides text/*, *+json and *+xml)
+COMPRESSIBLE_TYPES = frozenset((
+    'application/json',
+    'application/javascript',
+    'application/x-javascript',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/rss+xml',
+    'application/atom+xml',
+    'image/svg+xml',
+    ))
+
+## the zlib window bits for each content coding
+_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+    }
+
+## the preferred coding, when the client accepts both with the same quality
+_PREFERENCE = ('gzip', 'deflate')
+
+## Accept-Encoding headers already parsed
+_accepted = {}
+MAX_ACCEPTED = 256
+
+
+def accepted_encoding (accept_encoding):
+    """
+    Get the content coding to use for a response, given the *Accept-Encoding* header of
+    the request
+
+    :param accept_encoding: the value of the header (or None if it was not present)
+    :return: 'gzip', 'deflate' or None
+    """
+    if not accept_encoding:
+        return None
+    try:
+        return _accepted[accept_encoding]
+    except KeyError:
+        pass
+
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding] = quality
+
+    wildcard = qualities.get('*', 0.0)
+    best, best_quality = None, 0.0
+    for coding in _PREFERENCE:
+        quality = qualities.get(coding, wildcard)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+
+    if len(_accepted) >= MAX_ACCEPTED:
+        _accepted.clear()
+    _accepted[accept_encoding] = best
+    return best
+
+
+def is_compressible (content_type):
+    """
+    Check if a response with some *Content-Type* is worth compressing: text is, but images,
+    videos or archives are usually compressed already.
+
+    :param content_type: the value of the header (or None if it was not present)
+    """
+    if not content_type:
+        return False
+    mime = content_type.split(';', 1)[0].strip().lower()
+    return mime.startswith('text/') or mime in COMPRESSIBLE_TYPES or \
+           mime.endswith('+json') or mime.endswith('+xml')
+
+
+class StreamCompressor(object):
+    """
+    A compressor for a response body produced in blocks.
+
+    Each block is compressed and flushed (with a *sync flush*), so the data returned for it can
+    be sent immediately and decompressed by the client. The last block finishes the stream.
+    """
+
+    __slots__ = ['encoding', 'compressor', 'finished']
+
+    def __init__ (self, encoding, level = COMPRESSION_LEVEL):
+        """
+        :param encoding: the content coding: 'gzip' or 'deflate'
+        :param level: the compression level
+        """
+        self.encoding = encoding
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, _WBITS[encoding])
+        self.finished = False
+
+    def compress (self, data, last = False):
+        """
+        Compress a block of the body
+
+        :param data: the block
+        :param last: True for the last block
+        :return: the compressed data
+        """
+        if self.finished:
+            return data
+        compressor = self.compressor
+        if last:
+            self.finished = True
+            return compressor.compress(data) + compressor.flush()
+        if not data:
+            return ''
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
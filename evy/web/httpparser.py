@@ -0,0 +1,309 @@
+#
+# Evy - a concurrent networking library for Python
+#
+# Unless otherwise noted, the files in Evy are under the following MIT license:
+#
+# Copyright (c) 2012, Alvaro Saurin
+# Copyright (c) 2008-2010, Eventlet Contributors (see AUTHORS)
+# Copyright (c) 2007-2010, Linden Research, Inc.
+# Copyright (c) 2005-2006, Bob Ippolito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+"""
+Incremental parsers for the head (request line and headers) of HTTP/1.x requests, and for
+request bodies with the chunked transfer coding.
+"""
+
+MAX_REQUEST_LINE = 8192
+MAX_HEADER_LINE = 8192
+MAX_TOTAL_HEADER_SIZE = 65536
+MAX_CHUNK_LINE = 4096
+
+__all__ = ['HttpRequestParser', 'RequestHeaders', 'ChunkedDecoder',
+           'BadRequest', 'RequestLineTooLong', 'HeaderLineTooLong', 'HeadersTooLarge']
+
+
+class BadRequest(Exception):
+    pass
+
+
+class RequestLineTooLong(BadRequest):
+    pass
+
+
+class HeaderLineTooLong(BadRequest):
+    pass
+
+
+class HeadersTooLarge(BadRequest):
+    pass
+
+
+class HttpRequestParser(object):
+    """
+    An incremental parser for the head of a HTTP request.
+
+    The data is given to the parser with :meth:`feed` as it is received, in chunks of any size,
+    and the parser stops at the end of the headers, so the data after them (the body, or the
+    next request) is left to the caller. Lines are found with a single scan of each chunk, and
+    only the incomplete line at the end of a chunk is copied.
+
+    Once :attr:`done` is set, :attr:`requestline` has the request line (without the line
+    terminator) and :attr:`headers` is a list of *(name, value)* pairs, in the order they
+    were received.
+    """
+
+    __slots__ = ['max_request_line', 'max_header_line', 'max_total_header_size',
+                 'requestline', 'headers', 'header_size', 'done', '_partial']
+
+    def __init__ (self, max_request_line = MAX_REQUEST_LINE,
+                  max_header_line = MAX_HEADER_LINE,
+                  max_total_header_size = MAX_TOTAL_HEADER_SIZE):
+        """
+        :param max_request_line: the request line (including the line terminator) must be
+                                 shorter than this, or :class:`RequestLineTooLong` is raised
+        :param max_header_line: each header line must be shorter than this, or
+                                :class:`HeaderLineTooLong` is raised
+        :param max_total_header_size: maximum size of all the header lines together, or
+                                      :class:`HeadersTooLarge` is raised
+        """
+        self.max_request_line = max_request_line
+        self.max_header_line = max_header_line
+        self.max_total_header_size = max_total_header_size
+        self.requestline = None
+        self.headers = []
+        self.header_size = 0
+        self.done = False
+        self._partial = ''
+
+    def feed (self, data):
+        """
+        Parse some data
+
+        :param data: the data received
+        :return: the number of bytes of *data* used. This is less than the length of *data*
+                 only when the head of the request is complete, and the rest of the data
+                 belongs to the body (or to the next request)
+        :raises: :class:`BadRequest` (or one of its subclasses) if the request is not valid
+        """
+        if self.done:
+            return 0
+
+        partial = self._partial
+        if partial:
+            data = partial + data
+            self._partial = ''
+
+        pos = 0
+        find = data.find
+        while True:
+            end = find('\n', pos) + 1
+            if not end:
+                ## an incomplete line: check it now, so we do not accumulate huge lines
+                self._check(len(data) - pos)
+                self._partial = data[pos:]
+                return len(data) - len(partial)
+
+            self._check(end - pos)
+            line = data[pos:end]
+            pos = end
+            if self._line(line):
+                self.done = True
+                return pos - len(partial)
+
+    def _check (self, length):
+        if self.requestline is None:
+            if length >= self.max_request_line:
+                raise RequestLineTooLong()
+        else:
+            if length >= self.max_header_line:
+                raise HeaderLineTooLong()
+            if self.header_size + length > self.max_total_header_size:
+                raise HeadersTooLarge()
+
+    def _line (self, line):
+        if self.requestline is None:
+            line = line.rstrip('\r\n')
+            ## empty lines before the request line must be ignored (RFC 2616, section 4.1)
+            if line:
+                self.requestline = line
+            return False
+
+        self.header_size += len(line)
+        if line == '\r\n' or line == '\n':
+            return True
+
+        if line[0] in ' \t':
+            ## a continuation of the previous header
+            if not self.headers:
+                raise BadRequest('continuation line without header')
+            name, value = self.headers[-1]
+            self.headers[-1] = (name, value + ' ' + line.strip())
+            return False
+
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise BadRequest('invalid header line %r' % line)
+        self.headers.append((name.rstrip(), value.strip()))
+        return False
+
+
+## the states of the chunked decoder
+_CHUNK_SIZE, _CHUNK_DATA, _CHUNK_END, _CHUNK_TRAILER = range(4)
+
+
+class ChunkedDecoder(object):
+    """
+    An incremental decoder for request bodies with the chunked transfer coding.
+
+    Like :class:`HttpRequestParser`, the data is given to the decoder as it is received, in
+    chunks of any size, and it only uses the data that belongs to the body, so the rest (the
+    next request) is left to the caller. The body data is not copied: :meth:`decode` tells where
+    it is in the data given.
+
+    Chunk extensions and trailers are accepted, and ignored.
+    """
+
+    __slots__ = ['max_line', 'state', 'remaining', 'done', '_partial']
+
+    def __init__ (self, max_line = MAX_CHUNK_LINE):
+        """
+        :param max_line: the chunk size and trailer lines must be shorter than this, or
+                         :class:`BadRequest` is raised
+        """
+        self.max_line = max_line
+        self.state = _CHUNK_SIZE
+        self.remaining = 0
+        self.done = False
+        self._partial = ''
+
+    def wanted (self):
+        """
+        :return: the number of bytes of chunk data expected next, or None when a line (the size
+                 of a chunk, the end of a chunk or a trailer) is expected
+        """
+        if self.state == _CHUNK_DATA:
+            return self.remaining
+        return None
+
+    def decode (self, data, limit = None, readline = False):
+        """
+        Decode some data
+
+        :param data: the data received
+        :param limit: the maximum number of bytes of the body wanted, or None for no limit
+        :param readline: True if the body data must stop after a newline
+        :return: a tuple *(used, start, end)*, where *used* is the number of bytes of *data*
+                 used and ``data[start:end]`` is the body data found (empty if there is none)
+        :raises: :class:`BadRequest` if the data is not valid
+        """
+        pos = 0
+        while self.state != _CHUNK_DATA:
+            if self.done:
+                return pos, pos, pos
+
+            end = data.find('\n', pos) + 1
+            if not end:
+                ## an incomplete line: keep it for the next data
+                if len(self._partial) + len(data) - pos >= self.max_line:
+                    raise BadRequest('chunk line too long')
+                self._partial += data[pos:]
+                return len(data), len(data), len(data)
+
+            line = data[pos:end]
+            if self._partial:
+                line = self._partial + line
+                self._partial = ''
+            if len(line) >= self.max_line:
+                raise BadRequest('chunk line too long')
+            self._line(line)
+            pos = end
+
+        end = min(len(data), pos + self.remaining)
+        if limit is not None:
+            end = min(end, pos + limit)
+        if readline:
+            newline = data.find('\n', pos, end)
+            if newline >= 0:
+                end = newline + 1
+        self.remaining -= end - pos
+        if not self.remaining:
+            self.state = _CHUNK_END
+        return end, pos, end
+
+    def _line (self, line):
+        state = self.state
+        if state == _CHUNK_SIZE:
+            size = line.split(';', 1)[0].strip()
+            try:
+                self.remaining = int(size, 16)
+            except ValueError:
+                raise BadRequest('invalid chunk size %r' % size)
+            if self.remaining < 0:
+                raise BadRequest('invalid chunk size %r' % size)
+            self.state = self.remaining and _CHUNK_DATA or _CHUNK_TRAILER
+        elif state == _CHUNK_END:
+            if line.strip():
+                raise BadRequest('missing end of chunk')
+            self.state = _CHUNK_SIZE
+        elif line == '\r\n' or line == '\n':
+            self.done = True
+
+
+class RequestHeaders(dict):
+    """
+    The headers of a request, as a case-insensitive dictionary.
+
+    Values of repeated headers are joined with commas, but for the cookies, that are joined
+    with semicolons (RFC 6265, section 5.4). The methods of :class:`mimetools.Message`
+    used by request handlers (:meth:`getheader` and :meth:`get`) are provided.
+    """
+
+    def __init__ (self, headers = ()):
+        """
+        :param headers: a list of *(name, value)* pairs
+        """
+        dict.__init__(self)
+        for name, value in headers:
+            key = name.lower()
+            if key in self:
+                separator = '; ' if key == 'cookie' else ', '
+                dict.__setitem__(self, key, dict.__getitem__(self, key) + separator + value)
+            else:
+                dict.__setitem__(self, key, value)
+
+    def __getitem__ (self, name):
+        return dict.__getitem__(self, name.lower())
+
+    def __setitem__ (self, name, value):
+        dict.__setitem__(self, name.lower(), value)
+
+    def __delitem__ (self, name):
+        dict.__delitem__(self, name.lower())
+
+    def __contains__ (self, name):
+        return dict.__contains__(self, name.lower())
+
+    def get (self, name, default = None):
+        return dict.get(self, name.lower(), default)
+
+    getheader = get
@@ -0,0 +1,153 @@
+#
+# Evy - a concurrent networking library for Python
+#
+# Unless otherwise noted, the files in Evy are under the following MIT license:
+#
+# Copyright (c) 2012, Alvaro Saurin
+# Copyright (c) 2008-2010, Eventlet Contributors (see AUTHORS)
+# Copyright (c) 2007-2010, Linden Research, Inc.
+# Copyright (c) 2005-2006, Bob Ippolito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+
+"""
+Metrics of a WSGI server: latency histograms and counters, cheap enough to be always on.
+"""
+
+import bisect
+
+__all__ = ['Histogram', 'ServerMetrics', 'LATENCY_BUCKETS']
+
+
+## upper bounds (in seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """
+    A histogram with fixed buckets.
+
+    Every observation increments the counter of the first bucket with an upper bound not
+    lower than the value (or the last bucket, for values above all the bounds), so updates
+    take constant time and the histogram never grows.
+    """
+
+    __slots__ = ['bounds', 'counts', 'count', 'sum']
+
+    def __init__ (self, bounds = LATENCY_BUCKETS):
+        """
+        :param bounds: the upper bounds of the buckets, in increasing order. An extra bucket is
+                       kept for the values above the last bound.
+        """
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add (self, value):
+        """
+        Add an observation
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile (self, percent):
+        """
+        Get (an upper bound of) a percentile of the values observed
+
+        :param percent: the percentile, from 0 to 100
+        :return: the bound of the bucket where the percentile is, None if there are no
+                 observations or float('inf') if it is above all the bounds
+        """
+        if not self.count:
+            return None
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return float('inf')
+
+    def snapshot (self):
+        """
+        :return: a dictionary with the buckets (as *[bound, count]* pairs, with None as the
+                 bound of the last bucket), the number of observations and their sum
+        """
+        buckets = [[bound, count] for bound, count in zip(self.bounds, self.counts)]
+        buckets.append([None, self.counts[-1]])
+        return {'buckets': buckets, 'count': self.count, 'sum': self.sum}
+
+
+class ServerMetrics(object):
+    """
+    The metrics of a WSGI server, updated by the requests handlers.
+    """
+
+    def __init__ (self, bounds = LATENCY_BUCKETS):
+        self.request_duration = Histogram(bounds)   # from the request head to the response end
+        self.first_byte = Histogram(bounds)         # from the request head to the status line
+        self.accept_latency = Histogram(bounds)     # from accept() to the handler start
+
+        self.connections = 0                        # connections handled
+        self.requests = 0                           # requests received
+        self.keepalive_requests = 0                 # requests received in reused connections
+        self.bytes_in = 0                           # bytes of request heads and bodies read
+        self.bytes_out = 0                          # bytes of responses written
+
+        ## responses by status class (1xx to 5xx), and errors by status code
+        self.status_classes = [0] * 6
+        self.errors = {}
+
+    def add_status (self, status):
+        """
+        Count a response with a *status* code (an integer or a string starting with it)
+        """
+        try:
+            code = int(str(status)[:3])
+        except ValueError:
+            return
+        code_class = code // 100
+        if 1 <= code_class <= 5:
+            self.status_classes[code_class] += 1
+            if code_class >= 4:
+                self.errors[code] = self.errors.get(code, 0) + 1
+
+    def snapshot (self):
+        """
+        :return: a dictionary with all the metrics
+        """
+        classes = self.status_classes
+        return {
+            'connections': self.connections,
+            'requests': self.requests,
+            'keepalive_requests': self.keepalive_requests,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'responses': dict(('%dxx' % i, classes[i]) for i in range(1, 6)),
+            'errors': dict((str(code), count) for code, count in self.errors.iteritems()),
+            'request_duration': self.request_duration.snapshot(),
+            'first_byte': self.first_byte.snapshot(),
+            'accept_latency': self.accept_latency.snapshot(),
+            }
@@ -0,0 +1,367 @@
+#
+# Evy - a concurrent networking library for Python
+#
+# Unless otherwise noted, the files in Evy are under the following MIT license:
+#
+# Copyright (c) 2012, Alvaro Saurin
+# Copyright (c) 2008-2010, Eventlet Contributors (see AUTHORS)
+# Copyright (c) 2007-2010, Linden Research, Inc.
+# Copyright (c) 2005-2006, Bob Ippolito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""
+A pre-fork supervisor for the WSGI server.
+
+The supervisor binds the listening socket once and forks some worker processes, each one with its
+own hub running a :func:`evy.web.wsgi.server` loop::
+
+    from evy.web import prefork
+
+    prefork.Supervisor(('', 8080), app, workers = 4).run()
+
+Workers that die are restarted. On SIGHUP, a new set of workers is started and the old ones are
+stopped gracefully: they stop accepting connections and finish the requests in progress. SIGTERM
+(or SIGINT) stops the supervisor and all its workers.
+
+With *reuse_port*, each worker listens on its own socket with SO_REUSEPORT (Linux 3.9 or later),
+so the kernel spreads the new connections among the workers instead of waking all of them for
+every connection.
+"""
+
+import errno
+import fcntl
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from evy import event
+from evy import hubs
+from evy.green.pools import GreenPool
+from evy.green.threads import spawn, spawn_n, kill
+from evy.io.sockets import GreenSocket
+from evy.support import greenlets as greenlet
+from evy.timeout import Timeout
+from evy.web import wsgi
+
+
+__all__ = ['Supervisor']
+
+
+## time (in seconds) stopped workers have for finishing the requests in progress
+GRACEFUL_TIMEOUT = 30.0
+
+## minimum time (in seconds) before restarting workers that die right after being started
+RESPAWN_DELAY = 1.0
+
+## how often (in seconds) the supervisor checks its workers when no signal wakes it up
+CHECK_INTERVAL = 1.0
+
+## SO_REUSEPORT is not defined in the socket module of Python 2, and we only know its value
+## in Linux: reuse_port cannot be used in other platforms when it is not defined
+if hasattr(socket, 'SO_REUSEPORT'):
+    SO_REUSEPORT = socket.SO_REUSEPORT
+elif sys.platform.startswith('linux'):
+    SO_REUSEPORT = 15
+else:
+    SO_REUSEPORT = None
+
+
+def _cpu_count ():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+class Supervisor(object):
+    """
+    Run a WSGI application in several worker processes, sharing the same listening address.
+
+    The supervisor process does not use the hub: it just forks the workers, waits for signals and
+    restarts the workers that die.
+    """
+
+    def __init__ (self, address, site,
+                  workers = None,
+                  reuse_port = False,
+                  backlog = 50,
+                  graceful_timeout = GRACEFUL_TIMEOUT,
+                  log = None,
+                  **server_args):
+        """
+        :param address: the (host, port) address to listen on
+        :param site: the WSGI application
+        :param workers: the number of worker processes (by default, the number of CPUs)
+        :param reuse_port: if True, each worker listens on its own socket with SO_REUSEPORT
+        :param backlog: the listen backlog
+        :param graceful_timeout: maximum time (in seconds) stopped workers wait for the requests
+                                 in progress
+        :param log: file-like object for the supervisor and the servers logs (by default,
+                    sys.stderr)
+        :param server_args: other arguments for :func:`evy.web.wsgi.server` (ie, *max_size*)
+        :raise ValueError: if *reuse_port* is used in a platform without SO_REUSEPORT
+        """
+        if reuse_port and SO_REUSEPORT is None:
+            raise ValueError('SO_REUSEPORT is not supported in this platform')
+
+        self.address = address
+        self.site = site
+        self.num_workers = workers or _cpu_count()
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.graceful_timeout = graceful_timeout
+        self.log = log or sys.stderr
+        self.server_args = server_args
+
+        self.sock = None
+        self.workers = {}                   # pid -> (generation, start time)
+        self.generation = 0
+        self.respawn_after = 0
+        self.stopping = False
+        self.reloading = False
+
+    def bind (self):
+        """
+        Bind the listening socket. This is done by :meth:`run` if it has not been done before.
+
+        :return: the address we are bound to (ie, with the real port when binding to port 0)
+        """
+        if ':' in self.address[0]:
+            family = socket.AF_INET6
+        else:
+            family = socket.AF_INET
+
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind(self.address)
+        if not self.reuse_port:
+            sock.listen(self.backlog)
+        ## with reuse_port, this socket does not listen: it just keeps the port for the workers
+
+        self.sock = sock
+        self.address = sock.getsockname()
+        return self.address
+
+    def run (self):
+        """
+        Start the workers and supervise them until the supervisor is stopped
+        """
+        if self.sock is None:
+            self.bind()
+
+        previous_handlers = {}
+        for signum, handler in ((signal.SIGHUP, self._reload_handler),
+                                (signal.SIGTERM, self._stop_handler),
+                                (signal.SIGINT, self._stop_handler),
+                                (signal.SIGCHLD, self._child_handler)):
+            previous_handlers[signum] = signal.signal(signum, handler)
+
+        self.log.write("(%s) supervisor starting %d workers on %s:%s\n" % (
+            os.getpid(), self.num_workers, self.address[0], self.address[1]))
+        try:
+            while not self.stopping:
+                self._reap_workers()
+                if self.reloading:
+                    self.reloading = False
+                    self._reload_workers()
+                self._spawn_workers()
+                ## signals interrupt this sleep
+                time.sleep(CHECK_INTERVAL)
+        finally:
+            self._stop_workers()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+            self.sock.close()
+            self.sock = None
+            self.log.write("(%s) supervisor exiting\n" % os.getpid())
+
+    def stop (self):
+        """
+        Stop the supervisor (and all the workers)
+        """
+        self.stopping = True
+
+    def reload (self):
+        """
+        Replace all the workers with new ones
+        """
+        self.reloading = True
+
+    def _stop_handler (self, signum, frame):
+        self.stop()
+
+    def _reload_handler (self, signum, frame):
+        self.reload()
+
+    def _child_handler (self, signum, frame):
+        pass
+
+    def _signal_worker (self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _reap_workers (self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                elif e.errno == errno.ECHILD:
+                    self.workers.clear()
+                    break
+                raise
+
+            if not pid:
+                break
+
+            generation, started = self.workers.pop(pid, (None, None))
+            if generation == self.generation and not self.stopping:
+                self.log.write("(%s) worker %s died with status %s: restarting it\n" % (
+                    os.getpid(), pid, status))
+                ## do not restart workers in a loop if they die while starting
+                if time.time() - started < RESPAWN_DELAY:
+                    self.respawn_after = time.time() + RESPAWN_DELAY
+
+    def _spawn_workers (self):
+        if time.time() < self.respawn_after:
+            return
+        current = [pid for pid, (generation, _) in self.workers.items()
+                   if generation == self.generation]
+        for i in xrange(self.num_workers - len(current)):
+            self._spawn_worker()
+
+    def _reload_workers (self):
+        self.log.write("(%s) supervisor reloading workers\n" % os.getpid())
+        old_workers = self.workers.keys()
+        self.generation += 1
+        self.respawn_after = 0
+        self._spawn_workers()
+        for pid in old_workers:
+            self._signal_worker(pid, signal.SIGTERM)
+
+    def _stop_workers (self):
+        self.stopping = True
+        for pid in self.workers:
+            self._signal_worker(pid, signal.SIGTERM)
+
+        deadline = time.time() + self.graceful_timeout
+        while self.workers and time.time() < deadline:
+            self._reap_workers()
+            if self.workers:
+                time.sleep(0.1)
+
+        for pid in self.workers:
+            self._signal_worker(pid, signal.SIGKILL)
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.workers.clear()
+
+    def _spawn_worker (self):
+        ## do not let the workers inherit anything buffered
+        self.log.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                self._run_worker()
+            except:
+                traceback.print_exc()
+                status = 1
+            try:
+                self.log.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(status)
+
+        self.workers[pid] = (self.generation, time.time())
+        return pid
+
+    def _run_worker (self):
+        """
+        The worker process: run a server loop until SIGTERM, and then wait for the requests in
+        progress
+        """
+        for signum in (signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        ## the supervisor stops its workers (ie, on a Ctrl-C in a terminal)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        hubs.reinit_hub()
+
+        if self.reuse_port:
+            listener = socket.socket(self.sock.family, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            listener.bind(self.address)
+            listener.listen(self.backlog)
+            self.sock.close()
+        else:
+            listener = self.sock
+
+        ## a SIGTERM wakes up the hub by writing in this pipe
+        stop_r, stop_w = os.pipe()
+        for fd in (stop_r, stop_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.set_wakeup_fd(stop_w)
+        signal.signal(signal.SIGTERM, lambda signum, frame: None)
+
+        server_args = dict(self.server_args)
+        pool = GreenPool(server_args.pop('max_size', wsgi.DEFAULT_MAX_SIMULTANEOUS_REQUESTS))
+        ## we need the Server for stopping it, so the server_event is ours
+        user_server_event = server_args.pop('server_event', None)
+        server_event = event.Event()
+        if user_server_event is not None:
+            spawn_n(lambda: user_server_event.send(server_event.wait()))
+        server = spawn(wsgi.server, GreenSocket(listener), self.site,
+                       log = self.log, custom_pool = pool, server_event = server_event,
+                       **server_args)
+
+        def wait_for_stop ():
+            hubs.wait_read(stop_r)
+            kill(server)
+
+        spawn_n(wait_for_stop)
+        try:
+            server.wait()
+        except greenlet.GreenletExit:
+            pass
+
+        ## the listening socket has been closed: close the idle keep-alive connections (and the
+        ## connections of the requests in progress, once they are done) and finish the requests
+        ## in progress
+        serv = server_event.poll()
+        if serv is not None:
+            serv.keepalive = False
+            serv.reap_idle_connections(len(serv.idle_connections))
+        with Timeout(self.graceful_timeout, False):
+            pool.waitall()
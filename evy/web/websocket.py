@@ -27,25 +27,241 @@
 # THE SOFTWARE.
 #
 
+import array
+import base64
 import collections
 import errno
 import string
 import struct
+import zlib
 from socket import error as SocketError
 
 try:
-    from hashlib import md5
+    from hashlib import md5, sha1
 except ImportError: #pragma NO COVER
     from md5 import md5
+    from sha import sha as sha1
 
 from evy import semaphore
+from evy.hubs import get_hub
+from evy.green.threads import spawn_n
+from evy.support import greenlets as greenlet
 from evy.web import wsgi
+from evy.web.compression import COMPRESSION_LEVEL
 from evy.patched import socket
 from evy.support import get_errno
 
 ACCEPTABLE_CLIENT_ERRORS = set((errno.ECONNRESET, errno.EPIPE))
 
-__all__ = ["WebSocketWSGI", "WebSocket"]
+__all__ = ["WebSocketWSGI", "WebSocket", "RFC6455WebSocket", "BroadcastGroup"]
+
+## the GUID used for the handshake in RFC 6455
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+## versions of the protocol spoken with the Sec-WebSocket-Version header
+RFC6455_VERSIONS = ('13', '8', '7')
+
+## maximum size of a message received (or the connection is closed)
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+## size of the reads from the socket
+RECV_SIZE = 65536
+
+## opcodes
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+## status codes of close frames
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_UNSUPPORTED = 1003
+CLOSE_INVALID_DATA = 1007
+CLOSE_TOO_BIG = 1009
+
+## default limit of the data queued for a member of a broadcast group (in bytes)
+BROADCAST_MAX_QUEUED = 1024 * 1024
+
+## what is done with the members of a broadcast group that cannot keep up
+SLOW_DROP = 'drop'              # they are removed from the group, and disconnected
+SLOW_COALESCE = 'coalesce'      # the messages they have queued are replaced by the newest one
+
+## the reserved bit used by permessage-deflate for the first frame of a compressed message
+RSV1 = 0x40
+
+## messages smaller than this (in bytes) are not compressed
+DEFLATE_MIN_SIZE = 64
+
+## the tail removed from (and added to) compressed messages
+DEFLATE_TAIL = '\x00\x00\xff\xff'
+
+## maximum number of idle zlib contexts kept (for every level and window size)
+ZLIB_POOL_SIZE = 32
+
+## size of the machine words used for unmasking
+_WORD_SIZE = array.array('L').itemsize
+
+
+def unmask (data, mask):
+    """
+    Unmask (or mask) the payload of a frame, XOR-ing it with the 4 bytes of the *mask*.
+
+    The payload is processed as an array of machine words, so the XOR is done 8 (or 4) bytes
+    at a time instead of byte by byte.
+
+    :param data: the payload
+    :param mask: the masking key
+    :return: the unmasked payload
+    """
+    length = len(data)
+    if not length:
+        return data
+    padding = -length % _WORD_SIZE
+    if padding:
+        data += '\x00' * padding
+    words = array.array('L', data)
+    key = array.array('L', mask * (_WORD_SIZE // 4))[0]
+    words = array.array('L', [word ^ key for word in words])
+    if padding:
+        return words.tostring()[:length]
+    return words.tostring()
+
+
+class ProtocolError(ValueError):
+    """
+    The peer has sent something that is not valid: the connection must be closed with the
+    status *code*
+    """
+
+    def __init__ (self, message, code = CLOSE_PROTOCOL_ERROR):
+        ValueError.__init__(self, message)
+        self.code = code
+
+
+## idle zlib contexts, shared by the connections without context takeover
+_zlib_pool = collections.defaultdict(list)
+
+
+def _get_zlib (key):
+    pool = _zlib_pool[key]
+    if pool:
+        return pool.pop()
+    if key[0] == 'c':
+        return zlib.compressobj(key[1], zlib.DEFLATED, -key[-1])
+    return zlib.decompressobj(-key[-1])
+
+
+def _put_zlib (key, context):
+    pool = _zlib_pool[key]
+    if len(pool) < ZLIB_POOL_SIZE:
+        pool.append(context)
+
+
+class PerMessageDeflate(object):
+    """
+    The state of the permessage-deflate extension (RFC 7692) negotiated for a connection.
+
+    With context takeover, the connection owns its zlib contexts, so messages can refer to the
+    data of previous messages. Without it, every message is compressed (or decompressed) on its
+    own with a context taken from a pool shared by all the connections, and it is returned
+    to the pool once the message is done, so idle connections do not keep any zlib memory.
+    """
+
+    def __init__ (self, level = COMPRESSION_LEVEL, server_window_bits = 15,
+                  client_window_bits = 15, server_takeover = True, client_takeover = True,
+                  min_size = DEFLATE_MIN_SIZE):
+        """
+        :param level: the zlib compression level
+        :param server_window_bits: the size of the window used for compressing (9 to 15)
+        :param client_window_bits: the size of the window the client uses for compressing
+        :param server_takeover: True if the compression context is kept between messages
+        :param client_takeover: True if the decompression context is kept between messages
+        :param min_size: messages smaller than this (in bytes) are not compressed
+        """
+        self.level = level
+        self.server_window_bits = server_window_bits
+        self.client_window_bits = client_window_bits
+        self.server_takeover = server_takeover
+        self.client_takeover = client_takeover
+        self.min_size = min_size
+
+        self.compress_key = ('c', level, server_window_bits)
+        ## zlib does not support windows of 256 bytes, but a bigger window can decompress anything
+        self.decompress_key = ('d', max(client_window_bits, 9))
+        self.compressor = server_takeover and _get_zlib(self.compress_key) or None
+        self.decompressor = client_takeover and _get_zlib(self.decompress_key) or None
+
+    def compress (self, data):
+        """
+        Compress the payload of a message
+        """
+        compressor = self.compressor
+        if compressor is not None:
+            data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            ## a full flush forgets the data compressed, so the context can be reused for any
+            ## other connection
+            compressor = _get_zlib(self.compress_key)
+            data = compressor.compress(data) + compressor.flush(zlib.Z_FULL_FLUSH)
+            _put_zlib(self.compress_key, compressor)
+        if data.endswith(DEFLATE_TAIL):
+            data = data[:-4]
+        return data
+
+    def decompress (self, data, max_size):
+        """
+        Decompress the payload of a message
+
+        :param max_size: the maximum size of the message, once decompressed
+        :raises: :class:`ProtocolError` if the data is not valid or it is too big
+        """
+        decompressor = self.decompressor
+        if decompressor is None:
+            decompressor = _get_zlib(self.decompress_key)
+        try:
+            data = decompressor.decompress(data + DEFLATE_TAIL, max_size + 1)
+        except zlib.error:
+            raise ProtocolError('invalid compressed data', CLOSE_INVALID_DATA)
+        if len(data) > max_size:
+            raise ProtocolError('message too big', CLOSE_TOO_BIG)
+        if decompressor.unused_data:
+            ## the client has ended the deflate stream, so the context cannot be used any more
+            if self.decompressor is not None:
+                self.decompressor = zlib.decompressobj(-self.decompress_key[1])
+        elif self.decompressor is None:
+            _put_zlib(self.decompress_key, decompressor)
+        return data
+
+
+def _parse_extensions (header):
+    """
+    Parse a Sec-WebSocket-Extensions header, returning a list of *(name, params)* offers,
+    where *params* is a list of *(name, value)* pairs (with None for the params without
+    a value)
+    """
+    offers = []
+    for offer in header.split(','):
+        parts = offer.split(';')
+        name = parts[0].strip().lower()
+        if not name:
+            continue
+        params = []
+        for param in parts[1:]:
+            param_name, eq, value = param.partition('=')
+            params.append((param_name.strip().lower(), eq and value.strip().strip('"') or None))
+        offers.append((name, params))
+    return offers
+
+
+def _window_bits (value):
+    if value is None or not value.isdigit() or not 8 <= int(value) <= 15:
+        return None
+    return int(value)
+
 
 class WebSocketWSGI(object):
     """
@@ -59,16 +275,48 @@ class WebSocketWSGI(object):
           ws.send("from server")
 
     The single argument to the function will be an instance of
-    :class:`WebSocket`.  To close the socket, simply return from the
+    :class:`RFC6455WebSocket` for the clients that speak RFC 6455, or
+    :class:`WebSocket` for the older hixie-75/76 drafts.  To close the socket, simply return from the
     function.  Note that the server will log the websocket request at
     the time of closure.
+
+    The permessage-deflate extension can be enabled for the RFC 6455 clients that offer it::
+
+      app = websocket.WebSocketWSGI(my_handler, compression = True)
+
+    With *compression_context_takeover* disabled, messages are compressed on their own, without
+    referring to previous messages: the compression ratio is worse, but connections do not keep
+    any zlib context between messages.
     """
 
-    def __init__ (self, handler):
+    def __init__ (self, handler, compression = False, compression_level = COMPRESSION_LEVEL,
+                  compression_window_bits = 15, compression_context_takeover = True,
+                  compression_min_size = DEFLATE_MIN_SIZE):
+        """
+        :param handler: the websocket handler
+        :param compression: if True, the permessage-deflate extension is accepted when the
+                            client offers it
+        :param compression_level: the zlib compression level, from 1 (fastest) to 9 (smallest)
+        :param compression_window_bits: the maximum size of the compression windows
+                                        (from 9 to 15), for messages sent and received
+        :param compression_context_takeover: if False, the compression contexts are not kept
+                                             between messages (in both directions)
+        :param compression_min_size: messages smaller than this (in bytes) are not compressed
+        """
+        if not 9 <= compression_window_bits <= 15:
+            raise ValueError('invalid window bits %r' % compression_window_bits)
         self.handler = handler
         self.protocol_version = None
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_window_bits = compression_window_bits
+        self.compression_context_takeover = compression_context_takeover
+        self.compression_min_size = compression_min_size
 
     def __call__ (self, environ, start_response):
+        if 'HTTP_SEC_WEBSOCKET_VERSION' in environ:
+            return self._handle_rfc6455(environ, start_response)
+
         if not (environ.get('HTTP_CONNECTION') == 'Upgrade' and
                 environ.get('HTTP_UPGRADE') == 'WebSocket'):
             # need to check a few more things here for true compliance
@@ -137,6 +385,9 @@ class WebSocketWSGI(object):
             raise ValueError("Unknown WebSocket protocol version.")
 
         sock.sendall(handshake_reply)
+        return self._run_handler(ws)
+
+    def _run_handler (self, ws):
         try:
             self.handler(ws)
         except socket.error, e:
@@ -148,6 +399,98 @@ class WebSocketWSGI(object):
         # doesn't barf on the fact that we didn't call start_response
         return wsgi.ALREADY_HANDLED
 
+    def _handle_rfc6455 (self, environ, start_response):
+        connection = [token.strip().lower() for token in
+                      environ.get('HTTP_CONNECTION', '').split(',')]
+        key = environ.get('HTTP_SEC_WEBSOCKET_KEY')
+        if not ('upgrade' in connection and
+                environ.get('HTTP_UPGRADE', '').lower() == 'websocket' and key):
+            start_response('400 Bad Request', [('Connection', 'close')])
+            return []
+        if environ['HTTP_SEC_WEBSOCKET_VERSION'] not in RFC6455_VERSIONS:
+            start_response('426 Upgrade Required', [('Connection', 'close'),
+                                                    ('Sec-WebSocket-Version', '13')])
+            return []
+
+        deflate = extensions = None
+        if self.compression and 'HTTP_SEC_WEBSOCKET_EXTENSIONS' in environ:
+            deflate, extensions = self._negotiate_deflate(environ['HTTP_SEC_WEBSOCKET_EXTENSIONS'])
+
+        self.protocol_version = 13
+        sock = environ['evy.input'].get_socket()
+        ws = RFC6455WebSocket(sock, environ, self.protocol_version, deflate = deflate)
+
+        accept = base64.b64encode(sha1(key.strip() + WS_GUID).digest())
+        reply = ["HTTP/1.1 101 Switching Protocols\r\n"
+                 "Upgrade: websocket\r\n"
+                 "Connection: Upgrade\r\n"
+                 "Sec-WebSocket-Accept: %s\r\n" % accept]
+        if extensions:
+            reply.append("Sec-WebSocket-Extensions: %s\r\n" % extensions)
+        reply.append("\r\n")
+        sock.sendall(''.join(reply))
+        return self._run_handler(ws)
+
+    def _negotiate_deflate (self, header):
+        """
+        Accept the first valid permessage-deflate offer of a Sec-WebSocket-Extensions header
+
+        :return: a *(deflate, response)* tuple, where *deflate* is the
+                 :class:`PerMessageDeflate` for the connection, and *response* is the value of
+                 the Sec-WebSocket-Extensions header in the response (or *(None, None)*)
+        """
+        for name, params in _parse_extensions(header):
+            if name == 'permessage-deflate':
+                accepted = self._accept_deflate(params)
+                if accepted is not None:
+                    return accepted
+        return None, None
+
+    def _accept_deflate (self, params):
+        names = [name for name, value in params]
+        if len(set(names)) != len(names):
+            return None
+        params = dict(params)
+
+        takeover = self.compression_context_takeover
+        server_takeover = takeover and 'server_no_context_takeover' not in params
+        client_takeover = takeover and 'client_no_context_takeover' not in params
+        server_bits = self.compression_window_bits
+        client_bits = 15
+
+        for name, value in params.iteritems():
+            if name == 'server_max_window_bits':
+                bits = _window_bits(value)
+                if bits is None:
+                    return None
+                server_bits = min(server_bits, bits)
+            elif name == 'client_max_window_bits':
+                if value is not None:
+                    client_bits = _window_bits(value)
+                    if client_bits is None:
+                        return None
+                client_bits = min(client_bits, self.compression_window_bits)
+            elif name not in ('server_no_context_takeover', 'client_no_context_takeover'):
+                return None
+
+        ## zlib cannot compress with a window of 256 bytes
+        if server_bits < 9:
+            return None
+
+        response = ['permessage-deflate']
+        if not server_takeover:
+            response.append('server_no_context_takeover')
+        if not client_takeover:
+            response.append('client_no_context_takeover')
+        if server_bits < 15:
+            response.append('server_max_window_bits=%d' % server_bits)
+        if client_bits < 15:
+            response.append('client_max_window_bits=%d' % client_bits)
+
+        deflate = PerMessageDeflate(self.compression_level, server_bits, client_bits,
+                                    server_takeover, client_takeover, self.compression_min_size)
+        return deflate, '; '.join(response)
+
     def _extract_number (self, value):
         """
         Utility function which, given a string like 'g98sd  5[]221@1', will
@@ -183,6 +526,9 @@ class WebSocket(object):
 
     """
 
+    ## websockets with the same key encode messages in the same way (see :class:`BroadcastGroup`)
+    encoding_key = 'hixie'
+
     def __init__ (self, sock, environ, version = 76):
         """
         :param socket: The evy socket
@@ -222,27 +568,52 @@ class WebSocket(object):
         Returns an array of messages, and the buffer remainder that
         didn't contain any full messages."""
         msgs = []
-        end_idx = 0
         buf = self._buf
-        while buf:
-            frame_type = ord(buf[0])
+        pos = 0
+        ## messages are found with an offset, so the buffer is only sliced once at the end
+        while pos < len(buf):
+            frame_type = ord(buf[pos])
             if frame_type == 0:
                 # Normal message.
-                end_idx = buf.find("\xFF")
+                end_idx = buf.find("\xFF", pos)
                 if end_idx == -1: #pragma NO COVER
                     break
-                msgs.append(buf[1:end_idx].decode('utf-8', 'replace'))
-                buf = buf[end_idx + 1:]
+                msgs.append(buf[pos + 1:end_idx].decode('utf-8', 'replace'))
+                pos = end_idx + 1
             elif frame_type == 255:
                 # Closing handshake.
-                assert ord(buf[1]) == 0, "Unexpected closing handshake: %r" % buf
+                assert ord(buf[pos + 1]) == 0, "Unexpected closing handshake: %r" % buf[pos:]
                 self.websocket_closed = True
                 break
             else:
-                raise ValueError("Don't understand how to parse this type of message: %r" % buf)
-        self._buf = buf
+                raise ValueError("Don't understand how to parse this type of message: %r" %
+                                 buf[pos:])
+        self._buf = buf[pos:] if pos else buf
         return msgs
 
+    def encode_message (self, message, binary = False):
+        """
+        Get the data sent to the client for a message, as a single string
+        """
+        return self._pack_message(message)
+
+    def _send_frames (self, frames):
+        ## send some frames with a single (vectored, when possible) write
+        # if two greenthreads are trying to send at the same time
+        # on the same socket, sendlock prevents interleaving and corruption
+        self._sendlock.acquire()
+        try:
+            self._write_frames(frames)
+        finally:
+            self._sendlock.release()
+
+    def _write_frames (self, frames):
+        sendv = getattr(self.socket, 'sendv', None)
+        if sendv is not None and len(frames) > 1:
+            sendv(frames)
+        else:
+            self.socket.sendall(''.join(frames))
+
     def send (self, message):
         """Send a message to the browser.  
         
@@ -297,3 +668,480 @@ class WebSocket(object):
         self.socket.shutdown(True)
         self.socket.close()
 
+
+
+class RFC6455WebSocket(WebSocket):
+    """
+    A websocket speaking the protocol of RFC 6455, with the same interface as :class:`WebSocket`.
+
+    Frames are parsed from a single buffer, with an offset, so the buffer is only copied
+    when a new frame is incomplete. The data of big frames is accumulated and joined once, when
+    the frame is complete. Payloads are unmasked a machine word at a time.
+
+    Fragmented messages are reassembled, and control frames are handled as they are received:
+    pings are answered with pongs, and a close frame is answered with another close frame,
+    and then :meth:`wait` returns None. Text messages are returned as unicode objects, and
+    binary messages as strings.
+
+    When the permessage-deflate extension has been negotiated, the messages received are
+    decompressed, and the messages sent are compressed unless they are too small.
+    """
+
+    max_message_size = MAX_MESSAGE_SIZE
+    encoding_key = 'rfc6455'
+
+    def __init__ (self, sock, environ, version = 13, deflate = None):
+        """
+        :param socket: The evy socket
+        :type socket: :class:`evy.io.sockets.GreenSocket`
+        :param environ: The wsgi environment
+        :param version: The version of the protocol, from the Sec-WebSocket-Version header
+        :param deflate: the :class:`PerMessageDeflate` negotiated, or None
+        """
+        WebSocket.__init__(self, sock, environ, version)
+        self.protocol = environ.get('HTTP_SEC_WEBSOCKET_PROTOCOL')
+        self.close_code = None
+        self.deflate = deflate
+        if deflate is not None:
+            if deflate.server_takeover:
+                ## messages depend on the previous messages sent to this client
+                self.encoding_key = None
+            else:
+                self.encoding_key = ('rfc6455-deflate', deflate.level,
+                                     deflate.server_window_bits, deflate.min_size)
+
+        self._pos = 0                   # offset of the next frame in the buffer
+        self._needed = 2                # bytes needed (from the offset) for the next frame
+        self._pending = []              # data received while the next frame is incomplete
+        self._pending_size = 0
+        self._fragments = []            # payloads of a fragmented message
+        self._fragments_size = 0
+        self._fragments_opcode = None
+        self._fragments_compressed = False
+        self._close_sent = False
+        self._close_received = False
+
+    def _feed (self, data):
+        ## keep the data until the next frame is complete, and then join it (once) with the
+        ## rest of the buffer
+        self._pending.append(data)
+        self._pending_size += len(data)
+        buf, pos = self._buf, self._pos
+        if len(buf) - pos + self._pending_size < self._needed:
+            return False
+
+        pending = self._pending
+        if pos < len(buf):
+            pending.insert(0, buf[pos:] if pos else buf)
+        self._buf = len(pending) > 1 and ''.join(pending) or pending[0]
+        self._pos = 0
+        self._pending = []
+        self._pending_size = 0
+        return True
+
+    def _parse_frames (self):
+        buf = self._buf
+        pos = self._pos
+        end = len(buf)
+        unpack_from = struct.unpack_from
+        while not self._close_received:
+            available = end - pos
+            if available < 2:
+                self._needed = 2
+                break
+
+            b1 = ord(buf[pos])
+            b2 = ord(buf[pos + 1])
+            if not b2 & 0x80:
+                raise ProtocolError('unmasked frame from the client')
+            length = b2 & 0x7F
+            header = 6
+            if length == 126:
+                header = 8
+            elif length == 127:
+                header = 14
+            if available < header:
+                self._needed = header
+                break
+
+            if length == 126:
+                length = unpack_from('!H', buf, pos + 2)[0]
+            elif length == 127:
+                length = unpack_from('!Q', buf, pos + 2)[0]
+            if length + self._fragments_size > self.max_message_size:
+                raise ProtocolError('message too big', CLOSE_TOO_BIG)
+            if available < header + length:
+                self._needed = header + length
+                break
+
+            start = pos + header
+            payload = unmask(buf[start:start + length], buf[start - 4:start])
+            pos = self._pos = start + length
+            self._frame(b1, payload)
+        else:
+            self._needed = 2
+        self._pos = pos
+
+    def _check_reserved_bits (self, b1, opcode):
+        ## return True if the frame starts a compressed message
+        rsv = b1 & 0x70
+        if rsv == RSV1 and self.deflate is not None and (opcode == OP_TEXT or
+                                                         opcode == OP_BINARY):
+            return True
+        if rsv:
+            raise ProtocolError('reserved bits set without an extension')
+        return False
+
+    def _frame (self, b1, payload):
+        fin = b1 & 0x80
+        opcode = b1 & 0x0F
+        compressed = self._check_reserved_bits(b1, opcode)
+
+        if opcode >= OP_CLOSE:
+            if not fin or len(payload) > 125:
+                raise ProtocolError('invalid control frame')
+            if opcode == OP_PING:
+                self.pong(payload)
+            elif opcode == OP_CLOSE:
+                self._closing_frame_received(payload)
+            elif opcode != OP_PONG:
+                raise ProtocolError('unknown opcode %d' % opcode)
+            return
+
+        if opcode == OP_CONTINUATION:
+            if self._fragments_opcode is None:
+                raise ProtocolError('continuation frame without a message')
+        elif opcode == OP_TEXT or opcode == OP_BINARY:
+            if self._fragments_opcode is not None:
+                raise ProtocolError('new message before the end of the previous one')
+            if fin:
+                self._message(opcode, payload, compressed)
+                return
+            self._fragments_opcode = opcode
+            self._fragments_compressed = compressed
+        else:
+            raise ProtocolError('unknown opcode %d' % opcode)
+
+        self._fragments.append(payload)
+        self._fragments_size += len(payload)
+        if fin:
+            opcode = self._fragments_opcode
+            payload = ''.join(self._fragments)
+            self._fragments = []
+            self._fragments_size = 0
+            self._fragments_opcode = None
+            self._message(opcode, payload, self._fragments_compressed)
+
+    def _message (self, opcode, payload, compressed = False):
+        if compressed:
+            payload = self.deflate.decompress(payload, self.max_message_size)
+        if opcode == OP_TEXT:
+            try:
+                payload = payload.decode('utf-8')
+            except UnicodeDecodeError:
+                raise ProtocolError('invalid UTF-8 in a text message', CLOSE_INVALID_DATA)
+        self._msgs.append(payload)
+
+    def _closing_frame_received (self, payload):
+        if len(payload) == 1:
+            raise ProtocolError('invalid close frame')
+        self._close_received = True
+        self.close_code = payload and struct.unpack('!H', payload[:2])[0] or None
+        self._send_closing_frame(True, self.close_code or CLOSE_NORMAL)
+
+    @staticmethod
+    def _frame_header (opcode, length, rsv = 0):
+        """
+        Get the header of a (final, unmasked) frame
+        """
+        b1 = 0x80 | rsv | opcode
+        if length < 126:
+            return struct.pack('!BB', b1, length)
+        elif length < 65536:
+            return struct.pack('!BBH', b1, 126, length)
+        return struct.pack('!BBQ', b1, 127, length)
+
+    def _send_frame (self, opcode, payload, rsv = 0):
+        header = self._frame_header(opcode, len(payload), rsv)
+        if len(payload) > 1024:
+            ## big payloads are not copied
+            self._send_frames([header, payload])
+        else:
+            self._send_frames([header + payload])
+
+    def _send_frames (self, frames):
+        if self.deflate is None:
+            WebSocket._send_frames(self, frames)
+            return
+
+        ## the messages must be compressed in the same order they are sent, so the messages
+        ## queued as *(opcode, payload)* are compressed with the lock held
+        self._sendlock.acquire()
+        try:
+            data = []
+            for frame in frames:
+                if isinstance(frame, tuple):
+                    data.extend(self._encode(*frame))
+                else:
+                    data.append(frame)
+            self._write_frames(data)
+        finally:
+            self._sendlock.release()
+
+    def _encode (self, opcode, payload):
+        ## get the header and the payload of a message (compressed, if it is worth it)
+        rsv = 0
+        if len(payload) >= self.deflate.min_size:
+            payload = self.deflate.compress(payload)
+            rsv = RSV1
+        return self._frame_header(opcode, len(payload), rsv), payload
+
+    def encode_message (self, message, binary = False):
+        """
+        Get the data sent to the client for a message, as a single string.
+
+        When the message depends on the messages sent before (compression with context
+        takeover), it is returned as an *(opcode, payload)* tuple, and it is encoded when
+        it is sent.
+        """
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        elif not isinstance(message, str):
+            message = str(message)
+        opcode = binary and OP_BINARY or OP_TEXT
+        if self.deflate is None:
+            return self._frame_header(opcode, len(message)) + message
+        if self.encoding_key is None:
+            return opcode, message
+        return ''.join(self._encode(opcode, message))
+
+    def send (self, message, binary = False):
+        """Send a message to the browser.
+
+        *message* should be convertable to a string; unicode objects are
+        encoded as utf-8. It is sent as a text message, unless *binary* is
+        True. Raises socket.error with errno of 32 (broken pipe) if the
+        socket has already been closed by the client."""
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        elif not isinstance(message, str):
+            message = str(message)
+        if self.deflate is not None:
+            self._send_frames([(binary and OP_BINARY or OP_TEXT, message)])
+        else:
+            self._send_frame(binary and OP_BINARY or OP_TEXT, message)
+
+    def ping (self, payload = ''):
+        """
+        Send a ping to the client (that should answer with a pong)
+        """
+        self._send_frame(OP_PING, payload)
+
+    def pong (self, payload = ''):
+        """
+        Send a pong to the client
+        """
+        self._send_frame(OP_PONG, payload)
+
+    def wait (self):
+        """Waits for and deserializes messages.
+
+        Returns a single message; the oldest not yet processed. If the client
+        has closed the connection (or it has sent something invalid), returns
+        None."""
+        while not self._msgs:
+            if self.websocket_closed:
+                return None
+            delta = self.socket.recv(RECV_SIZE)
+            if delta == '':
+                self.websocket_closed = True
+                return None
+            if self._feed(delta):
+                try:
+                    self._parse_frames()
+                except ProtocolError, e:
+                    self.close_code = e.code
+                    self._send_closing_frame(True, e.code)
+                    return None
+        return self._msgs.popleft()
+
+    def _send_closing_frame (self, ignore_send_errors = False, code = CLOSE_NORMAL):
+        """Sends the closing frame to the client, if required."""
+        if not self._close_sent:
+            self._close_sent = True
+            try:
+                self._send_frame(OP_CLOSE, struct.pack('!H', code))
+            except SocketError:
+                if not ignore_send_errors: #pragma NO COVER
+                    raise
+        self.websocket_closed = True
+
+
+class BroadcastGroup(object):
+    """
+    A group of websockets that receive the same messages, like the participants of a chat::
+
+        group = BroadcastGroup()
+
+        @websocket.WebSocketWSGI
+        def handle (ws):
+            group.add(ws)
+            try:
+                while True:
+                    m = ws.wait()
+                    if m is None:
+                        break
+                    group.send(m)
+            finally:
+                group.remove(ws)
+
+    A message sent to the group is encoded once (for every kind of websocket in the group), and
+    the same frame is queued for every member. Every member has a writer greenthread that sends
+    all the frames queued with a single (vectored) write, so :meth:`send` never blocks, and a
+    burst of messages only wakes every writer once.
+
+    The members that do not keep up (with more than *max_queued* bytes waiting in their
+    queue) are handled according to the *policy*: with :const:`SLOW_DROP`, they are removed
+    from the group and disconnected; with :const:`SLOW_COALESCE`, the frames they have
+    queued are discarded, so they only get the newest message.
+    """
+
+    def __init__ (self, max_queued = BROADCAST_MAX_QUEUED, policy = SLOW_DROP):
+        """
+        :param max_queued: maximum number of bytes queued for a member
+        :param policy: what is done with the slow members: :const:`SLOW_DROP` or
+                       :const:`SLOW_COALESCE`
+        """
+        if policy not in (SLOW_DROP, SLOW_COALESCE):
+            raise ValueError('unknown policy %r' % policy)
+        self.max_queued = max_queued
+        self.policy = policy
+        self.writers = {}
+        self.messages = 0           # messages sent to the group
+        self.dropped = 0            # members dropped for being slow
+        self.coalesced = 0          # frames discarded for slow members
+
+    def __len__ (self):
+        return len(self.writers)
+
+    def __contains__ (self, ws):
+        return ws in self.writers
+
+    def __iter__ (self):
+        return iter(self.writers.keys())
+
+    def add (self, ws):
+        """
+        Add a websocket to the group
+        """
+        if ws not in self.writers:
+            self.writers[ws] = _GroupWriter(self, ws)
+
+    def remove (self, ws):
+        """
+        Remove a websocket from the group. The messages queued and not sent yet are discarded.
+        """
+        writer = self.writers.pop(ws, None)
+        if writer is not None:
+            writer.close()
+
+    def send (self, message, binary = False, exclude = None):
+        """
+        Send a message to all the members of the group (but *exclude*). It does not wait for
+        the message to be sent.
+
+        :param message: the message (see :meth:`WebSocket.send`)
+        :param binary: True for sending a binary message
+        :param exclude: a websocket that must not get the message (ie, the sender)
+        """
+        self.messages += 1
+        frames = {}
+        for ws, writer in self.writers.items():
+            if ws is exclude:
+                continue
+            key = ws.encoding_key
+            frame = frames.get(key)
+            if frame is None:
+                frame = ws.encode_message(message, binary)
+                if key is not None:
+                    frames[key] = frame
+            writer.put(frame)
+
+    def close (self):
+        """
+        Remove all the members of the group
+        """
+        for ws in self.writers.keys():
+            self.remove(ws)
+
+    def _slow_member (self, writer):
+        ## return True if the new frame must still be queued
+        if self.policy == SLOW_COALESCE:
+            self.coalesced += len(writer.queue)
+            writer.queue = []
+            writer.queued = 0
+            return True
+
+        self.dropped += 1
+        self.remove(writer.ws)
+        try:
+            writer.ws.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        return False
+
+
+class _GroupWriter(object):
+    """
+    The queue of frames for a member of a broadcast group, and the greenthread writing them
+    """
+
+    __slots__ = ['group', 'ws', 'queue', 'queued', 'closed', 'waiting']
+
+    def __init__ (self, group, ws):
+        self.group = group
+        self.ws = ws
+        self.queue = []
+        self.queued = 0
+        self.closed = False
+        self.waiting = None
+        spawn_n(self.run)
+
+    def put (self, frame):
+        ## messages encoded when sent are queued as (opcode, payload) tuples
+        size = isinstance(frame, tuple) and len(frame[1]) or len(frame)
+        if self.queue and self.queued + size > self.group.max_queued:
+            if not self.group._slow_member(self):
+                return
+        self.queue.append(frame)
+        self.queued += size
+        self._wakeup()
+
+    def close (self):
+        self.closed = True
+        self.queue = []
+        self.queued = 0
+        self._wakeup()
+
+    def _wakeup (self):
+        waiting = self.waiting
+        if waiting is not None:
+            self.waiting = None
+            get_hub().run_callback(waiting.switch)
+
+    def run (self):
+        hub = get_hub()
+        current = greenlet.getcurrent()
+        try:
+            while not self.closed:
+                if not self.queue:
+                    self.waiting = current
+                    hub.switch()
+                    continue
+                frames = self.queue
+                self.queue = []
+                self.queued = 0
+                self.ws._send_frames(frames)
+        except socket.error:
+            ## the client has gone: the handler will find it out too
+            self.group.remove(self.ws)
@@ -27,8 +27,11 @@
 # THE SOFTWARE.
 #
 
+import collections
 import errno
+import json
 import os
+import stat
 import sys
 import time
 import traceback
@@ -38,19 +41,30 @@ from evy.patched import urllib
 from evy.patched import socket
 from evy.patched import BaseHTTPServer
 from evy.green.pools import GreenPool
+from evy.hubs import get_hub
+from evy.hubs.timer import TimerWheel
 from evy.io import sockets
+from evy.io.convenience import AcceptStats, accept_batch, ACCEPT_BATCH_SIZE
 from evy.support import get_errno
+from evy.support import greenlets as greenlet
+from evy.web.httpparser import HttpRequestParser, RequestHeaders, ChunkedDecoder
+from evy.web.compression import StreamCompressor, accepted_encoding, is_compressible
+from evy.web.compression import COMPRESSION_LEVEL, COMPRESSION_MIN_SIZE
+from evy.web.metrics import ServerMetrics
+from evy.web.httpparser import BadRequest, RequestLineTooLong, HeaderLineTooLong, HeadersTooLarge
+from evy.web.httpparser import MAX_REQUEST_LINE, MAX_HEADER_LINE, MAX_TOTAL_HEADER_SIZE
 
 DEFAULT_MAX_SIMULTANEOUS_REQUESTS = 1024
 DEFAULT_MAX_HTTP_VERSION = 'HTTP/1.1'
-MAX_REQUEST_LINE = 8192
-MAX_HEADER_LINE = 8192
-MAX_TOTAL_HEADER_SIZE = 65536
 MINIMUM_CHUNK_SIZE = 4096
+MAX_PIPELINED_OUTPUT = 65536
+INPUT_CHUNK_SIZE = 65536
+## idle keep-alive connections are closed when fewer connections than this could be handled
+MIN_FREE_CONNECTIONS = 8
 DEFAULT_LOG_FORMAT = ('%(client_ip)s - - [%(date_time)s] "%(request_line)s"'
                       ' %(status_code)s %(body_length)s %(wall_seconds).6f')
 
-__all__ = ['server', 'format_date_time']
+__all__ = ['server', 'format_date_time', 'FileWrapper']
 
 # Weekday and month names for HTTP date/time formatting; always English!
 _weekdayname = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
@@ -65,6 +79,59 @@ def format_date_time (timestamp):
         _weekdayname[wd], day, _monthname[month], year, hh, mm, ss
         )
 
+## the Date header line for the current second
+_date_header = None
+
+def _expire_date_header ():
+    global _date_header
+    _date_header = None
+
+def date_header ():
+    """
+    Return the Date header line for the current time.
+
+    The value is computed once per second: a hub timer (that does not keep the hub running)
+    invalidates it at the start of the next second.
+    """
+    global _date_header
+    if _date_header is None:
+        now = time.time()
+        _date_header = 'Date: %s\r\n' % format_date_time(now)
+        get_hub().schedule_call_global(1.0 - now % 1.0, _expire_date_header).forget()
+    return _date_header
+
+## the status lines for all the well known status codes, by (HTTP version, status)
+_status_lines = dict((
+    ((version, '%d %s' % (code, messages[0])), '%s %d %s\r\n' % (version, code, messages[0]))
+    for version in ('HTTP/1.0', 'HTTP/1.1')
+    for code, messages in BaseHTTPServer.BaseHTTPRequestHandler.responses.iteritems()))
+
+def status_line (version, status):
+    """
+    Return the status line for a response with some *status* (ie, '200 OK')
+    """
+    try:
+        return _status_lines[(version, status)]
+    except KeyError:
+        return '%s %s\r\n' % (version, status)
+
+## canonical header names (ie, 'Content-Type' for 'content-type'), by the name used by the app
+_header_names = {}
+MAX_HEADER_NAMES = 1024
+
+def canonical_header_name (name):
+    """
+    Return the canonical form of a header name, with each word capitalized
+    """
+    try:
+        return _header_names[name]
+    except KeyError:
+        canonical = '-'.join([x.capitalize() for x in name.split('-')])
+        ## do not let applications with random header names grow this forever
+        if len(_header_names) < MAX_HEADER_NAMES:
+            _header_names[name] = canonical
+        return canonical
+
 # Collections of error codes to compare against.  Not all attributes are set
 # on errno module on all platforms, so some are literals :(
 BAD_SOCK = set((errno.EBADF, 10053))
@@ -80,13 +147,65 @@ class _AlreadyHandled(object):
 
 ALREADY_HANDLED = _AlreadyHandled()
 
+class FileWrapper(object):
+    """
+    The ``wsgi.file_wrapper`` (see PEP 333)
+
+    Applications can return a file wrapped with this class. When the file is a regular file
+    and the client is on a plain TCP socket, the server sends it with sendfile(), without
+    copying the data. Otherwise, the file is read in blocks of *blksize* bytes.
+    """
+
+    def __init__ (self, filelike, blksize = 8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__ (self):
+        return self
+
+    def next (self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+
+    def file_range (self):
+        """
+        Return the position in the file and the number of bytes until EOF, or None if the
+        file-like object is not a regular file
+        """
+        try:
+            offset = self.filelike.tell()
+            st = os.fstat(self.filelike.fileno())
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return offset, max(st.st_size - offset, 0)
+
+
 class Input(object):
+    """
+    The body of a request, as the ``wsgi.input`` file-like object.
+
+    The body is read from the connection as the application asks for it, decoding the chunked
+    transfer coding when needed, so it is only kept in memory as a whole if the application
+    reads it all at once. Iterating over the input gets the body in chunks of (at most)
+    :attr:`chunk_size` bytes, as they are received, and :meth:`readinto` copies the data into
+    a buffer provided by the application.
+    """
+    chunk_size = INPUT_CHUNK_SIZE
+
     def __init__ (self,
                   rfile,
                   content_length,
                   wfile = None,
                   wfile_line = None,
-                  chunked_input = False):
+                  chunked_input = False,
+                  protocol = None,
+                  timeout = None):
         self.rfile = rfile
         if content_length is not None:
             content_length = int(content_length)
@@ -97,19 +216,46 @@ class Input(object):
 
         self.position = 0
         self.chunked_input = chunked_input
-        self.chunk_length = -1
+        self.decoder = chunked_input and ChunkedDecoder() or None
+        self.peeked = ''
 
-    def _do_read (self, reader, length = None):
+        ## green sockets are read directly from their receive buffer
+        self.sock = None
+        sock = getattr(rfile, '_sock', None)
+        if getattr(rfile, 'bufsize', None) == 0 and isinstance(sock, sockets.GreenSocket) and \
+           sock.uv_handle:
+            self.sock = sock
+
+        ## the protocol interrupts any read that takes more than this
+        self.protocol = protocol
+        self.timeout = timeout
+
+    def _timed (self, method, *args):
+        self.protocol.start_deadline(self.timeout)
+        try:
+            return method(*args)
+        finally:
+            self.protocol.stop_deadline()
+
+    def _send_continue (self):
         if self.wfile is not None:
             ## 100 Continue
             self.wfile.write(self.wfile_line)
             self.wfile = None
             self.wfile_line = None
 
-        if length is None and self.content_length is not None:
-            length = self.content_length - self.position
-        if length and length > self.content_length - self.position:
-            length = self.content_length - self.position
+    def _remaining (self, length):
+        ## the number of bytes of a body with a Content-Length that can be read for a *length*
+        if self.content_length is None:
+            return 0
+        remaining = self.content_length - self.position
+        if length is None or length < 0 or length > remaining:
+            return remaining
+        return length
+
+    def _do_read (self, reader, length = None):
+        self._send_continue()
+        length = self._remaining(length)
         if not length:
             return ''
         try:
@@ -119,114 +265,183 @@ class Input(object):
         self.position += len(read)
         return read
 
-    def _chunked_read (self, rfile, length = None, use_readline = False):
-        if self.wfile is not None:
-            ## 100 Continue
-            self.wfile.write(self.wfile_line)
-            self.wfile = None
-            self.wfile_line = None
-        try:
-            if length == 0:
-                return ""
+    def _peek (self, size):
+        ## get some data of a chunked body, without consuming it: a line when *size* is None
+        sock = self.sock
+        if sock is not None:
+            buf = sock.uv_recv_buffer
+            if not buf.size and sock._uv_read() == sockets.GreenSocket.EOF:
+                return ''
+            return buf.peek()
 
-            if length < 0:
-                length = None
-
-            if use_readline:
-                reader = self.rfile.readline
-            else:
-                reader = self.rfile.read
-
-            response = []
-            while self.chunk_length != 0:
-                maxreadlen = self.chunk_length - self.position
-                if length is not None and length < maxreadlen:
-                    maxreadlen = length
-
-                if maxreadlen > 0:
-                    data = reader(maxreadlen)
-                    if not data:
-                        self.chunk_length = 0
-                        raise IOError("unexpected end of file while parsing chunked data")
-
-                    datalen = len(data)
-                    response.append(data)
-
-                    self.position += datalen
-                    if self.chunk_length == self.position:
-                        rfile.readline()
-
-                    if length is not None:
-                        length -= datalen
-                        if length == 0:
-                            break
-                    if use_readline and data[-1] == "\n":
-                        break
-                else:
-                    self.chunk_length = int(rfile.readline().split(";", 1)[0], 16)
-                    self.position = 0
-                    if self.chunk_length == 0:
-                        rfile.readline()
-        except sockets.SSL.ZeroReturnError:
-            pass
-        return ''.join(response)
+        if not self.peeked:
+            try:
+                self.peeked = self.rfile.readline(size or self.decoder.max_line)
+            except sockets.SSL.ZeroReturnError:
+                pass
+        return self.peeked
+
+    def _skip (self, nbytes):
+        sock = self.sock
+        if sock is not None:
+            sock.uv_recv_buffer.skip(nbytes)
+            if sock.uv_streaming:
+                sock._uv_stream_drained()
+        else:
+            self.peeked = self.peeked[nbytes:]
+
+    def _chunked_decode (self, limit = None, readline = False):
+        ## decode the next piece of the chunked body: return the data and where it is in it
+        decoder = self.decoder
+        while not decoder.done:
+            data = self._peek(decoder.wanted())
+            if not data:
+                decoder.done = True
+                raise IOError("unexpected end of file while parsing chunked data")
+            used, start, end = decoder.decode(data, limit, readline)
+            self._skip(used)
+            if end > start:
+                self.position += end - start
+                return data, start, end
+        return '', 0, 0
+
+    def _chunked_read (self, length = None, readline = False):
+        self._send_continue()
+        if length is not None and length < 0:
+            length = None
+
+        pieces = []
+        while length != 0:
+            data, start, end = self._chunked_decode(length, readline)
+            if end == start:
+                break
+            pieces.append(data[start:end])
+            if length is not None:
+                length -= end - start
+            if readline and data[end - 1] == '\n':
+                break
+        return ''.join(pieces)
 
     def read (self, length = None):
+        if self.timeout:
+            return self._timed(self._read, length)
+        return self._read(length)
+
+    def _read (self, length):
         if self.chunked_input:
-            return self._chunked_read(self.rfile, length)
+            return self._chunked_read(length)
         return self._do_read(self.rfile.read, length)
 
+    def read1 (self, size = None):
+        """
+        Read up to *size* bytes of the body, waiting only if nothing has been received yet
+
+        :return: the data, or an empty string at the end of the body
+        """
+        if self.timeout:
+            return self._timed(self._read1, size)
+        return self._read1(size)
+
+    def _read1 (self, size):
+        if size is None or size < 0:
+            size = self.chunk_size
+        if self.chunked_input:
+            self._send_continue()
+            data, start, end = self._chunked_decode(size)
+            return data[start:end]
+        if self.sock is not None:
+            return self._do_read(self.sock.recv, size)
+        return self._do_read(self.rfile.read, size)
+
+    def readinto (self, buf):
+        """
+        Read up to ``len(buf)`` bytes of the body into *buf*, waiting only if nothing has been
+        received yet
+
+        :param buf: a writable buffer, like a :class:`bytearray`
+        :return: the number of bytes read, or 0 at the end of the body
+        """
+        if self.timeout:
+            return self._timed(self._readinto, buf)
+        return self._readinto(buf)
+
+    def _readinto (self, buf):
+        view = memoryview(buf)
+        self._send_continue()
+        if self.chunked_input:
+            data, start, end = self._chunked_decode(len(view))
+            view[:end - start] = buffer(data, start, end - start)
+            return end - start
+
+        length = self._remaining(len(view))
+        if not length:
+            return 0
+        if self.sock is not None:
+            nbytes = self.sock.recv_into(view, length)
+        else:
+            data = self.rfile.read(length)
+            nbytes = len(data)
+            view[:nbytes] = data
+        self.position += nbytes
+        return nbytes
+
     def readline (self, size = None):
+        if self.timeout:
+            return self._timed(self._readline, size)
+        return self._readline(size)
+
+    def _readline (self, size):
         if self.chunked_input:
-            return self._chunked_read(self.rfile, size, True)
+            return self._chunked_read(size, True)
         else:
             return self._do_read(self.rfile.readline, size)
 
     def readlines (self, hint = None):
-        return self._do_read(self.rfile.readlines, hint)
+        lines = []
+        total = 0
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            total += len(line)
+            if hint and total >= hint:
+                break
+        return lines
 
     def __iter__ (self):
-        return iter(self.read())
+        read1 = self.read1
+        while True:
+            data = read1(self.chunk_size)
+            if not data:
+                break
+            yield data
 
     def get_socket (self):
+        """
+        Get the socket of the connection, for applications that write directly to it. Any
+        response to a previous pipelined request is sent first.
+        """
+        if self.protocol is not None:
+            self.protocol.flush_output()
         return self.rfile._sock
 
 
-class HeaderLineTooLong(Exception):
-    pass
-
-
-class HeadersTooLarge(Exception):
-    pass
-
-
-class FileObjectForHeaders(object):
-    def __init__ (self, fp):
-        self.fp = fp
-        self.total_header_size = 0
-
-    def readline (self, size = -1):
-        sz = size
-        if size < 0:
-            sz = MAX_HEADER_LINE
-        rv = self.fp.readline(sz)
-        if size < 0 and len(rv) >= MAX_HEADER_LINE:
-            raise HeaderLineTooLong()
-        self.total_header_size += len(rv)
-        if self.total_header_size > MAX_TOTAL_HEADER_SIZE:
-            raise HeadersTooLarge()
-        return rv
-
-
 class HttpProtocol(BaseHTTPServer.BaseHTTPRequestHandler):
     protocol_version = 'HTTP/1.1'
     minimum_chunk_size = MINIMUM_CHUNK_SIZE
+    max_pipelined_output = MAX_PIPELINED_OUTPUT
 
     def setup (self):
         # overriding SocketServer.setup to correctly handle SSL.Connection objects
         conn = self.connection = self.request
+        rbufsize = self.rbufsize
+        if isinstance(conn, sockets.GreenSocket) and conn.uv_handle:
+            ## green sockets have their own receive buffer, so the request is parsed from it and
+            ## the file object must not buffer anything
+            rbufsize = 0
         try:
-            self.rfile = conn.makefile('rb', self.rbufsize)
+            self.rfile = conn.makefile('rb', rbufsize)
             self.wfile = conn.makefile('wb', self.wbufsize)
         except (AttributeError, NotImplementedError):
             if hasattr(conn, 'send') and hasattr(conn, 'recv'):
@@ -238,6 +453,178 @@ class HttpProtocol(BaseHTTPServer.BaseHTTPRequestHandler):
                 raise NotImplementedError("wsgi.py doesn't support sockets "\
                                           "of type %s" % type(conn))
 
+        ## responses to pipelined requests are kept here, and sent in a single write
+        self.output = []
+        self.output_size = 0
+        self.output_flusher = None
+        self.output_sock = None
+        sock = getattr(self.wfile, '_sock', None)
+        if isinstance(sock, sockets.GreenSocket) and sock.uv_handle:
+            self.output_sock = sock
+
+        ## reads are interrupted by the server's timer wheel, throwing into this greenlet
+        self.greenlet = greenlet.getcurrent()
+        self.deadline = None
+        self.deadline_id = 0
+        self.requests_read = 0
+
+    def start_deadline (self, seconds):
+        """
+        Start a deadline for the next read: if it has not finished in *seconds*, it is
+        interrupted with a :class:`socket.timeout`. The deadline must be stopped with
+        :meth:`stop_deadline` when the read is done.
+
+        :param seconds: the timeout, or None for no deadline
+        """
+        self.deadline_id += 1
+        if seconds:
+            self.deadline = self.server.timers.add(seconds, self.interrupt_read,
+                                                   self.deadline_id)
+
+    def stop_deadline (self):
+        """
+        Stop the deadline started with :meth:`start_deadline`
+        """
+        self.deadline_id += 1
+        if self.deadline is not None:
+            self.server.timers.cancel(self.deadline)
+            self.deadline = None
+
+    def interrupt_read (self, deadline_id, timed_out = True):
+        ## invoked from the hub, so the greenlet is blocked: interrupt it only if it is still
+        ## waiting in the same read. Reaped connections are not counted as timeouts
+        if deadline_id == self.deadline_id and not self.greenlet.dead:
+            self.stop_deadline()
+            if timed_out:
+                self.server.timed_out_connections += 1
+            self.greenlet.throw(socket.timeout('timed out'))
+
+    def send_output (self, towrite, defer = False):
+        """
+        Send some response data to the client.
+
+        When *defer* is True and the next request is already in the receive buffer, the data
+        is not sent immediately: it is kept and sent together with the responses to the next
+        pipelined requests, with a single write, as soon as this greenlet blocks (or there is
+        too much output pending). It is also sent before anything the application writes
+        directly to the socket (see :meth:`Input.get_socket`).
+
+        :param towrite: a list of strings
+        :param defer: True if the data can be deferred
+        """
+        if defer and self.output_sock is not None and not self.close_connection and \
+           self.output_sock.uv_recv_buffer.size:
+            self.output.extend(towrite)
+            self.output_size += sum(map(len, towrite))
+            if self.output_size < self.max_pipelined_output:
+                if self.output_flusher is None:
+                    self.output_flusher = get_hub().run_callback(self._flush_output_nowait)
+                return
+            towrite = self._take_output()
+        elif self.output:
+            self.output.extend(towrite)
+            towrite = self._take_output()
+        self.wfile.writelines(towrite)
+
+    def _take_output (self):
+        if self.output_flusher is not None:
+            self.output_flusher.cancel()
+            self.output_flusher = None
+        output, self.output = self.output, []
+        self.output_size = 0
+        return output
+
+    def _flush_output_nowait (self):
+        ## invoked from the hub when the greenlet handling the connection blocks: the output
+        ## is queued in libuv, without waiting for the write to complete
+        self.output_flusher = None
+        size = self.output_size
+        output = self._take_output()
+        try:
+            self.output_sock._uv_write([x for x in output if x], size, wait = False)
+        except socket.error:
+            ## we are in the hub: the connection is broken, and the greenlet will find it
+            ## out in its next read or write
+            pass
+
+    def flush_output (self):
+        """
+        Send any response data pending from previous pipelined requests.
+        """
+        if self.output:
+            if self.output_sock is not None:
+                self.output_sock.sendv(self._take_output())
+            else:
+                self.wfile.writelines(self._take_output())
+
+    def send_error (self, code, message = None):
+        self.flush_output()
+        self.server.metrics.add_status(code)
+        BaseHTTPServer.BaseHTTPRequestHandler.send_error(self, code, message)
+
+    def send_error_and_close (self, status):
+        """
+        Send an empty response with a *status* (ie, '400 Bad Request') and close the connection
+        """
+        self.flush_output()
+        self.server.metrics.add_status(status)
+        self.wfile.write("HTTP/1.0 %s\r\nConnection: close\r\nContent-length: 0\r\n\r\n" % status)
+        self.close_connection = 1
+
+    def read_request_head (self, parser):
+        """
+        Read the request line and the headers, feeding the *parser* until it is done
+
+        :return: False if the connection was closed before that
+        """
+        server = self.server
+        sock = getattr(self.rfile, '_sock', None)
+        if self.rfile.bufsize == 0 and isinstance(sock, sockets.GreenSocket) and sock.uv_handle:
+            if self.requests_read and not sock.uv_recv_buffer.size:
+                if not self.wait_next_request(sock):
+                    return False
+            self.start_deadline(server.header_timeout)
+            try:
+                return sock._recv_parsed(parser)
+            finally:
+                self.stop_deadline()
+
+        ## we cannot tell when the next request starts, so the keep-alive timeout is used for
+        ## the whole request head
+        if self.requests_read:
+            server.idle_connections[self] = None
+            self.start_deadline(server.keepalive_timeout)
+        else:
+            self.start_deadline(server.header_timeout)
+        try:
+            limit = max(parser.max_request_line, parser.max_header_line)
+            while not parser.done:
+                line = self.rfile.readline(limit)
+                if not line:
+                    return False
+                parser.feed(line)
+            return True
+        finally:
+            self.stop_deadline()
+            server.idle_connections.pop(self, None)
+
+    def wait_next_request (self, sock):
+        """
+        Wait for the first data of the next request in a keep-alive connection, for no more than
+        the server's keep-alive timeout. Meanwhile, the connection is idle, and it can be reaped
+        if the server needs room for new connections.
+
+        :return: False if the connection was closed
+        """
+        server = self.server
+        server.idle_connections[self] = None
+        self.start_deadline(server.keepalive_timeout)
+        try:
+            return sock._uv_read() != sockets.GreenSocket.EOF
+        finally:
+            self.stop_deadline()
+            server.idle_connections.pop(self, None)
+
     def handle_one_request (self):
         if self.server.max_http_version:
             self.protocol_version = self.server.max_http_version
@@ -246,58 +633,60 @@ class HttpProtocol(BaseHTTPServer.BaseHTTPRequestHandler):
             self.close_connection = 1
             return
 
+        parser = HttpRequestParser(max_request_line = self.server.url_length_limit)
         try:
-            self.raw_requestline = self.rfile.readline(self.server.url_length_limit)
-            if len(self.raw_requestline) == self.server.url_length_limit:
-                self.wfile.write(
-                    "HTTP/1.0 414 Request URI Too Long\r\n"
-                    "Connection: close\r\nContent-length: 0\r\n\r\n")
-                self.close_connection = 1
-                return
+            complete = self.read_request_head(parser)
+        except RequestLineTooLong:
+            self.send_error_and_close('414 Request URI Too Long')
+            return
+        except HeaderLineTooLong:
+            self.send_error_and_close('400 Header Line Too Long')
+            return
+        except HeadersTooLarge:
+            self.send_error_and_close('400 Headers Too Large')
+            return
+        except BadRequest:
+            self.send_error_and_close('400 Bad Request')
+            return
         except sockets.SSL.ZeroReturnError:
-            self.raw_requestline = ''
+            complete = False
+        except socket.timeout:
+            complete = False
         except socket.error, e:
             if get_errno(e) not in BAD_SOCK:
                 raise
-            self.raw_requestline = ''
+            complete = False
 
-        if not self.raw_requestline:
+        if not complete:
             self.close_connection = 1
             return
 
-        orig_rfile = self.rfile
-        try:
-            self.rfile = FileObjectForHeaders(self.rfile)
-            if not self.parse_request():
-                return
-        except HeaderLineTooLong:
-            self.wfile.write(
-                "HTTP/1.0 400 Header Line Too Long\r\n"
-                "Connection: close\r\nContent-length: 0\r\n\r\n")
-            self.close_connection = 1
-            return
-        except HeadersTooLarge:
-            self.wfile.write(
-                "HTTP/1.0 400 Headers Too Large\r\n"
-                "Connection: close\r\nContent-length: 0\r\n\r\n")
-            self.close_connection = 1
+        self.requests_read += 1
+        metrics = self.server.metrics
+        metrics.requests += 1
+        metrics.bytes_in += len(parser.requestline) + 2 + parser.header_size
+        if self.requests_read > 1:
+            metrics.keepalive_requests += 1
+
+        self.raw_requestline = parser.requestline + '\r\n'
+        if not self.parse_request_head(parser):
             return
-        finally:
-            self.rfile = orig_rfile
 
         content_length = self.headers.getheader('content-length')
         if content_length:
             try:
                 int(content_length)
             except ValueError:
-                self.wfile.write(
-                    "HTTP/1.0 400 Bad Request\r\n"
-                    "Connection: close\r\nContent-length: 0\r\n\r\n")
-                self.close_connection = 1
+                self.send_error_and_close('400 Bad Request')
                 return
 
         self.environ = self.get_environ()
+        if self.environ['evy.input'].wfile is not None:
+            ## the 100 Continue must go after the responses to the previous requests
+            self.flush_output()
         self.application = self.server.app
+        if self.server.metrics_path and self.environ['PATH_INFO'] == self.server.metrics_path:
+            self.application = self.server.metrics_app
         try:
             self.server.outstanding_requests += 1
             try:
@@ -309,32 +698,87 @@ class HttpProtocol(BaseHTTPServer.BaseHTTPRequestHandler):
         finally:
             self.server.outstanding_requests -= 1
 
+    def parse_request_head (self, parser):
+        """
+        Set the request attributes from the request line and headers found by the *parser*.
+        This replaces :meth:`BaseHTTPServer.BaseHTTPRequestHandler.parse_request`.
+
+        :return: True for success, False for failure (and then an error is sent back)
+        """
+        self.command = None
+        self.request_version = version = self.default_request_version
+        self.close_connection = 1
+        self.requestline = requestline = parser.requestline
+
+        words = requestline.split()
+        if len(words) == 3:
+            command, path, version = words
+            if version[:5] != 'HTTP/':
+                self.send_error(400, "Bad request version (%r)" % version)
+                return False
+            try:
+                major, minor = version[5:].split('.')
+                version_number = int(major), int(minor)
+            except ValueError:
+                self.send_error(400, "Bad request version (%r)" % version)
+                return False
+            if version_number >= (1, 1) and self.protocol_version >= "HTTP/1.1":
+                self.close_connection = 0
+            if version_number >= (2, 0):
+                self.send_error(505, "Invalid HTTP Version (%s)" % version[5:])
+                return False
+        elif len(words) == 2:
+            command, path = words
+            if command != 'GET':
+                self.send_error(400, "Bad HTTP/0.9 request type (%r)" % command)
+                return False
+        else:
+            self.send_error(400, "Bad request syntax (%r)" % requestline)
+            return False
+        self.command, self.path, self.request_version = command, path, version
+
+        self.request_headers = parser.headers
+        self.headers = RequestHeaders(parser.headers)
+
+        conntype = self.headers.get('Connection', '').lower()
+        if conntype == 'close':
+            self.close_connection = 1
+        elif conntype == 'keep-alive' and self.protocol_version >= "HTTP/1.1":
+            self.close_connection = 0
+        return True
+
     def handle_one_response (self):
         start = time.time()
         headers_set = []
         headers_sent = []
 
-        wfile = self.wfile
         result = None
         use_chunked = [False]
         length = [0]
         status_code = [200]
+        last = [False]
+        compressor = [None]
 
-        def write (data, _writelines = wfile.writelines):
+        def write (data):
             towrite = []
             if not headers_set:
                 raise AssertionError("write() before start_response()")
             elif not headers_sent:
                 status, response_headers = headers_set
                 headers_sent.append(1)
-                header_list = [header[0].lower() for header in response_headers]
-                towrite.append('%s %s\r\n' % (self.protocol_version, status))
+                self.server.metrics.first_byte.add(time.time() - start)
+                if compressor[0] is None:
+                    compressor[0] = self.get_compressor(status_code[0], response_headers,
+                                                        len(data) if last[0] else None)
+                ## header names have been canonicalized in start_response()
+                header_list = [header[0] for header in response_headers]
+                towrite.append(status_line(self.protocol_version, status))
                 for header in response_headers:
                     towrite.append('%s: %s\r\n' % header)
 
                 # send Date header?
-                if 'date' not in header_list:
-                    towrite.append('Date: %s\r\n' % (format_date_time(time.time()),))
+                if 'Date' not in header_list:
+                    towrite.append(date_header())
 
                 client_conn = self.headers.get('Connection', '').lower()
                 send_keep_alive = False
@@ -349,11 +793,11 @@ class HttpProtocol(BaseHTTPServer.BaseHTTPRequestHandler):
                 else:
                     self.close_connection = 1
 
-                if 'content-length' not in header_list:
+                if 'Content-Length' not in header_list:
                     if self.request_version == 'HTTP/1.1':
                         use_chunked[0] = True
                         towrite.append('Transfer-Encoding: chunked\r\n')
-                    elif 'content-length' not in header_list:
+                    else:
                         # client is 1.0 and therefore must read to EOF
                         self.close_connection = 1
 
@@ -364,13 +808,20 @@ class HttpProtocol(BaseHTTPServer.BaseHTTPRequestHandler):
                 towrite.append('\r\n')
                 # end of header writing
 
+            raw_data = data
+            if compressor[0]:
+                data = compressor[0].compress(data, last[0])
             if use_chunked[0]:
-                ## Write the chunked encoding
-                towrite.append("%x\r\n%s\r\n" % (len(data), data))
+                ## Write the chunked encoding (without copying the data)
+                if data:
+                    towrite.extend(("%x\r\n" % len(data), data, "\r\n"))
+                if not raw_data:
+                    towrite.append("0\r\n\r\n")
             else:
                 towrite.append(data)
             try:
-                _writelines(towrite)
+                ## the last write can be deferred and batched with the next pipelined responses
+                self.send_output(towrite, defer = last[0] and type(data) is str)
                 length[0] = length[0] + sum(map(len, towrite))
             except UnicodeEncodeError:
                 self.server.log_message(
@@ -385,12 +836,12 @@ class HttpProtocol(BaseHTTPServer.BaseHTTPRequestHandler):
                                                                                                        ,
                                                                                                        unicode)])
                 self.server.log_message(traceback.format_exc())
-                _writelines(
+                self.send_output(
                     ["HTTP/1.1 500 Internal Server Error\r\n",
                      "Connection: close\r\n",
                      "Content-type: text/plain\r\n",
                      "Content-length: 98\r\n",
-                     "Date: %s\r\n" % format_date_time(time.time()),
+                     date_header(),
                      "\r\n",
                         ("Internal Server Error: wsgi application passed "
                          "a unicode object to the server instead of a string.")])
@@ -406,9 +857,8 @@ class HttpProtocol(BaseHTTPServer.BaseHTTPRequestHandler):
                     # Avoid dangling circular ref
                     exc_info = None
 
-            capitalized_headers = [('-'.join([x.capitalize()
-                                              for x in key.split('-')]), value)
-            for key, value in response_headers]
+            capitalized_headers = [(canonical_header_name(key), value)
+                                   for key, value in response_headers]
 
             headers_set[:] = [status, capitalized_headers]
             return write
@@ -419,7 +869,21 @@ class HttpProtocol(BaseHTTPServer.BaseHTTPRequestHandler):
                 if (isinstance(result, _AlreadyHandled)
                     or isinstance(getattr(result, '_obj', None), _AlreadyHandled)):
                     self.close_connection = 1
+                    self.flush_output()
                     return
+                if isinstance(result, FileWrapper) and not headers_sent:
+                    file_range = self.get_sendfile_range(result, headers_set)
+                    if file_range is not None:
+                        ## the file is sent as it is
+                        compressor[0] = False
+                        write('')
+                        self.flush_output()
+                        sent = self.output_sock.sendfile(result.filelike, *file_range)
+                        length[0] += sent
+                        if sent < file_range[1]:
+                            ## the file was truncated while we were sending it
+                            self.close_connection = 1
+                        return
                 if not headers_sent and hasattr(result, '__len__') and\
                    'Content-Length' not in [h for h, _v in headers_set[1]]:
                     headers_set[1].append(('Content-Length', str(sum(map(len, result)))))
@@ -434,10 +898,13 @@ class HttpProtocol(BaseHTTPServer.BaseHTTPRequestHandler):
                         towrite = []
                         just_written_size = towrite_size
                         towrite_size = 0
+                last[0] = True
                 if towrite:
                     just_written_size = towrite_size
                     write(''.join(towrite))
-                if not headers_sent or (use_chunked[0] and just_written_size):
+                if not headers_sent or (use_chunked[0] and just_written_size) or \
+                   (compressor[0] and not compressor[0].finished):
+                    ## the end of the chunked body, or of the compressed stream
                     write('')
             except Exception:
                 self.close_connection = 1
@@ -463,6 +930,12 @@ class HttpProtocol(BaseHTTPServer.BaseHTTPRequestHandler):
                         pass
             finish = time.time()
 
+            metrics = self.server.metrics
+            metrics.request_duration.add(finish - start)
+            metrics.add_status(status_code[0])
+            metrics.bytes_in += self.environ['evy.input'].position
+            metrics.bytes_out += length[0]
+
             for hook, args, kwargs in self.environ['evy.posthooks']:
                 hook(self.environ, *args, **kwargs)
 
@@ -475,6 +948,93 @@ class HttpProtocol(BaseHTTPServer.BaseHTTPRequestHandler):
                     body_length = length[0],
                     wall_seconds = finish - start))
 
+    def get_compressor (self, status_code, response_headers, size):
+        """
+        Get a compressor for the response body, if the server compresses responses, the client
+        accepts a compressed response and the content is worth compressing. When the response
+        is compressed, the *response_headers* are updated accordingly.
+
+        :param status_code: the status code of the response
+        :param response_headers: the (canonical) headers of the response
+        :param size: the size of the body, or None if it is not known yet
+        :return: a :class:`~evy.web.compression.StreamCompressor`, or None
+        """
+        server = self.server
+        if not server.compression or self.command == 'HEAD' or \
+           status_code in ('204', '304') or status_code.startswith('1'):
+            return None
+
+        content_type = content_length = vary = None
+        for i, (name, value) in enumerate(response_headers):
+            if name == 'Content-Encoding':
+                return None
+            elif name == 'Content-Type':
+                content_type = value
+            elif name == 'Content-Length':
+                content_length = value
+            elif name == 'Vary':
+                vary = i
+        if not is_compressible(content_type):
+            return None
+
+        ## the response depends on the Accept-Encoding of the request
+        if vary is None:
+            response_headers.append(('Vary', 'Accept-Encoding'))
+        elif 'accept-encoding' not in response_headers[vary][1].lower():
+            response_headers[vary] = ('Vary', response_headers[vary][1] + ', Accept-Encoding')
+
+        encoding = accepted_encoding(self.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return None
+        if content_length is not None:
+            try:
+                size = int(content_length)
+            except ValueError:
+                pass
+        if size is not None and size < server.compression_min_size:
+            return None
+
+        response_headers[:] = [header for header in response_headers
+                               if header[0] != 'Content-Length']
+        response_headers.append(('Content-Encoding', encoding))
+        return StreamCompressor(encoding, server.compression_level)
+
+    def get_sendfile_range (self, result, headers_set):
+        """
+        Check if the file wrapped by a :class:`FileWrapper` can be sent with sendfile(), adding
+        a Content-Length header when there is none.
+
+        When the declared Content-Length is bigger than the rest of the file, the connection
+        is closed after the response, so the client does not wait for the missing bytes.
+
+        :return: the (offset, count) in the file, or None if the file must be sent as any other
+                 iterable (ie, on SSL connections)
+        """
+        if not headers_set or self.output_sock is None:
+            return None
+        file_range = result.file_range()
+        if file_range is None:
+            return None
+        offset, count = file_range
+
+        ## a Content-Length header avoids chunked responses
+        response_headers = headers_set[1]
+        for name, value in response_headers:
+            if name == 'Content-Length':
+                try:
+                    declared = int(value)
+                except ValueError:
+                    return None
+                if declared > count:
+                    ## the file is shorter than the body we announced: the client can only
+                    ## find the end of the response when we close the connection
+                    self.close_connection = 1
+                count = min(count, declared)
+                break
+        else:
+            response_headers.append(('Content-Length', str(count)))
+        return offset, count
+
     def get_client_ip (self):
         client_ip = self.client_address[0]
         if self.server.log_x_forwarded_for:
@@ -494,12 +1054,9 @@ class HttpProtocol(BaseHTTPServer.BaseHTTPRequestHandler):
         if len(pq) > 1:
             env['QUERY_STRING'] = pq[1]
 
-        if self.headers.typeheader is None:
-            env['CONTENT_TYPE'] = self.headers.type
-        else:
-            env['CONTENT_TYPE'] = self.headers.typeheader
+        env['CONTENT_TYPE'] = self.headers.get('content-type', 'text/plain')
 
-        length = self.headers.getheader('content-length')
+        length = self.headers.get('content-length')
         if length:
             env['CONTENT_LENGTH'] = length
         env['SERVER_PROTOCOL'] = 'HTTP/1.0'
@@ -510,17 +1067,15 @@ class HttpProtocol(BaseHTTPServer.BaseHTTPRequestHandler):
         env['REMOTE_ADDR'] = self.client_address[0]
         env['GATEWAY_INTERFACE'] = 'CGI/1.1'
 
-        for h in self.headers.headers:
-            k, v = h.split(':', 1)
-            k = k.replace('-', '_').upper()
-            v = v.strip()
+        for name, value in self.request_headers:
+            k = name.replace('-', '_').upper()
             if k in env:
                 continue
             envk = 'HTTP_' + k
             if envk in env:
-                env[envk] += ',' + v
+                env[envk] += ',' + value
             else:
-                env[envk] = v
+                env[envk] = value
 
         if env.get('HTTP_EXPECT') == '100-continue':
             wfile = self.wfile
@@ -531,12 +1086,16 @@ class HttpProtocol(BaseHTTPServer.BaseHTTPRequestHandler):
         chunked = env.get('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked'
         env['wsgi.input'] = env['evy.input'] = Input(
             self.rfile, length, wfile = wfile, wfile_line = wfile_line,
-            chunked_input = chunked)
+            chunked_input = chunked, protocol = self, timeout = self.server.body_timeout)
         env['evy.posthooks'] = []
 
         return env
 
     def finish (self):
+        try:
+            self.flush_output()
+        except socket.error:
+            pass
         BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
         sockets.shutdown_safe(self.connection)
         self.connection.close()
@@ -557,7 +1116,14 @@ class Server(BaseHTTPServer.HTTPServer):
                   log_output = True,
                   log_format = DEFAULT_LOG_FORMAT,
                   url_length_limit = MAX_REQUEST_LINE,
-                  debug = True):
+                  debug = True,
+                  keepalive_timeout = None,
+                  header_timeout = None,
+                  body_timeout = None,
+                  compression = False,
+                  compression_level = COMPRESSION_LEVEL,
+                  compression_min_size = COMPRESSION_MIN_SIZE,
+                  metrics_path = None):
         self.outstanding_requests = 0
         self.socket = socket
         self.address = address
@@ -578,6 +1144,26 @@ class Server(BaseHTTPServer.HTTPServer):
         self.log_format = log_format
         self.url_length_limit = url_length_limit
         self.debug = debug
+        self.accept_stats = AcceptStats()
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_min_size = compression_min_size
+
+        ## metrics are always kept, and they are served at the metrics path (if any)
+        self.metrics = ServerMetrics()
+        self.metrics_path = metrics_path
+        self.pool = None
+
+        ## all the deadlines of the connections share a timer wheel
+        self.keepalive_timeout = keepalive_timeout
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.timers = TimerWheel()
+        self.timed_out_connections = 0
+
+        ## the keep-alive connections waiting for a new request, the oldest first
+        self.idle_connections = collections.OrderedDict()
+        self.reaped_connections = 0
 
     def get_environ (self):
         d = {
@@ -587,6 +1173,7 @@ class Server(BaseHTTPServer.HTTPServer):
             'wsgi.multiprocess': False,
             'wsgi.run_once': False,
             'wsgi.url_scheme': 'http',
+            'wsgi.file_wrapper': FileWrapper,
             }
         # detect secure socket
         if hasattr(self.socket, 'do_handshake'):
@@ -596,10 +1183,66 @@ class Server(BaseHTTPServer.HTTPServer):
             d.update(self.environ)
         return d
 
-    def process_request (self, (socket, address)):
+    def process_request (self, (socket, address), accepted = None):
+        metrics = self.metrics
+        metrics.connections += 1
+        if accepted is not None:
+            metrics.accept_latency.add(time.time() - accepted)
         proto = self.protocol(socket, address, self)
         proto.handle()
 
+    def get_metrics (self):
+        """
+        Get the metrics of the server: the histograms and counters of the requests handled,
+        the connections accepted, timed out and reaped, and the occupancy of the pool
+
+        :return: a dictionary
+        """
+        res = self.metrics.snapshot()
+        accept_stats = self.accept_stats
+        res.update({
+            'outstanding_requests': self.outstanding_requests,
+            'idle_connections': len(self.idle_connections),
+            'timed_out_connections': self.timed_out_connections,
+            'reaped_connections': self.reaped_connections,
+            'accepted': accept_stats.accepted,
+            'accept_rate': accept_stats.rate,
+            'max_backlog': accept_stats.max_backlog,
+            })
+        pool = self.pool
+        if pool is not None and hasattr(pool, 'running'):
+            res['pool'] = {
+                'size': pool.size,
+                'running': pool.running(),
+                'waiting': pool.waiting(),
+                }
+        return res
+
+    def metrics_app (self, environ, start_response):
+        """
+        A WSGI application that returns the metrics of the server, as JSON
+        """
+        body = json.dumps(self.get_metrics(), sort_keys = True)
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Cache-Control', 'no-cache')])
+        return [body]
+
+    def reap_idle_connections (self, count):
+        """
+        Close (up to) *count* keep-alive connections waiting for a new request, the connections
+        that have been idle for more time first.
+
+        :return: the number of connections closed
+        """
+        hub = get_hub()
+        reaped = 0
+        while self.idle_connections and reaped < count:
+            proto, _ = self.idle_connections.popitem(last = False)
+            hub.run_callback(proto.interrupt_read, proto.deadline_id, False)
+            reaped += 1
+        self.reaped_connections += reaped
+        return reaped
+
     def log_message (self, message):
         self.log.write(message + '\n')
 
@@ -627,7 +1270,14 @@ def server (sock, site,
             log_output = True,
             log_format = DEFAULT_LOG_FORMAT,
             url_length_limit = MAX_REQUEST_LINE,
-            debug = True):
+            debug = True,
+            keepalive_timeout = None,
+            header_timeout = None,
+            body_timeout = None,
+            compression = False,
+            compression_level = COMPRESSION_LEVEL,
+            compression_min_size = COMPRESSION_MIN_SIZE,
+            metrics_path = None):
     """  Start up a wsgi server handling requests from the supplied server
     socket.  This function loops forever.  The *sock* object will be closed after server exits,
     but the underlying file descriptor will remain open, so if you have a dup() of *sock*,
@@ -649,6 +1299,13 @@ def server (sock, site,
     :param log_format: A python format string that is used as the template to generate log lines.  The following values can be formatted into it: client_ip, date_time, request_line, status_code, body_length, wall_seconds.  The default is a good example of how to use it.
     :param url_length_limit: A maximum allowed length of the request url. If exceeded, 414 error is returned.
     :param debug: True if the server should send exception tracebacks to the clients on 500 errors.  If False, the server will respond with empty bodies.
+    :param keepalive_timeout: Maximum time (in seconds) a keep-alive connection can be idle, waiting for a new request. When the server is running out of room for new connections, the connections that have been idle for more time are closed first, regardless of this timeout.
+    :param header_timeout: Maximum time (in seconds) for receiving the request line and headers.
+    :param body_timeout: Maximum time (in seconds) for each read of the request body done by the application, that gets a :class:`socket.timeout` when it expires.
+    :param compression: If True, responses are compressed with gzip or deflate for the clients that accept it, when their content type is worth compressing. The body is compressed as it is produced, in blocks of *minimum_chunk_size* bytes, so streaming responses are compressed too (with chunked transfer encoding).
+    :param compression_level: The zlib compression level, from 1 (fastest) to 9 (smallest).
+    :param compression_min_size: Responses with a body smaller than this (in bytes) are not compressed.
+    :param metrics_path: If set, requests for this path get the server metrics (see :meth:`Server.get_metrics`) as JSON, instead of being handled by the application. The metrics are always kept, regardless of this and *log_output*.
     """
     serv = Server(sock, sock.getsockname(),
                   site, log,
@@ -661,7 +1318,14 @@ def server (sock, site,
                   log_output = log_output,
                   log_format = log_format,
                   url_length_limit = url_length_limit,
-                  debug = debug)
+                  debug = debug,
+                  keepalive_timeout = keepalive_timeout,
+                  header_timeout = header_timeout,
+                  body_timeout = body_timeout,
+                  compression = compression,
+                  compression_level = compression_level,
+                  compression_min_size = compression_min_size,
+                  metrics_path = metrics_path)
     if server_event is not None:
         server_event.send(serv)
     if max_size is None:
@@ -670,6 +1334,7 @@ def server (sock, site,
         pool = custom_pool
     else:
         pool = GreenPool(max_size)
+    serv.pool = pool
     try:
         host, port = sock.getsockname()[:2]
         port = ':%s' % (port, )
@@ -686,15 +1351,27 @@ def server (sock, site,
             os.getpid(), scheme, host, port))
         while True:
             try:
-                client_socket = sock.accept()
-                try:
-                    pool.spawn_n(serv.process_request, client_socket)
-                except AttributeError:
-                    warnings.warn("wsgi's pool should be an instance of "\
-                                  "evy.greenpool.GreenPool, is %s. Please convert your"\
-                                  " call site to use GreenPool instead" % type(pool),
-                                  DeprecationWarning, stacklevel = 2)
-                    pool.execute_async(serv.process_request, client_socket)
+                ## accept all the connections waiting, but not more than we can handle now
+                free = getattr(pool, 'free', None)
+                limit = free and min(max(free(), 1), ACCEPT_BATCH_SIZE) or 1
+                client_sockets = accept_batch(sock, limit)
+                accepted = time.time()
+                serv.accept_stats.add(len(client_sockets))
+                if free:
+                    ## make room for the new connections closing idle ones
+                    needed = len(client_sockets) + MIN_FREE_CONNECTIONS - free()
+                    if needed > 0 and serv.idle_connections:
+                        serv.reap_idle_connections(needed)
+                for client_socket in client_sockets:
+                    try:
+                        pool.spawn_n(serv.process_request, client_socket, accepted)
+                    except AttributeError:
+                        warnings.warn("wsgi's pool should be an instance of "\
+                                      "evy.greenpool.GreenPool, is %s. Please convert your"\
+                                      " call site to use GreenPool instead" % type(pool),
+                                      DeprecationWarning, stacklevel = 2)
+                        pool.execute_async(serv.process_request, client_socket, accepted)
+                client_socket = client_sockets = None
             except ACCEPT_EXCEPTIONS, e:
                 if get_errno(e) not in ACCEPT_ERRNO:
                     raise
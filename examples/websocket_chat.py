@@ -5,7 +5,7 @@ from evy.web import wsgi, websocket
 
 PORT = 7000
 
-participants = set()
+participants = websocket.BroadcastGroup()
 
 @websocket.WebSocketWSGI
 def handle (ws):
@@ -15,8 +15,7 @@ def handle (ws):
             m = ws.wait()
             if m is None:
                 break
-            for p in participants:
-                p.send(m)
+            participants.send(m)
     finally:
         participants.remove(ws)
 
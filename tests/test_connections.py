@@ -0,0 +1,155 @@
+#
+# Evy - a concurrent networking library for Python
+#
+# Unless otherwise noted, the files in Evy are under the following MIT license:
+#
+# Copyright (c) 2012, Alvaro Saurin
+# Copyright (c) 2008-2010, Eventlet Contributors (see AUTHORS)
+# Copyright (c) 2007-2010, Linden Research, Inc.
+# Copyright (c) 2005-2006, Bob Ippolito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+
+from tests import LimitedTestCase, main
+
+from evy import event
+from evy.io import convenience
+from evy.io.connections import ConnectionPool
+from evy.patched import httplib
+from evy.green.threads import spawn, sleep
+
+
+class TestConnectionPool(LimitedTestCase):
+    TEST_TIMEOUT = 2
+
+    def setUp (self):
+        super(TestConnectionPool, self).setUp()
+        self.listener = convenience.listen(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        self.accepted = []
+
+        def server ():
+            while True:
+                sock, addr = self.listener.accept()
+                self.accepted.append(sock)
+
+        self.server = spawn(server)
+
+    def tearDown (self):
+        self.server.kill()
+        for sock in self.accepted:
+            sock.close()
+        self.listener.close()
+        super(TestConnectionPool, self).tearDown()
+
+    def test_reuse (self):
+        pool = ConnectionPool()
+        sock = pool.get('127.0.0.1', self.port)
+        pool.put(sock)
+        self.assertEquals(len(pool), 1)
+        self.assert_(pool.get('127.0.0.1', self.port) is sock)
+        self.assertEquals((pool.hits, pool.misses), (1, 1))
+
+        ## a socket that could not be reused is not returned to the pool
+        pool.discard(sock)
+        self.assertEquals(len(pool), 0)
+
+    def test_dead (self):
+        pool = ConnectionPool()
+        sock = pool.get('127.0.0.1', self.port)
+        pool.put(sock)
+
+        sleep(0.01)
+        self.accepted[0].close()
+        sleep(0.01)
+
+        other = pool.get('127.0.0.1', self.port)
+        self.assert_(other is not sock)
+        self.assertEquals(pool.dead, 1)
+        pool.discard(other)
+
+    def test_max_per_host (self):
+        pool = ConnectionPool(max_per_host = 1)
+        sock = pool.get('127.0.0.1', self.port)
+        got = event.Event()
+        spawn(lambda: got.send(pool.get('127.0.0.1', self.port)))
+        sleep(0.01)
+        self.assertFalse(got.ready())
+
+        pool.put(sock)
+        self.assert_(got.wait() is sock)
+
+    def test_idle_timeout (self):
+        pool = ConnectionPool(idle_timeout = 0.05)
+        pool.put(pool.get('127.0.0.1', self.port))
+        self.assertEquals(len(pool), 1)
+        sleep(0.1)
+        self.assertEquals(len(pool), 0)
+        self.assertEquals(pool.expired, 1)
+
+
+class TestPooledHTTPConnection(LimitedTestCase):
+    TEST_TIMEOUT = 2
+
+    def test_keepalive (self):
+        listener = convenience.listen(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        connections = []
+
+        def server ():
+            sock, addr = listener.accept()
+            connections.append(sock)
+            fd = sock.makefile('rb', 0)
+            close = False
+            while not close:
+                line = fd.readline()
+                while line not in ('\r\n', '\n', ''):
+                    close = close or line.lower().startswith('x-close')
+                    line = fd.readline()
+                if not line:
+                    break
+                body = 'hello'
+                headers = 'Content-Length: %d\r\n' % len(body)
+                if close:
+                    headers += 'Connection: close\r\n'
+                sock.sendall('HTTP/1.1 200 OK\r\n%s\r\n%s' % (headers, body))
+            sock.close()
+
+        gt = spawn(server)
+        pool = ConnectionPool()
+
+        for headers in ({}, {}, {'X-Close': '1'}):
+            conn = httplib.PooledHTTPConnection('127.0.0.1', port, pool = pool)
+            conn.request('GET', '/', headers = headers)
+            self.assertEquals(conn.getresponse().read(), 'hello')
+            conn.close()
+
+        ## all the requests used the same connection, that was closed by the server at the end
+        self.assertEquals(len(connections), 1)
+        self.assertEquals((pool.hits, pool.misses), (2, 1))
+        self.assertEquals(len(pool), 0)
+        gt.wait()
+        listener.close()
+
+
+if __name__ == '__main__':
+    main()
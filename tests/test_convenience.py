@@ -113,6 +113,28 @@ class TestConvenience(LimitedTestCase):
         gt.kill()
         self.assertEqual(100, hits[0])
 
+    def test_accept_batches (self):
+        hits = [0]
+
+        def counter (sock, addr):
+            hits[0] += 1
+
+        l = convenience.listen(('127.0.0.1', 0))
+        _, port = l.getsockname()
+
+        ## the connections are waiting in the backlog when the server starts
+        clients = [convenience.connect(('127.0.0.1', port)) for i in xrange(20)]
+        stats = convenience.AcceptStats()
+        gt = spawn(convenience.serve, l, counter, stats = stats)
+        for client in clients:
+            self.assertFalse(client.recv(100))
+
+        gt.kill()
+        self.assertEqual(20, hits[0])
+        self.assertEqual(20, stats.accepted)
+        self.assert_(stats.batches < 20)
+        self.assert_(stats.max_backlog > 1)
+
     def test_blocking (self):
         l = convenience.listen(('localhost', 0))
         x = with_timeout(0.01,
@@ -179,3 +201,28 @@ class TestConvenience(LimitedTestCase):
         lsock1.close()
         assert same_socket()
 
+    def test_connect_fastest (self):
+        l = convenience.listen(('127.0.0.1', 0))
+        port = l.getsockname()[1]
+        infos = [(socket.AF_INET, socket.SOCK_STREAM, 0, '', ('127.0.0.1', 1)),
+                 (socket.AF_INET, socket.SOCK_STREAM, 0, '', ('127.0.0.1', port))]
+
+        orig_getaddrinfo = socket.getaddrinfo
+        socket.getaddrinfo = lambda *args: infos
+        try:
+            # the first address refuses the connection: we do not wait for the next attempt
+            client = convenience.connect_fastest(('somehost', port), delay = 10)
+            self.assertEquals(client.getpeername(), ('127.0.0.1', port))
+            client.close()
+
+            del infos[1]
+            self.assertRaises(socket.error, convenience.connect_fastest, ('somehost', 1))
+        finally:
+            socket.getaddrinfo = orig_getaddrinfo
+
+    def test_interleave_families (self):
+        infos = [(socket.AF_INET6, 1), (socket.AF_INET6, 2), (socket.AF_INET6, 3),
+                 (socket.AF_INET, 4), (socket.AF_INET, 5)]
+        self.assertEquals([i[1] for i in convenience._interleave_families(infos)],
+                          [1, 4, 2, 5, 3])
+
@@ -27,21 +27,50 @@
 # THE SOFTWARE.
 #
 
+from __future__ import with_statement
+
 import socket as _orig_sock
 from tests import LimitedTestCase, main, skipped, s2b, skip_on_windows
 
 from evy.patched import socket
 
 import sys
+import os
+import tempfile
 
 import unittest
 
-from evy.green.dns import resolve
+from evy.green import dns
+from evy.green.dns import resolve, DnsCache
+from evy.green.threads import spawn, sleep
+from evy.support import greenlets as greenlet
+from evy.timeout import Timeout
 
 
 HOST = 'localhost'
 
 
+class FakeResolver(dns.CaresResolver):
+    """
+    A resolver that fails with *errorno* or *exception*, answers with the *answers* for
+    each query type, or never answers queries of other types
+    """
+    def __init__ (self, errorno = None, exception = None, answers = None):
+        self.errorno = errorno
+        self.exception = exception
+        self.answers = answers
+        self.queries = []
+
+    def query (self, name, query_type, cb):
+        self.queries.append((name, query_type))
+        if self.exception is not None:
+            raise self.exception
+        if self.answers is None:
+            cb(None, self.errorno)
+        elif query_type in self.answers:
+            cb(self.answers[query_type], None)
+
+
 class TestDnsResolution(unittest.TestCase):
     def test_resolve (self):
         res = resolve('google.com')
@@ -134,3 +163,201 @@ class TestDnsResolution(unittest.TestCase):
         addr, service = socket.getnameinfo(('127.0.0.1', 80), 0)
         self.assertEquals(service, 'http')
 
+
+class TestDnsCache(LimitedTestCase):
+    def setUp (self):
+        super(TestDnsCache, self).setUp()
+        self.queries = []
+
+    def query (self, answer, ttl = None, delay = 0):
+        def _query ():
+            self.queries.append(answer)
+            if delay:
+                sleep(delay)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer, ttl
+        return _query
+
+    def test_hits (self):
+        cache = DnsCache()
+        self.assertEquals(cache.lookup('a', self.query(['1.1.1.1'])), ['1.1.1.1'])
+        self.assertEquals(cache.lookup('a', self.query(['2.2.2.2'])), ['1.1.1.1'])
+        self.assertEquals(len(self.queries), 1)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+        self.assert_('a' in cache)
+
+        cache.flush()
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.lookup('a', self.query(['2.2.2.2'])), ['2.2.2.2'])
+
+    def test_ttl (self):
+        cache = DnsCache(ttl = 60)
+        cache.lookup('a', self.query(['1.1.1.1'], ttl = 0.05))
+        cache.lookup('b', self.query(['2.2.2.2']))
+        sleep(0.1)
+        self.assertFalse('a' in cache)
+        self.assert_('b' in cache)
+        self.assertEquals(cache.lookup('a', self.query(['3.3.3.3'])), ['3.3.3.3'])
+
+    def test_lru (self):
+        cache = DnsCache(max_entries = 2)
+        cache.lookup('a', self.query(['1.1.1.1']))
+        cache.lookup('b', self.query(['2.2.2.2']))
+        cache.lookup('a', self.query(['1.1.1.1']))
+        cache.lookup('c', self.query(['3.3.3.3']))
+        self.assertEquals(len(cache), 2)
+        self.assert_('a' in cache)
+        self.assertFalse('b' in cache)
+
+    def test_negative (self):
+        cache = DnsCache()
+        nodata = socket.gaierror(socket.EAI_NODATA, 'No address')
+        self.assertRaises(socket.gaierror, cache.lookup, 'a', self.query(nodata))
+        self.assertRaises(socket.gaierror, cache.lookup, 'a', self.query(['1.1.1.1']))
+        self.assertEquals(len(self.queries), 1)
+
+        # temporary failures are not cached
+        again = socket.gaierror(socket.EAI_AGAIN, 'Timed out')
+        self.assertRaises(socket.gaierror, cache.lookup, 'b', self.query(again))
+        self.assertEquals(cache.lookup('b', self.query(['1.1.1.1'])), ['1.1.1.1'])
+
+    def test_collapse (self):
+        cache = DnsCache()
+        query = self.query(['1.1.1.1'], delay = 0.05)
+        gts = [spawn(cache.lookup, 'a', query) for i in xrange(5)]
+        results = [gt.wait() for gt in gts]
+        self.assertEquals(results, [['1.1.1.1']] * 5)
+        self.assertEquals(len(self.queries), 1)
+        self.assertEquals((cache.misses, cache.collapsed), (1, 4))
+
+    def test_collapse_killed (self):
+        cache = DnsCache()
+        query = self.query(['1.1.1.1'], delay = 0.05)
+        owner = spawn(cache.lookup, 'a', query)
+        follower = spawn(cache.lookup, 'a', query)
+        sleep(0)
+        owner.kill()
+        self.assertRaises(greenlet.GreenletExit, follower.wait)
+        self.assertFalse('a' in cache)
+
+        # the next lookup runs a new query
+        self.assertEquals(cache.lookup('a', query), ['1.1.1.1'])
+        self.assertEquals(len(self.queries), 2)
+
+    def test_collapse_timeout (self):
+        cache = DnsCache()
+        query = self.query(['1.1.1.1'], delay = 0.05)
+
+        def owner ():
+            with Timeout(0.01):
+                cache.lookup('a', query)
+
+        owner = spawn(owner)
+        follower = spawn(cache.lookup, 'a', query)
+        self.assertRaises(Timeout, owner.wait)
+        self.assertRaises(Timeout, follower.wait)
+
+    def test_query_errors (self):
+        orig_resolver, orig_cache = dns.resolver, dns.cache
+        dns.cache = DnsCache()
+        try:
+            ## errors that are not answers from the DNS are not cached
+            dns.resolver = FakeResolver(exception = RuntimeError('broken resolver'))
+            self.assertRaises(RuntimeError, dns._query, 'a.invalid', dns.pycares.QUERY_TYPE_A)
+            self.assertRaises(RuntimeError, resolve, 'a.invalid')
+            dns.resolver = FakeResolver(dns.pycares.errno.ARES_ECONNREFUSED)
+            self.assertRaises(socket.gaierror, resolve, 'a.invalid')
+            self.assertEquals(len(dns.cache), 0)
+
+            ## but NXDOMAIN is
+            dns.resolver = FakeResolver(dns.pycares.errno.ARES_ENOTFOUND)
+            self.assertRaises(socket.gaierror, resolve, 'a.invalid')
+            self.assertEquals(len(dns.cache), 1)
+        finally:
+            dns.resolver, dns.cache = orig_resolver, orig_cache
+
+
+class TestAddrInfo(LimitedTestCase):
+    def setUp (self):
+        super(TestAddrInfo, self).setUp()
+        fd, self.hosts_path = tempfile.mkstemp()
+        os.write(fd, '# comment\n'
+                     '10.0.0.1  svc.internal  svc  # trailing comment\n'
+                     '10.0.0.2  svc.internal\n'
+                     'fd00::1   svc.internal\n'
+                     'fd00::2   only6.internal\n')
+        os.close(fd)
+        self.orig_hosts = dns.hosts
+        dns.hosts = dns.HostsFile(self.hosts_path)
+        self.orig_resolver, self.orig_cache = dns.resolver, dns.cache
+        dns.resolver = FakeResolver(dns.pycares.errno.ARES_ENOTFOUND)
+        dns.cache = DnsCache()
+
+    def tearDown (self):
+        dns.hosts = self.orig_hosts
+        dns.resolver, dns.cache = self.orig_resolver, self.orig_cache
+        os.unlink(self.hosts_path)
+        super(TestAddrInfo, self).tearDown()
+
+    def test_literals (self):
+        self.assert_(dns.is_ipv4_addr('192.168.0.1'))
+        self.assertFalse(dns.is_ipv4_addr('192.168.0'))
+        self.assertFalse(dns.is_ipv4_addr('::1'))
+        self.assert_(dns.is_ipv6_addr('::ffff:192.168.0.1'))
+        self.assertFalse(dns.is_ipv6_addr('localhost'))
+        self.assertFalse(dns.is_ipv6_addr(None))
+
+    def test_hosts (self):
+        self.assertEquals(resolve('SVC.internal'), ['10.0.0.1', '10.0.0.2'])
+        self.assertEquals(resolve('svc', _orig_sock.AF_INET), ['10.0.0.1'])
+        self.assertEquals(resolve('svc.internal', _orig_sock.AF_INET6), ['fd00::1'])
+        self.assertEquals(dns.resolver.queries, [])
+
+        ## families without addresses in the hosts file are looked up in the DNS
+        self.assertRaises(socket.gaierror, resolve, 'only6.internal')
+        self.assertEquals(dns.resolver.queries, [('only6.internal', dns.pycares.QUERY_TYPE_A)])
+        dns.resolver = FakeResolver(answers = {dns.pycares.QUERY_TYPE_A: ['10.0.0.3']})
+        dns.cache.flush()
+        self.assertEquals(dns.resolve_all('only6.internal'),
+                          [(_orig_sock.AF_INET, '10.0.0.3'), (_orig_sock.AF_INET6, 'fd00::2')])
+
+    def test_resolve_all_interrupted (self):
+        ## the AAAA query never gets an answer
+        dns.resolver = FakeResolver(answers = {dns.pycares.QUERY_TYPE_A: ['10.0.0.3']})
+        with Timeout(0.05, False):
+            dns.resolve_all('other.internal')
+            self.fail('resolve_all() did not time out')
+        sleep(0)
+        ## the query for the other family has been killed too
+        self.assertEquals(dns.cache.pending, {})
+
+    def test_getaddrinfo_families (self):
+        infos = dns.getaddrinfo('svc.internal', 80, 0, _orig_sock.SOCK_STREAM)
+        self.assertEquals(infos, [
+            (_orig_sock.AF_INET, _orig_sock.SOCK_STREAM, _orig_sock.IPPROTO_TCP, '', ('10.0.0.1', 80)),
+            (_orig_sock.AF_INET, _orig_sock.SOCK_STREAM, _orig_sock.IPPROTO_TCP, '', ('10.0.0.2', 80)),
+            (_orig_sock.AF_INET6, _orig_sock.SOCK_STREAM, _orig_sock.IPPROTO_TCP, '', ('fd00::1', 80, 0, 0)),
+        ])
+
+        infos = dns.getaddrinfo('svc.internal', 80, _orig_sock.AF_INET6)
+        self.assertEquals(set(info[0] for info in infos), set([_orig_sock.AF_INET6]))
+        self.assertEquals(set(info[1] for info in infos),
+                          set([_orig_sock.SOCK_STREAM, _orig_sock.SOCK_DGRAM, _orig_sock.SOCK_RAW]))
+
+    def test_getaddrinfo_flags (self):
+        infos = dns.getaddrinfo(None, 8080, _orig_sock.AF_INET, _orig_sock.SOCK_STREAM, 0,
+                                _orig_sock.AI_PASSIVE)
+        self.assertEquals(infos[0][4], ('0.0.0.0', 8080))
+
+        infos = dns.getaddrinfo('127.0.0.1', 80, _orig_sock.AF_INET6, _orig_sock.SOCK_STREAM, 0,
+                                _orig_sock.AI_V4MAPPED)
+        self.assertEquals(infos[0][4], ('::ffff:127.0.0.1', 80, 0, 0))
+
+        infos = dns.getaddrinfo('svc', 80, _orig_sock.AF_INET, _orig_sock.SOCK_STREAM, 0,
+                                _orig_sock.AI_CANONNAME)
+        self.assertEquals(infos[0][3], 'svc')
+
+        self.assertRaises(socket.gaierror, dns.getaddrinfo, 'svc', 80, 0, 0, 0,
+                          _orig_sock.AI_NUMERICHOST)
+        self.assertRaises(socket.gaierror, dns.getaddrinfo, '::1', 80, _orig_sock.AF_INET)
@@ -36,6 +36,7 @@ from evy.timeout import Timeout
 from evy.support import greenlets as greenlet
 from evy.event import Event
 from evy.green.pools import GreenPool
+from evy.green.threads import GreenThread, GreenTask
 from evy.green.threads import spawn, sleep
 
 import tests
@@ -268,6 +269,52 @@ class TestGreenPool(tests.LimitedTestCase):
         sleep(0)
         self.assertEqual(set(r), set([1, 2, 3, 4]))
 
+    def test_recycled_workers (self):
+        p = GreenPool(100, recycle = True)
+        seen = set()
+
+        def foo ():
+            seen.add(greenlet.getcurrent())
+
+        for i in xrange(100):
+            p.spawn_n(foo)
+        p.waitall()
+        # the functions do not block, so one worker is enough for all of them
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(len(p.workers), 1)
+
+        # the timers started by a function do not outlive it in the worker
+        def bar ():
+            hubs.get_hub().schedule_call_local(0, seen.clear)
+
+        p.spawn(bar).wait()
+        sleep(0.01)
+        self.assertEqual(len(seen), 1)
+
+    def test_greenthreads_by_default (self):
+        p = GreenPool(10)
+        gts = [p.spawn(greenlet.getcurrent) for i in xrange(3)]
+        self.assert_(all(isinstance(gt, GreenThread) for gt in gts))
+        self.assertEqual(p.coroutines_running, set(gts))
+        self.assertEqual([gt.wait() for gt in gts], gts)
+        self.assertEqual(p.coroutines_running, set())
+
+        p = GreenPool(10, recycle = True)
+        self.assert_(isinstance(p.spawn(greenlet.getcurrent), GreenTask))
+
+    def test_task_kill (self):
+        p = GreenPool(1)
+        evt = Event()
+        first = p.spawn(evt.wait)
+        results = []
+        waiter = spawn(p.spawn, results.append, 1)
+        sleep(0)
+        self.assertEqual(p.waiting(), 1)
+        first.kill()
+        waiter.wait().wait()
+        self.assertEqual(results, [1])
+        self.assertEqual(p.free(), 1)
+
     def test_exceptions (self):
         p = GreenPool(2)
         for m in (p.spawn, p.spawn_n):
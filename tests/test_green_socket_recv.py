@@ -258,6 +258,122 @@ class TestGreenSocketRecv(LimitedTestCase):
         accepted.send()
         gt.wait()
 
+    def test_recv_buffered (self):
+        listener = sockets.GreenSocket()
+        listener.bind(('', 0))
+        listener.listen(50)
+        address, port = listener.getsockname()
+
+        sent_data = ''.join(chr(i % 256) for i in xrange(100000))
+
+        def server ():
+            sock, addr = listener.accept()
+            sock.sendall(sent_data)
+            sock.close()
+
+        gt = spawn(server)
+
+        client = sockets.GreenSocket()
+        client.connect(('127.0.0.1', port))
+
+        # mix small recv() and recv_into() calls over the buffered data
+        received = []
+        buf = bytearray(7)
+        while True:
+            data = client.recv(13)
+            if not data:
+                break
+            received.append(data)
+            nbytes = client.recv_into(buf)
+            received.append(str(buf[:nbytes]))
+
+        gt.wait()
+        self.assertEquals(''.join(received), sent_data)
+
+    def test_makefile_readline (self):
+        listener = sockets.GreenSocket()
+        listener.bind(('', 0))
+        listener.listen(50)
+        address, port = listener.getsockname()
+
+        def server ():
+            sock, addr = listener.accept()
+            sock.sendall('first\r\nsecond\n' + 'x' * 20000 + '\nlast')
+            sock.close()
+
+        gt = spawn(server)
+
+        client = sockets.GreenSocket()
+        client.connect(('127.0.0.1', port))
+        f = client.makefile()
+        self.assertEquals(f.readline(), 'first\r\n')
+        self.assertEquals(f.readline(3), 'sec')
+        self.assertEquals(f.readline(), 'ond\n')
+        self.assertEquals(f.readline(), 'x' * 20000 + '\n')
+        self.assertEquals(f.readline(), 'last')
+        self.assertEquals(f.readline(), '')
+        gt.wait()
+
+    def test_recv_streaming (self):
+        listener = sockets.GreenSocket()
+        listener.bind(('', 0))
+        listener.listen(50)
+        address, port = listener.getsockname()
+
+        sent_data = 'x' * 100000
+        done = event.Event()
+
+        def server ():
+            sock, addr = listener.accept()
+            sock.sendall(sent_data)
+            done.wait()
+            sock.close()
+
+        gt = spawn(server)
+
+        client = sockets.GreenSocket()
+        client.connect(('127.0.0.1', port))
+        client.setstreaming(True, high_water = 10000, low_water = 1000)
+
+        # data is received while nobody is reading, up to the high water mark
+        sleep(0.1)
+        self.assert_(10000 <= client.uv_recv_buffer.size < len(sent_data))
+        self.assertFalse(client.uv_reading)
+
+        received = []
+        while sum(map(len, received)) < len(sent_data):
+            received.append(client.recv(3000))
+        self.assertEquals(''.join(received), sent_data)
+
+        done.send()
+        self.assertEquals(client.recv(100), '')
+        gt.wait()
+
+    def test_recv_streaming_timeout (self):
+        listener = sockets.GreenSocket()
+        listener.bind(('', 0))
+        listener.listen(50)
+        address, port = listener.getsockname()
+
+        accepted = event.Event()
+
+        def server ():
+            sock, addr = listener.accept()
+            accepted.wait()
+            sock.sendall('data')
+
+        gt = spawn(server)
+
+        client = sockets.GreenSocket()
+        client.settimeout(0.1)
+        client.setstreaming()
+        client.connect(('127.0.0.1', port))
+
+        self.assertRaises(socket.timeout, client.recv, 100)
+        accepted.send()
+        self.assertEquals(client.recv(100), 'data')
+        gt.wait()
+
 
 if __name__ == '__main__':
     main()
@@ -30,6 +30,7 @@
 
 import signal
 import math
+import tempfile
 
 from tests import LimitedTestCase, main, s2b
 
@@ -146,8 +147,8 @@ class TestGreenSocketSend(LimitedTestCase):
 
                 total_sent = 0
                 # want to exceed the size of the OS buffer so it'll block in a
-                # single send
-                for x in range(10):
+                # single send (before the timeout, that is rounded up to 1 ms)
+                for x in range(100):
                     total_sent += client.send(msg)
                 self.fail("socket.timeout not raised")
             except socket.timeout, e:
@@ -285,6 +286,105 @@ class TestGreenSocketSend(LimitedTestCase):
         for how_many in (1000, 10000, 100000, 1000000):
             test_sendall_impl(how_many)
 
+    def test_sendv (self):
+        listener = convenience.listen(('', 0))
+        _, listener_port = listener.getsockname()
+
+        def server ():
+            sock, addr = listener.accept()
+            data = []
+            while True:
+                last_data = sock.recv(65536)
+                if not last_data:
+                    break
+                data.append(last_data)
+            return ''.join(data)
+
+        def client ():
+            client = sockets.GreenSocket()
+            client.connect(('127.0.0.1', listener_port))
+            client.setwritelimit(20000)
+            for x in range(100):
+                client.sendv(['a' * 1000, '', buffer('xbc', 1), memoryview('de')])
+                # writes are not waited for while they are below the limit
+                self.assert_(client.uv_write_pending <= 20000)
+            client.close()
+            return ('a' * 1000 + 'bcde') * 100
+
+        res = waitall(spawn(client), spawn(server))
+        self.assertEqual(res[0], res[1])
+
+    def test_sendfile (self):
+        listener = convenience.listen(('', 0))
+        _, listener_port = listener.getsockname()
+
+        sent_data = ''.join(chr(i % 256) for i in xrange(3000000))
+        f = tempfile.TemporaryFile()
+        f.write(sent_data)
+        f.flush()
+
+        def server ():
+            sock, addr = listener.accept()
+            ## let the sender fill the socket buffers
+            sleep(0.05)
+            data = []
+            while True:
+                last_data = sock.recv(65536)
+                if not last_data:
+                    break
+                data.append(last_data)
+            return ''.join(data)
+
+        def client ():
+            client = sockets.GreenSocket()
+            client.connect(('127.0.0.1', listener_port))
+            client.sendall('header')
+            sent = client.sendfile(f, 10, 2000000)
+            self.assertEqual(f.tell(), 2000010)
+            sent += client.sendfile(f, 2000010)
+            client.close()
+            return sent
+
+        sent, received = waitall(spawn(client), spawn(server))
+        self.assertEqual(sent, len(sent_data) - 10)
+        self.assertEqual(received, 'header' + sent_data[10:])
+
+    def test_sendfile_while_reading (self):
+        ## the socket gets full while another greenlet reads from it
+        listener = convenience.listen(('', 0))
+        _, listener_port = listener.getsockname()
+
+        sent_data = ''.join(chr(i) for i in xrange(256)) * 32768
+        f = tempfile.TemporaryFile()
+        f.write(sent_data)
+        f.flush()
+
+        def server ():
+            sock, addr = listener.accept()
+            sleep(0.1)
+            data = []
+            received = 0
+            while received < len(sent_data):
+                data.append(sock.recv(65536))
+                received += len(data[-1])
+            sock.sendall('bye')
+            return ''.join(data)
+
+        def client ():
+            client = sockets.GreenSocket()
+            client.connect(('127.0.0.1', listener_port))
+            client.setstreaming(True)
+            reader = spawn(client.recv, 1024)
+            sleep(0)
+            sent = client.sendfile(f, 0)
+            self.assertEqual(reader.wait(), 'bye')
+            client.close()
+            return sent
+
+        sent, received = waitall(spawn(client), spawn(server))
+        self.assertEqual(sent, len(sent_data))
+        self.assertEqual(received, sent_data)
+
 
     def test_timeout_and_final_write (self):
         """
@@ -34,6 +34,7 @@ import warnings
 from evy import hubs
 from evy.event import Event
 from evy.green.threads import sleep, spawn, spawn_n, kill, spawn_after, spawn_after_local
+from evy.green.threads import recycle_workers, GreenTask
 from evy.green.threads import with_timeout, TimeoutError
 from evy.support import greenlets as greenlet
 from evy.io.convenience import listen, connect
@@ -138,6 +139,43 @@ class TestSpawn(LimitedTestCase, Asserts):
         self.assertEquals(results, [gt, (4,), {'b': 5}])
 
 
+class TestSpawnRecycled(TestSpawn):
+    def setUp (self):
+        super(TestSpawnRecycled, self).setUp()
+        recycle_workers()
+
+    def tearDown (self):
+        recycle_workers(0)
+        super(TestSpawnRecycled, self).tearDown()
+
+    def test_recycled (self):
+        workers = []
+
+        def func (a):
+            workers.append(greenlet.getcurrent())
+            return a
+
+        gts = [spawn(func, i) for i in xrange(10)]
+        self.assert_(isinstance(gts[0], GreenTask))
+        self.assertEquals([gt.wait() for gt in gts], range(10))
+        self.assertEquals(len(set(workers)), 1)
+
+        spawn_n(func, 10)
+        sleep(0)
+        self.assertEquals(set(workers), set(workers[:1]))
+
+    def test_kill_running (self):
+        evt = Event()
+        gt = spawn(evt.wait)
+        sleep(0)
+        self.assert_(gt)
+        kill(gt)
+        self.assert_dead(gt)
+
+        # the worker is still usable
+        self.assertEquals(spawn(passthru, 1).wait(), ((1,), {}))
+
+
 class TestSpawnAfter(LimitedTestCase, Asserts):
     def test_basic (self):
         gt = spawn_after(0.1, passthru, 20)
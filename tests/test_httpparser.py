@@ -0,0 +1,156 @@
+#
+# Evy - a concurrent networking library for Python
+#
+# Unless otherwise noted, the files in Evy are under the following MIT license:
+#
+# Copyright (c) 2012, Alvaro Saurin
+# Copyright (c) 2008-2010, Eventlet Contributors (see AUTHORS)
+# Copyright (c) 2007-2010, Linden Research, Inc.
+# Copyright (c) 2005-2006, Bob Ippolito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+
+from tests import LimitedTestCase, main
+
+from evy.web import httpparser
+
+
+REQUEST = ('GET /path?q=1 HTTP/1.1\r\n'
+           'Host: localhost\r\n'
+           'X-Multi: a\r\n'
+           'X-Folded: first\r\n'
+           '  second\r\n'
+           'x-multi: b\r\n'
+           '\r\n')
+
+
+class TestHttpRequestParser(LimitedTestCase):
+    def check (self, parser):
+        self.assert_(parser.done)
+        self.assertEquals(parser.requestline, 'GET /path?q=1 HTTP/1.1')
+        self.assertEquals(parser.headers, [('Host', 'localhost'),
+                                           ('X-Multi', 'a'),
+                                           ('X-Folded', 'first second'),
+                                           ('x-multi', 'b')])
+
+    def test_parse (self):
+        parser = httpparser.HttpRequestParser()
+        self.assertEquals(parser.feed(REQUEST), len(REQUEST))
+        self.check(parser)
+
+    def test_parse_incremental (self):
+        parser = httpparser.HttpRequestParser()
+        for c in REQUEST:
+            self.assertFalse(parser.done)
+            self.assertEquals(parser.feed(c), 1)
+        self.check(parser)
+
+    def test_leftover (self):
+        ## the body (or the next request) is not consumed
+        parser = httpparser.HttpRequestParser()
+        data = REQUEST[:10]
+        self.assertEquals(parser.feed(data), len(data))
+        data = REQUEST[10:] + 'body'
+        self.assertEquals(parser.feed(data), len(data) - 4)
+        self.check(parser)
+        self.assertEquals(parser.feed('more'), 0)
+
+    def test_leading_empty_lines (self):
+        parser = httpparser.HttpRequestParser()
+        parser.feed('\r\n\r\n' + REQUEST)
+        self.check(parser)
+
+    def test_limits (self):
+        parser = httpparser.HttpRequestParser(max_request_line = 20)
+        self.assertRaises(httpparser.RequestLineTooLong, parser.feed, 'GET /' + 'x' * 20)
+
+        parser = httpparser.HttpRequestParser(max_header_line = 20)
+        parser.feed('GET / HTTP/1.1\r\n')
+        self.assertRaises(httpparser.HeaderLineTooLong, parser.feed, 'Long: ' + 'x' * 20)
+
+        parser = httpparser.HttpRequestParser(max_total_header_size = 100)
+        parser.feed('GET / HTTP/1.1\r\n')
+        self.assertRaises(httpparser.HeadersTooLarge, parser.feed, 'Name: Value\r\n' * 10)
+
+    def test_invalid_header (self):
+        parser = httpparser.HttpRequestParser()
+        self.assertRaises(httpparser.BadRequest, parser.feed,
+                          'GET / HTTP/1.1\r\nno colon here\r\n\r\n')
+
+    def test_request_headers (self):
+        parser = httpparser.HttpRequestParser()
+        parser.feed(REQUEST)
+        headers = httpparser.RequestHeaders(parser.headers)
+        self.assertEquals(headers['HOST'], 'localhost')
+        self.assertEquals(headers.get('x-multi'), 'a, b')
+        self.assertEquals(headers.getheader('Missing', ''), '')
+        self.assert_('X-Folded' in headers)
+
+    def test_request_cookies (self):
+        headers = httpparser.RequestHeaders([('Cookie', 'a=1'), ('cookie', 'b=2; c=3')])
+        self.assertEquals(headers['cookie'], 'a=1; b=2; c=3')
+
+
+
+CHUNKED = '4;ext=1\r\nthis\r\n7\r\n is chu\r\n5\r\nnked\n\r\n0\r\nX-Trailer: 1\r\n\r\n'
+
+
+class TestChunkedDecoder(LimitedTestCase):
+    def decode (self, decoder, data, limit = None, readline = False):
+        ## decode all the data, returning the body and the data left
+        body = []
+        while data and not decoder.done:
+            used, start, end = decoder.decode(data, limit, readline)
+            body.append(data[start:end])
+            data = data[used:]
+            if readline and body[-1].endswith('\n'):
+                break
+        return ''.join(body), data
+
+    def test_decode (self):
+        decoder = httpparser.ChunkedDecoder()
+        self.assertEquals(self.decode(decoder, CHUNKED + 'GET'), ('this is chunked\n', 'GET'))
+        self.assert_(decoder.done)
+
+    def test_decode_incremental (self):
+        decoder = httpparser.ChunkedDecoder()
+        body = ''.join(self.decode(decoder, c)[0] for c in CHUNKED)
+        self.assertEquals(body, 'this is chunked\n')
+        self.assert_(decoder.done)
+
+    def test_decode_limits (self):
+        decoder = httpparser.ChunkedDecoder()
+        used, start, end = decoder.decode(CHUNKED, limit = 2)
+        self.assertEquals(CHUNKED[start:end], 'th')
+        self.assertEquals(decoder.wanted(), 2)
+        body, left = self.decode(decoder, CHUNKED[used:], readline = True)
+        self.assertEquals(body, 'is is chunked\n')
+        self.assertFalse(decoder.done)
+
+    def test_invalid_chunks (self):
+        for data in ('x\r\n', '-1\r\n', '2\r\nabc\r\n', '1' * 5000):
+            decoder = httpparser.ChunkedDecoder()
+            self.assertRaises(httpparser.BadRequest, self.decode, decoder, data)
+
+
+if __name__ == '__main__':
+    main()
@@ -31,6 +31,7 @@
 from __future__ import with_statement
 
 from tests import LimitedTestCase, main, skip_if_no_itimer
+import heapq
 import time
 
 from evy import hubs
@@ -105,6 +106,29 @@ class TestTimerCleanup(LimitedTestCase):
 
         sleep()
 
+    def test_destroy (self):
+        # a destroyed timer is accounted as a canceled one
+        hub = hubs.get_hub()
+        # forget the timers canceled by other tests
+        hub.timers = [entry for entry in hub.timers if not entry[2].called]
+        heapq.heapify(hub.timers)
+        hub.timers_canceled = 0
+        referenced = hub.timers_referenced
+        lst = []
+        t = hub.schedule_call_global(DELAY, lst.append, 1)
+        t.destroy()
+        self.assertEquals(hub.timers_canceled, 1)
+        self.assertEquals(hub.timers_referenced, referenced)
+        sleep(DELAY * 2)
+        self.assertEquals(lst, [])
+        self.assertEquals(hub.timers_canceled, 0)
+
+    def test_deadline_rounded_up (self):
+        hub = hubs.get_hub()
+        t = hub.schedule_call_global(0.0001, noop)
+        self.assertEquals(t.scheduled_time, hub.uv_loop.now() + 1)
+        t.cancel()
+
 
 class TestScheduleCall(LimitedTestCase):
     def test_local (self):
@@ -130,6 +154,102 @@ class TestScheduleCall(LimitedTestCase):
             sleep(DELAY)
         self.assertEquals(sorted(lst), sorted([1, 2, 3]))
 
+    def test_ordering_same_deadline (self):
+        lst = []
+        for i in xrange(10):
+            hubs.get_hub().schedule_call_global(0, lst.append, i)
+        sleep(DELAY)
+        self.assertEquals(lst, range(10))
+
+    def test_rescheduled_while_firing (self):
+        # a timer added from a timer callback must not run in the same batch
+        hub = hubs.get_hub()
+        lst = []
+        def again ():
+            lst.append(hub.timers_count)
+            if len(lst) < 3:
+                hub.schedule_call_global(0, again)
+        hub.schedule_call_global(0, again)
+        while len(lst) < 3:
+            sleep(DELAY)
+        self.assertEquals(len(lst), 3)
+
+    def test_cancel_lazy (self):
+        hub = hubs.get_hub()
+        stimers = hub.timers_count
+        lst = []
+        t = hub.schedule_call_global(DELAY, lst.append, 1)
+        hub.schedule_call_global(DELAY * 2, lst.append, 2)
+        t.cancel()
+        # canceled timers are discarded when they reach the top of the heap
+        self.assertEquals(hub.timers_count, stimers + 2)
+        sleep(DELAY * 3)
+        self.assertEquals(lst, [2])
+        self.assertEquals(hub.timers_count, stimers)
+
+
+class TestPollers(LimitedTestCase):
+    def test_reuse (self):
+        from evy import patcher
+
+        orig_socket = patcher.original('socket')
+        r, w = orig_socket.socketpair()
+        r.setblocking(0)
+        hub = hubs.get_hub()
+        reuses = hub.poller_reuses
+        try:
+            for i in xrange(10):
+                w.send('x')
+                hubs.trampoline(r, read = True)
+                self.assertEquals(r.recv(1), 'x')
+
+            p = hub.pollers[r.fileno()]
+            self.assert_(not p.active)
+            self.assertEquals(hub.poller_reuses, reuses + 9)
+
+            hubs.trampoline(r, write = True)
+            self.assert_(hub.pollers[r.fileno()] is p)
+            self.assertEquals(hub.poller_reuses, reuses + 10)
+        finally:
+            hub.remove_descriptor(r.fileno())
+            self.assert_(r.fileno() not in hub.pollers)
+            r.close()
+            w.close()
+
+
+class TestCallbacks(LimitedTestCase):
+    def test_fifo (self):
+        lst = []
+        hub = hubs.get_hub()
+        for i in xrange(10):
+            hub.run_callback(lst.append, i)
+        sleep(0)
+        self.assertEquals(lst, range(10))
+
+    def test_cancel (self):
+        lst = []
+        hub = hubs.get_hub()
+        cb = hub.run_callback(lst.append, 1)
+        hub.run_callback(lst.append, 2)
+        cb.cancel()
+        sleep(0)
+        self.assertEquals(lst, [2])
+
+    def test_callbacks_per_iteration (self):
+        lst = []
+        hub = hubs.get_hub()
+        saved, hub.callbacks_per_iteration = hub.callbacks_per_iteration, 10
+        try:
+            for i in xrange(25):
+                hub.run_callback(lst.append, i)
+            hub._callbacks_triggered(hub.uv_idle)
+            self.assertEquals(lst, range(10))
+            self.assertEquals(hub.callback_count, 15)
+        finally:
+            hub.callbacks_per_iteration = saved
+        sleep(0)
+        self.assertEquals(lst, range(25))
+
 
 class TestDebug(LimitedTestCase):
     def test_timer_exceptions (self):
@@ -159,6 +279,16 @@ class TestExceptions(LimitedTestCase):
         assert delay >= DELAY * 0.9, 'sleep returned after %f seconds (was scheduled for %s)' % (
             delay, DELAY)
 
+    def test_sleep_after_blocking (self):
+        # the loop time is not updated while the hub is not running, so a timer added
+        # after blocking for a while must not be computed from the old loop time
+        sleep(0)
+        time.sleep(0.05)
+        start = time.time()
+        sleep(0.02)
+        delay = time.time() - start
+        assert delay >= 0.02 * 0.9, 'sleep returned after %f seconds (was scheduled for 0.02)' % delay
+
     def test_exception_spawn (self):
         def server ():
             raise RuntimeError(1234)
@@ -0,0 +1,222 @@
+#
+# Evy - a concurrent networking library for Python
+#
+# Unless otherwise noted, the files in Evy are under the following MIT license:
+#
+# Copyright (c) 2012, Alvaro Saurin
+# Copyright (c) 2008-2010, Eventlet Contributors (see AUTHORS)
+# Copyright (c) 2007-2010, Linden Research, Inc.
+# Copyright (c) 2005-2006, Bob Ippolito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+from tests import main
+from tests.test_patcher import ProcessBase
+
+
+supervised_script = '''
+import os
+import signal
+import socket
+import sys
+import time
+
+from evy.web import prefork
+
+def app (env, start_response):
+    body = str(os.getpid())
+    start_response('200 OK', [('Content-Length', str(len(body)))])
+    return [body]
+
+def get_pid (port):
+    deadline = time.time() + 5
+    while True:
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), 5)
+            sock.sendall('GET / HTTP/1.0\\r\\n\\r\\n')
+            data = ''
+            while True:
+                last_data = sock.recv(4096)
+                if not last_data:
+                    break
+                data += last_data
+            sock.close()
+            return int(data.split('\\r\\n\\r\\n')[1])
+        except (socket.error, IndexError, ValueError):
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+supervisor = prefork.Supervisor(('127.0.0.1', 0), app, workers = 2, reuse_port = %r,
+                                graceful_timeout = 1, log = open(os.devnull, 'w'))
+port = supervisor.bind()[1]
+pid = os.fork()
+if pid == 0:
+    supervisor.run()
+    os._exit(0)
+supervisor.sock.close()
+
+try:
+    workers = set(get_pid(port) for i in range(20))
+    print 'workers', len(workers)
+
+    ## dead workers are restarted
+    dead = workers.pop()
+    os.kill(dead, signal.SIGKILL)
+    time.sleep(1.5)
+    workers = set(get_pid(port) for i in range(20))
+    print 'restarted', dead not in workers
+
+    ## all the workers are replaced on SIGHUP
+    os.kill(pid, signal.SIGHUP)
+    time.sleep(1.5)
+    print 'reloaded', not (workers & set(get_pid(port) for i in range(20)))
+finally:
+    os.kill(pid, signal.SIGTERM)
+    print 'exit', os.waitpid(pid, 0)[1]
+'''
+
+resolving_script = '''
+import os
+import signal
+import socket
+import time
+
+from evy.green import dns
+from evy.web import prefork
+
+def app (env, start_response):
+    ## a name that is not in the hosts file, so it is resolved by the DNS resolver
+    try:
+        dns.resolve('evy-prefork-test.invalid')
+        body = 'resolved'
+    except socket.gaierror, e:
+        ## queries that time out fail with EAI_AGAIN
+        body = 'resolved' if e.args[0] != socket.EAI_AGAIN else str(e)
+    start_response('200 OK', [('Content-Length', str(len(body)))])
+    return [body]
+
+## do not wait too much for failed queries
+dns.DNS_QUERY_TIMEOUT = 2
+
+supervisor = prefork.Supervisor(('127.0.0.1', 0), app, workers = 1,
+                                graceful_timeout = 1, log = open(os.devnull, 'w'))
+port = supervisor.bind()[1]
+pid = os.fork()
+if pid == 0:
+    supervisor.run()
+    os._exit(0)
+supervisor.sock.close()
+
+try:
+    deadline = time.time() + 5
+    while True:
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), 10)
+            break
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+    sock.sendall('GET / HTTP/1.0\\r\\n\\r\\n')
+    data = ''
+    while True:
+        last_data = sock.recv(4096)
+        if not last_data:
+            break
+        data += last_data
+    sock.close()
+    print data.split('\\r\\n\\r\\n')[1]
+finally:
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+'''
+
+idle_script = '''
+import os
+import signal
+import socket
+import time
+
+from evy.web import prefork
+
+def app (env, start_response):
+    start_response('200 OK', [('Content-Length', '2')])
+    return ['ok']
+
+supervisor = prefork.Supervisor(('127.0.0.1', 0), app, workers = 1,
+                                graceful_timeout = 10, log = open(os.devnull, 'w'))
+port = supervisor.bind()[1]
+pid = os.fork()
+if pid == 0:
+    supervisor.run()
+    os._exit(0)
+supervisor.sock.close()
+
+try:
+    deadline = time.time() + 5
+    while True:
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), 10)
+            break
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+    ## a keep-alive connection, idle after its first request
+    sock.sendall('GET / HTTP/1.1\\r\\nHost: localhost\\r\\n\\r\\n')
+    data = ''
+    while not data.endswith('ok'):
+        data += sock.recv(4096)
+finally:
+    start = time.time()
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+print 'closed', repr(sock.recv(4096))
+print 'fast stop', time.time() - start < 5
+'''
+
+
+class TestSupervisor(ProcessBase):
+    TEST_TIMEOUT = 20
+
+    def check_supervisor (self, reuse_port):
+        output, lines = self.run_script(supervised_script % reuse_port)
+        self.assertEqual(lines[:4], ['workers 2', 'restarted True', 'reloaded True', 'exit 0'],
+                         output)
+
+    def test_shared_socket (self):
+        self.check_supervisor(False)
+
+    def test_reuse_port (self):
+        self.check_supervisor(True)
+
+    def test_resolve_in_worker (self):
+        output, lines = self.run_script(resolving_script)
+        self.assertEqual(lines[:1], ['resolved'], output)
+
+    def test_stop_with_idle_connections (self):
+        output, lines = self.run_script(idle_script)
+        self.assertEqual(lines[:2], ["closed ''", 'fast stop True'], output)
+
+
+if __name__ == '__main__':
+    main()
@@ -65,6 +65,19 @@ class TestTimer(TestCase):
         assert called
         assert not hub.running
 
+    def test_wheel (self):
+        wheel = timer.TimerWheel(resolution = 0.1)
+        called = []
+        wheel.add(0.2, called.append, 'second')
+        wheel.add(0.05, called.append, 'first')
+        canceled = wheel.add(0.1, called.append, 'canceled')
+        self.assertEqual(len(wheel), 3)
+        wheel.cancel(canceled)
+        sleep(0.5)
+        self.assertEqual(called, ['first', 'second'])
+        self.assertEqual(len(wheel), 0)
+        self.assert_(wheel.timer is None)
+
 
 if __name__ == '__main__':
     main()
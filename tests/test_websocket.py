@@ -27,8 +27,11 @@
 # THE SOFTWARE.
 #
 
+import os
 import socket
 import errno
+import struct
+import zlib
 
 import evy
 from evy import event
@@ -38,13 +41,16 @@ from evy.patched import httplib
 from evy.io.sockets import shutdown_safe
 from evy.io.convenience import connect, listen
 from evy.green.threads import sleep
-from evy.web.websocket import WebSocket, WebSocketWSGI
+from evy.web.websocket import WebSocket, WebSocketWSGI, BroadcastGroup
+from evy.web import websocket
 
 from tests import mock, LimitedTestCase, certificate_file, private_key_file
 from tests import skip_if_no_ssl
 from tests.test_wsgi import _TestBase
 
 
+group = BroadcastGroup()
+
 # demo app
 def handle (ws):
     if ws.path == '/echo':
@@ -57,6 +63,16 @@ def handle (ws):
         for i in xrange(10):
             ws.send("msg %d" % i)
             sleep(0.01)
+    elif ws.path == '/group':
+        group.add(ws)
+        try:
+            while True:
+                m = ws.wait()
+                if m is None:
+                    break
+                group.send(m)
+        finally:
+            group.remove(ws)
     elif ws.path == '/error':
         # some random socket error that we shouldn't normally get
         raise socket.error(errno.ENOTSOCK)
@@ -65,6 +81,7 @@ def handle (ws):
 
 
 wsapp = WebSocketWSGI(handle)
+deflate_app = WebSocketWSGI(handle, compression = True, compression_min_size = 10)
 
 
 class TestWebSocket(_TestBase):
@@ -559,6 +576,327 @@ class TestWebSocket(_TestBase):
         self.assert_(error_detected[0])
 
 
+def mask_frame (opcode, payload, fin = True, rsv = 0):
+    """
+    Build a (masked) frame, as sent by a RFC 6455 client
+    """
+    mask = os.urandom(4)
+    length = len(payload)
+    b1 = (fin and 0x80 or 0) | rsv | opcode
+    if length < 126:
+        header = struct.pack('!BB', b1, 0x80 | length)
+    elif length < 65536:
+        header = struct.pack('!BBH', b1, 0x80 | 126, length)
+    else:
+        header = struct.pack('!BBQ', b1, 0x80 | 127, length)
+    return header + mask + websocket.unmask(payload, mask)
+
+
+def read_frame (sock):
+    """
+    Read a (unmasked) frame sent by the server, returning the first byte and the payload
+    """
+    fd = sock.makefile()
+    b1, b2 = map(ord, fd.read(2))
+    length = b2 & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', fd.read(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', fd.read(8))[0]
+    return b1, fd.read(length)
+
+
+class _RFC6455TestBase(_TestBase):
+    TEST_TIMEOUT = 5
+
+    def upgrade (self, path = '/echo', version = '13', extensions = None):
+        sock = connect(('localhost', self.port))
+        headers = [
+            "GET %s HTTP/1.1" % path,
+            "Upgrade: websocket",
+            "Connection: keep-alive, Upgrade",
+            "Host: localhost:%s" % self.port,
+            "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==",
+            "Sec-WebSocket-Version: %s" % version,
+            ]
+        if extensions is not None:
+            headers.append("Sec-WebSocket-Extensions: %s" % extensions)
+        sock.sendall('\r\n'.join(headers) + '\r\n\r\n')
+        fd = sock.makefile()
+        status = fd.readline()
+        headers = {}
+        while True:
+            line = fd.readline()
+            if line == '\r\n':
+                break
+            name, value = line.split(': ', 1)
+            headers[name.lower()] = value.strip()
+        return sock, status, headers
+
+
+class TestRFC6455WebSocket(_RFC6455TestBase):
+
+    def set_site (self):
+        self.site = wsapp
+
+    def test_handshake (self):
+        sock, status, headers = self.upgrade()
+        self.assertEqual(status, 'HTTP/1.1 101 Switching Protocols\r\n')
+        self.assertEqual(headers['sec-websocket-accept'], 's3pPLMBiTxaQ9kYGzzhZRbK+xOo=')
+        self.assertEqual(headers['upgrade'], 'websocket')
+
+        sock, status, headers = self.upgrade(version = '5')
+        self.assert_(status.startswith('HTTP/1.1 426'))
+        self.assertEqual(headers['sec-websocket-version'], '13')
+
+    def test_echo (self):
+        sock, status, headers = self.upgrade()
+        for message in ('hello', '', 'x' * 1000, 'y' * 70000):
+            sock.sendall(mask_frame(websocket.OP_TEXT, message))
+            self.assertEqual(read_frame(sock), (0x80 | websocket.OP_TEXT, message))
+
+        ## a unicode message, in pieces
+        frame = mask_frame(websocket.OP_TEXT, u'\u00e9t\u00e9'.encode('utf-8'))
+        for c in frame:
+            sock.sendall(c)
+        self.assertEqual(read_frame(sock)[1].decode('utf-8'), u'\u00e9t\u00e9')
+
+    def test_fragments_and_ping (self):
+        sock, status, headers = self.upgrade()
+        sock.sendall(mask_frame(websocket.OP_TEXT, 'hel', fin = False) +
+                     mask_frame(websocket.OP_PING, 'are you there?') +
+                     mask_frame(websocket.OP_CONTINUATION, 'lo'))
+        self.assertEqual(read_frame(sock), (0x80 | websocket.OP_PONG, 'are you there?'))
+        self.assertEqual(read_frame(sock), (0x80 | websocket.OP_TEXT, 'hello'))
+
+    def test_close (self):
+        sock, status, headers = self.upgrade()
+        sock.sendall(mask_frame(websocket.OP_CLOSE, struct.pack('!H', 1001)))
+        self.assertEqual(read_frame(sock), (0x80 | websocket.OP_CLOSE, struct.pack('!H', 1001)))
+        self.assertEqual(sock.recv(1024), '')
+
+    def test_protocol_errors (self):
+        for frame in ('\x81\x05hello',                                   # not masked
+                      mask_frame(websocket.OP_CONTINUATION, 'x'),       # no message
+                      mask_frame(websocket.OP_TEXT, 'x', rsv = 0x40),   # no extension
+                      mask_frame(websocket.OP_PING, 'x', fin = False)):
+            sock, status, headers = self.upgrade()
+            sock.sendall(frame)
+            self.assertEqual(read_frame(sock), (0x80 | websocket.OP_CLOSE, struct.pack('!H', 1002)))
+
+        sock, status, headers = self.upgrade()
+        sock.sendall(mask_frame(websocket.OP_TEXT, '\xff'))
+        self.assertEqual(read_frame(sock), (0x80 | websocket.OP_CLOSE, struct.pack('!H', 1007)))
+
+    def test_broadcast (self):
+        members = [self.upgrade('/group')[0] for i in xrange(3)]
+        while len(group) < 3:
+            sleep(0.01)
+        members[0].sendall(mask_frame(websocket.OP_TEXT, 'hello everybody'))
+        for sock in members:
+            self.assertEqual(read_frame(sock), (0x80 | websocket.OP_TEXT, 'hello everybody'))
+
+        members[1].sendall(mask_frame(websocket.OP_CLOSE, ''))
+        self.assertEqual(read_frame(members[1])[0], 0x80 | websocket.OP_CLOSE)
+        while len(group) > 2:
+            sleep(0.01)
+        members[2].sendall(mask_frame(websocket.OP_TEXT, 'x' * 5000))
+        for sock in members[0], members[2]:
+            self.assertEqual(read_frame(sock), (0x80 | websocket.OP_TEXT, 'x' * 5000))
+        group.close()
+
+    def test_unmask (self):
+        mask = os.urandom(4)
+        for length in range(20):
+            data = os.urandom(length)
+            masked = websocket.unmask(data, mask)
+            self.assertEqual(masked, ''.join(chr(ord(c) ^ ord(mask[i % 4]))
+                                             for i, c in enumerate(data)))
+            self.assertEqual(websocket.unmask(masked, mask), data)
+
+
+class TestPerMessageDeflate(_RFC6455TestBase):
+
+    def set_site (self):
+        self.site = deflate_app
+
+    def compress (self, compressor, message):
+        return (compressor.compress(message) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+    def decompress (self, decompressor, payload):
+        return decompressor.decompress(payload + '\x00\x00\xff\xff')
+
+    def test_negotiation (self):
+        sock, status, headers = self.upgrade(extensions = 'permessage-deflate')
+        self.assertEqual(headers['sec-websocket-extensions'], 'permessage-deflate')
+        sock, status, headers = self.upgrade(extensions = 'x-webkit-deflate-frame')
+        self.assertFalse('sec-websocket-extensions' in headers)
+
+        negotiate = deflate_app._negotiate_deflate
+        self.assertEqual(negotiate('foo, bar')[1], None)
+        self.assertEqual(negotiate('permessage-deflate; server_max_window_bits=10; '
+                                   'client_max_window_bits')[1],
+                         'permessage-deflate; server_max_window_bits=10')
+        ## invalid offers are skipped
+        self.assertEqual(negotiate('permessage-deflate; server_max_window_bits=20, '
+                                   'permessage-deflate; server_max_window_bits=8, '
+                                   'permessage-deflate; foo, '
+                                   'permessage-deflate; client_no_context_takeover')[1],
+                         'permessage-deflate; client_no_context_takeover')
+
+        app = WebSocketWSGI(handle, compression = True, compression_window_bits = 12,
+                            compression_context_takeover = False)
+        deflate, response = app._negotiate_deflate('permessage-deflate; client_max_window_bits')
+        self.assertEqual(response, 'permessage-deflate; server_no_context_takeover; '
+                                   'client_no_context_takeover; server_max_window_bits=12; '
+                                   'client_max_window_bits=12')
+        self.assertEqual(deflate.compressor, None)
+        self.assertEqual(deflate.decompressor, None)
+
+    def test_echo (self):
+        sock, status, headers = self.upgrade(extensions = 'permessage-deflate')
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        decompressor = zlib.decompressobj(-15)
+        for message in ('{"hello": "world", "values": [1, 2, 3, 4, 5]}', 'x' * 100000, 'hi'):
+            sock.sendall(mask_frame(websocket.OP_TEXT, self.compress(compressor, message),
+                                    rsv = websocket.RSV1))
+            b1, payload = read_frame(sock)
+            if len(message) < 10:
+                self.assertEqual((b1, payload), (0x80 | websocket.OP_TEXT, message))
+            else:
+                self.assertEqual(b1, 0x80 | websocket.RSV1 | websocket.OP_TEXT)
+                self.assertEqual(self.decompress(decompressor, payload), message)
+
+        ## an uncompressed message, and a compressed one in fragments
+        sock.sendall(mask_frame(websocket.OP_TEXT, 'y' * 100))
+        self.assertEqual(self.decompress(decompressor, read_frame(sock)[1]), 'y' * 100)
+        data = self.compress(compressor, 'z' * 100)
+        sock.sendall(mask_frame(websocket.OP_TEXT, data[:3], fin = False, rsv = websocket.RSV1) +
+                     mask_frame(websocket.OP_CONTINUATION, data[3:]))
+        self.assertEqual(self.decompress(decompressor, read_frame(sock)[1]), 'z' * 100)
+
+    def test_invalid_data (self):
+        for frame, code in ((mask_frame(websocket.OP_PING, 'x', rsv = websocket.RSV1), 1002),
+                            (mask_frame(websocket.OP_TEXT, 'garbage', rsv = websocket.RSV1), 1007)):
+            sock, status, headers = self.upgrade(extensions = 'permessage-deflate')
+            sock.sendall(frame)
+            self.assertEqual(read_frame(sock), (0x80 | websocket.OP_CLOSE, struct.pack('!H', code)))
+
+        ## a small message that is too big once decompressed
+        bomb = self.compress(zlib.compressobj(9, zlib.DEFLATED, -15),
+                             '\x00' * (websocket.MAX_MESSAGE_SIZE + 1))
+        self.assert_(len(bomb) < 100000)
+        sock, status, headers = self.upgrade(extensions = 'permessage-deflate')
+        sock.sendall(mask_frame(websocket.OP_BINARY, bomb, rsv = websocket.RSV1))
+        self.assertEqual(read_frame(sock), (0x80 | websocket.OP_CLOSE, struct.pack('!H', 1009)))
+
+    def test_shared_contexts (self):
+        ## without context takeover, messages can be decompressed on their own, and the
+        ## connections share the same zlib contexts
+        first = websocket.PerMessageDeflate(server_takeover = False, client_takeover = False)
+        second = websocket.PerMessageDeflate(server_takeover = False, client_takeover = False)
+        for i in xrange(3):
+            for deflate in first, second:
+                message = 'message %d ' % i * 20
+                payload = deflate.compress(message)
+                self.assertEqual(self.decompress(zlib.decompressobj(-15), payload), message)
+                self.assertEqual(deflate.decompress(payload, 1000), message)
+        self.assertEqual(len(websocket._zlib_pool[first.compress_key]), 1)
+        self.assertEqual(len(websocket._zlib_pool[first.decompress_key]), 1)
+        self.assertRaises(ValueError, WebSocketWSGI, handle, compression_window_bits = 8)
+
+
+class FakeMember(object):
+    """
+    A websocket for a broadcast group that blocks while sending, until it is released
+    """
+    encoding_key = 'fake'
+
+    def __init__ (self):
+        self.frames = []
+        self.writes = 0
+        self.released = event.Event()
+        self.released.send()
+        self.socket = mock.Mock()
+
+    def encode_message (self, message, binary = False):
+        return 'frame:' + message
+
+    def _send_frames (self, frames):
+        self.writes += 1
+        self.released.wait()
+        self.frames.extend(frames)
+
+
+class TestBroadcastGroup(LimitedTestCase):
+    def test_send (self):
+        group = BroadcastGroup()
+        members = [FakeMember() for i in xrange(3)]
+        for ws in members:
+            group.add(ws)
+        self.assertEqual(len(group), 3)
+
+        group.send('hello', exclude = members[2])
+        group.send('world')
+        sleep(0.01)
+        for ws in members[:2]:
+            self.assertEqual(ws.frames, ['frame:hello', 'frame:world'])
+            self.assertEqual(ws.writes, 1)
+        self.assertEqual(members[2].frames, ['frame:world'])
+
+        ## the frame is encoded once, and shared by all the members
+        self.assert_(members[0].frames[1] is members[2].frames[0])
+
+        group.remove(members[0])
+        group.send('bye')
+        sleep(0.01)
+        self.assertEqual(members[0].frames, ['frame:hello', 'frame:world'])
+        self.assertEqual(members[1].frames[-1], 'frame:bye')
+        group.close()
+        self.assertEqual(len(group), 0)
+
+    def test_slow_drop (self):
+        group = BroadcastGroup(max_queued = 20)
+        slow, fast = FakeMember(), FakeMember()
+        slow.released.reset()
+        group.add(slow)
+        group.add(fast)
+
+        group.send('1')
+        sleep(0.01)
+        for i in xrange(2, 6):
+            group.send(str(i))
+            sleep(0.01)
+        self.assertFalse(slow in group)
+        self.assertEqual(group.dropped, 1)
+        self.assert_(slow.socket.shutdown.called)
+
+        slow.released.send()
+        sleep(0.01)
+        self.assertEqual(slow.frames, ['frame:1'])
+        self.assertEqual(fast.frames, ['frame:%d' % i for i in xrange(1, 6)])
+
+    def test_slow_coalesce (self):
+        group = BroadcastGroup(max_queued = 20, policy = websocket.SLOW_COALESCE)
+        slow = FakeMember()
+        slow.released.reset()
+        group.add(slow)
+
+        group.send('1')
+        sleep(0.01)
+        for i in xrange(2, 6):
+            group.send(str(i))
+        self.assert_(slow in group)
+        self.assertEqual(group.coalesced, 2)
+
+        slow.released.send()
+        sleep(0.01)
+        self.assertEqual(slow.frames, ['frame:1', 'frame:4', 'frame:5'])
+        group.close()
+
+        self.assertRaises(ValueError, BroadcastGroup, policy = 'unknown')
+
+
 class TestWebSocketSSL(_TestBase):
     def set_site (self):
         self.site = wsapp
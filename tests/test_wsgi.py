@@ -32,9 +32,13 @@ import cgi
 from evy.green import threads as greenthread
 import evy
 import errno
+import json
 import os
 import socket
 import sys
+import tempfile
+import time
+import zlib
 from tests import skipped, LimitedTestCase, skip_if_no_ssl
 from unittest import main
 
@@ -193,6 +197,20 @@ def read_http (sock):
     return response_line, headers, body
 
 
+def decode_chunked (body, join = True):
+    chunks = []
+    while True:
+        size, _, body = body.partition('\r\n')
+        size = int(size, 16)
+        if not size:
+            break
+        chunks.append(body[:size])
+        body = body[size + 2:]
+    if join:
+        return ''.join(chunks)
+    return chunks
+
+
 class _TestBase(LimitedTestCase):
     def setUp (self):
         super(_TestBase, self).setUp()
@@ -1139,6 +1157,337 @@ class TestHttpd(_TestBase):
         self.assertEqual(headers['connection'], 'close')
         self.assert_('transfer-encoding' not in headers)
 
+    def test_compression (self):
+        text = 'hello world\n' * 1000
+
+        def app (env, start_response):
+            content_type = env['PATH_INFO'] == '/png' and 'image/png' or 'text/plain'
+            start_response('200 OK', [('Content-Type', content_type)])
+            return [text[:int(env.get('QUERY_STRING') or len(text))]]
+
+        self.site.application = app
+        self.spawn_server(compression = True)
+
+        def get (path, accept_encoding):
+            sock = connect(('127.0.0.1', self.port))
+            sock.sendall('GET %s HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n'
+                         'Accept-Encoding: %s\r\n\r\n' % (path, accept_encoding))
+            response_line, headers, body = read_http(sock)
+            sock.close()
+            if headers.get('transfer-encoding') == 'chunked':
+                body = decode_chunked(body)
+            return headers, body
+
+        headers, body = get('/', 'deflate;q=0.5, gzip')
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertEqual(headers['vary'], 'Accept-Encoding')
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), text)
+
+        headers, body = get('/', 'gzip;q=0, deflate')
+        self.assertEqual(headers['content-encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(body), text)
+
+        ## not accepted, too small or already compressed
+        for path, accept_encoding in (('/', 'identity'), ('/?10', 'gzip'), ('/png', 'gzip')):
+            headers, body = get(path, accept_encoding)
+            self.assert_('content-encoding' not in headers)
+            self.assertEqual(headers['content-length'], str(len(body)))
+
+    def test_compression_streaming (self):
+        def app (env, start_response):
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            for i in range(10):
+                yield '{"block": %d, "data": "%s"}\n' % (i, 'x' * 1000)
+
+        self.site.application = app
+        self.spawn_server(compression = True, minimum_chunk_size = 1000)
+        sock = connect(('127.0.0.1', self.port))
+        sock.sendall('GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n'
+                     'Accept-Encoding: gzip\r\n\r\n')
+        response_line, headers, body = read_http(sock)
+        self.assertEqual(headers['transfer-encoding'], 'chunked')
+        self.assertEqual(headers['content-encoding'], 'gzip')
+
+        ## every chunk can be decompressed as soon as it is received
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = decode_chunked(body, join = False)
+        self.assert_(len(chunks) >= 10)
+        lines = [decompressor.decompress(chunk) for chunk in chunks]
+        self.assertEqual(lines[0], '{"block": 0, "data": "%s"}\n' % ('x' * 1000))
+        self.assertEqual(len(''.join(lines).splitlines()), 10)
+
+    def test_compression_http10_aligned (self):
+        ## a body made of full blocks: the compressed stream must be finished after them
+        block = 'x' * 4096
+
+        def app (env, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            yield block
+            yield block
+
+        self.site.application = app
+        self.spawn_server(compression = True, minimum_chunk_size = 4096)
+        sock = connect(('127.0.0.1', self.port))
+        sock.sendall('GET / HTTP/1.0\r\nAccept-Encoding: gzip\r\n\r\n')
+        received = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            received.append(data)
+        sock.close()
+
+        head, body = ''.join(received).split('\r\n\r\n', 1)
+        self.assert_('Content-Encoding: gzip' in head, head)
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), block * 2)
+
+    def test_file_wrapper (self):
+        body = ''.join(chr(i % 256) for i in xrange(200000))
+        f = tempfile.NamedTemporaryFile()
+        f.write(body)
+        f.flush()
+
+        def file_app (env, start_response):
+            if env['PATH_INFO'] == '/file':
+                start_response('200 OK', [('Content-type', 'application/octet-stream')])
+                sent_file = open(f.name, 'rb')
+                sent_file.seek(100)
+                return env['wsgi.file_wrapper'](sent_file)
+            ## not a real file: it is sent as any other iterable
+            start_response('200 OK', [('Content-type', 'application/octet-stream'),
+                                      ('Content-Length', str(len(body) - 100))])
+            return env['wsgi.file_wrapper'](StringIO(body[100:]), 1000)
+
+        self.site.application = file_app
+        sock = connect(('127.0.0.1', self.port))
+        fd = sock.makefile('rw')
+        for path in ('/file', '/stringio', '/file'):
+            fd.write('GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n' % path)
+            fd.flush()
+            response_line, headers, data = read_http(sock)
+            self.assert_(response_line.startswith('HTTP/1.1 200 OK'))
+            self.assertEqual(data, body[100:])
+            self.assertEqual(headers['content-length'], str(len(body) - 100))
+        fd.close()
+        sock.close()
+        f.close()
+
+    def test_file_wrapper_short_file (self):
+        body = 'x' * 1000
+        f = tempfile.NamedTemporaryFile()
+        f.write(body)
+        f.flush()
+
+        def file_app (env, start_response):
+            ## the declared length is bigger than the file
+            start_response('200 OK', [('Content-type', 'application/octet-stream'),
+                                      ('Content-Length', str(len(body) + 100))])
+            return env['wsgi.file_wrapper'](open(f.name, 'rb'))
+
+        self.site.application = file_app
+        sock = connect(('127.0.0.1', self.port))
+        sock.sendall('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        fd = sock.makefile()
+        response_line = fd.readline()
+        self.assert_(response_line.startswith('HTTP/1.1 200 OK'))
+        headers = {}
+        while True:
+            line = fd.readline()
+            if line == '\r\n':
+                break
+            name, value = line.split(':', 1)
+            headers[name.lower()] = value.strip()
+        self.assertEqual(headers['connection'], 'close')
+        ## the connection is closed after the file, instead of waiting for the missing bytes
+        self.assertEqual(fd.read(), body)
+        fd.close()
+        sock.close()
+        f.close()
+
+    def test_accept_stats (self):
+        server_event = event.Event()
+        self.spawn_server(server_event = server_event)
+        server = server_event.wait()
+        for i in range(3):
+            sock = connect(('127.0.0.1', self.port))
+            sock.sendall('GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+            read_http(sock)
+            sock.close()
+        self.assertEqual(server.accept_stats.accepted, 3)
+        self.assert_(server.accept_stats.max_backlog >= 1)
+
+    def test_keepalive_timeout (self):
+        self.reset_timeout(5)
+        self.spawn_server(keepalive_timeout = 0.5)
+        sock = connect(('127.0.0.1', self.port))
+        sock.sendall('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response_line, headers, body = read_http(sock)
+        self.assert_(response_line.startswith('HTTP/1.1 200'))
+        start = time.time()
+        self.assertEqual(sock.recv(1024), '')
+        self.assert_(time.time() - start < 2.5)
+
+    def test_header_timeout (self):
+        self.reset_timeout(5)
+        server_event = event.Event()
+        self.spawn_server(header_timeout = 0.5, server_event = server_event)
+        server = server_event.wait()
+        sock = connect(('127.0.0.1', self.port))
+        sock.sendall('GET / HTTP/1.1\r\nHost: local')
+        self.assertEqual(sock.recv(1024), '')
+        self.assertEqual(server.timed_out_connections, 1)
+
+    def test_body_timeout (self):
+        self.reset_timeout(5)
+        errors = []
+
+        def app (env, start_response):
+            try:
+                env['wsgi.input'].read()
+            except socket.timeout, e:
+                errors.append(e)
+            start_response('408 Request Timeout', [('Content-Length', '0'),
+                                                   ('Connection', 'close')])
+            return []
+
+        self.site.application = app
+        self.spawn_server(body_timeout = 0.5)
+        sock = connect(('127.0.0.1', self.port))
+        sock.sendall('POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: 10\r\n\r\n12')
+        response_line, headers, body = read_http(sock)
+        self.assert_(response_line.startswith('HTTP/1.1 408'))
+        self.assertEqual(len(errors), 1)
+
+    def test_reap_idle_connections (self):
+        server_event = event.Event()
+        self.spawn_server(max_size = wsgi.MIN_FREE_CONNECTIONS + 2, server_event = server_event)
+        server = server_event.wait()
+        request = 'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        idle = []
+        for i in range(2):
+            sock = connect(('127.0.0.1', self.port))
+            sock.sendall(request)
+            read_http(sock)
+            idle.append(sock)
+        self.assertEqual(len(server.idle_connections), 2)
+
+        ## a new connection leaves the server with too few free slots: the oldest idle
+        ## connection is closed
+        sock = connect(('127.0.0.1', self.port))
+        sock.sendall(request)
+        read_http(sock)
+        self.assertEqual(idle[0].recv(1024), '')
+        self.assertEqual(server.reaped_connections, 1)
+        self.assertEqual(server.timed_out_connections, 0)
+        idle[1].sendall(request)
+        response_line, headers, body = read_http(idle[1])
+        self.assert_(response_line.startswith('HTTP/1.1 200'))
+
+    def test_metrics (self):
+        server_event = event.Event()
+        self.spawn_server(metrics_path = '/metrics', log_output = False,
+                          server_event = server_event)
+        server = server_event.wait()
+        request = 'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        sock = connect(('127.0.0.1', self.port))
+        for i in range(2):
+            sock.sendall(request)
+            read_http(sock)
+        sock.sendall('GET / HTTP/1.1\r\nBad Header\r\n\r\n')
+        self.assert_(read_http(sock)[0].startswith('HTTP/1.0 400'))
+
+        sock = connect(('127.0.0.1', self.port))
+        sock.sendall('GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response_line, headers, body = read_http(sock)
+        self.assertEqual(headers['content-type'], 'application/json')
+        metrics = json.loads(body)
+        ## the bad request is not counted, but the request for the metrics is
+        self.assertEqual(metrics['requests'], 3)
+        self.assertEqual(metrics['keepalive_requests'], 1)
+        self.assertEqual(metrics['responses']['2xx'], 2)
+        self.assertEqual(metrics['errors'], {'400': 1})
+        self.assertEqual(metrics['request_duration']['count'], 2)
+        self.assertEqual(metrics['pool']['size'], 128)
+        self.assertEqual(metrics['pool']['running'], 1)
+        self.assert_(metrics['bytes_out'] > 0)
+
+        ## the metrics request itself is accounted when it is done
+        sleep(0.1)
+        self.assertEqual(server.metrics.request_duration.count, 3)
+        self.assertEqual(server.metrics.accept_latency.count, 2)
+
+    def test_date_header (self):
+        self.reset_timeout(3)
+        first = wsgi.date_header()
+        self.assert_(first is wsgi.date_header())
+        self.assertEqual(first, 'Date: %s\r\n' % wsgi.format_date_time(time.time()))
+
+        ## the cached value is dropped in the next second
+        sleep(1.05 - time.time() % 1.0)
+        self.assertEqual(wsgi.date_header(), 'Date: %s\r\n' % wsgi.format_date_time(time.time()))
+        self.assertNotEqual(wsgi.date_header(), first)
+
+    def test_status_and_header_names (self):
+        self.assertEqual(wsgi.status_line('HTTP/1.1', '404 Not Found'), 'HTTP/1.1 404 Not Found\r\n')
+        self.assertEqual(wsgi.status_line('HTTP/1.1', '299 Custom'), 'HTTP/1.1 299 Custom\r\n')
+        self.assertEqual(wsgi.canonical_header_name('content-TYPE'), 'Content-Type')
+        self.assertEqual(wsgi.canonical_header_name('x-forwarded-for'), 'X-Forwarded-For')
+
+    def test_pipelined_requests (self):
+        def echo_path (env, start_response):
+            if env['PATH_INFO'] == '/slow':
+                sleep(0.01)
+            start_response('200 OK', [('Content-type', 'text/plain')])
+            return [env['PATH_INFO']]
+
+        self.site.application = echo_path
+
+        paths = ['/%d' % i for i in range(10)] + ['/slow'] + ['/%d' % i for i in range(10, 20)]
+        requests = ['GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n' % path for path in paths]
+        requests.append('GET /last HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+
+        sock = connect(('127.0.0.1', self.port))
+        sock.sendall(''.join(requests))
+        received = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            received.append(data)
+        sock.close()
+
+        responses = ''.join(received).split('HTTP/1.1 200 OK\r\n')[1:]
+        self.assertEqual(len(responses), len(paths) + 1)
+        for path, response in zip(paths + ['/last'], responses):
+            self.assert_(response.endswith('\r\n\r\n' + path), response)
+
+    def test_pipelined_raw_socket (self):
+        # the responses to the previous requests go before the data an application
+        # writes directly to the socket
+        def app (env, start_response):
+            if env['PATH_INFO'] == '/raw':
+                env['evy.input'].get_socket().sendall('RAW\r\n')
+                return wsgi.ALREADY_HANDLED
+            start_response('200 OK', [('Content-type', 'text/plain')])
+            return ['ok']
+
+        self.site.application = app
+
+        sock = connect(('127.0.0.1', self.port))
+        sock.sendall('GET /a HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                     'GET /raw HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        received = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            received.append(data)
+        sock.close()
+
+        received = ''.join(received)
+        self.assert_(received.startswith('HTTP/1.1 200 OK\r\n'), received)
+        self.assert_(received.endswith('\r\n\r\nokRAW\r\n'), received)
+
 
 def read_headers (sock):
     fd = sock.makefile()
@@ -1231,6 +1580,20 @@ class TestChunkedInput(_TestBase):
         elif pi == "/ping":
             input.read()
             response.append("pong")
+        elif pi == "/chunks":
+            input.chunk_size = 5
+            response = list(input)
+            assert max(map(len, response)) <= 5
+        elif pi == "/readinto":
+            buf = bytearray(6)
+            while True:
+                nbytes = input.readinto(buf)
+                if not nbytes:
+                    break
+                response.append(str(buf[:nbytes]))
+        elif pi == "/readlines":
+            response = input.readlines()
+            assert len(response) == 3
         else:
             raise RuntimeError("bad path")
 
@@ -1309,6 +1672,23 @@ class TestChunkedInput(_TestBase):
         fd.sendall(req)
         self.assertEquals(read_http(fd)[-1], 'this is chunked\nline 2\nline3')
 
+    def test_chunks (self):
+        for path in ('/chunks', '/readinto', '/readlines'):
+            req = "POST %s HTTP/1.1\r\ntransfer-encoding: Chunked\r\n\r\n%s" % (path, self.body())
+            fd = self.connect()
+            fd.sendall(req)
+            self.assertEquals(read_http(fd)[-1], 'this is chunked\nline 2\nline3')
+            self.ping(fd)
+
+    def test_chunks_with_content_length (self):
+        body = 'this is chunked\nline 2\nline3'
+        for path in ('/chunks', '/readinto', '/readlines'):
+            req = "POST %s HTTP/1.1\r\nContent-Length: %s\r\n\r\n%s" % (path, len(body), body)
+            fd = self.connect()
+            fd.sendall(req)
+            self.assertEquals(read_http(fd)[-1], body)
+            self.ping(fd)
+
     def test_close_before_finished (self):
         import signal
 